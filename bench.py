@@ -0,0 +1,405 @@
+# =========================
+# AUTOVOLT - BENCHMARKS (offline)
+# - Roda sem GCS/BQ: SINK=memoria (lake + state em memória, hot layer desligado)
+# - Geradores (linhas/s), sorteio de cliente vs tamanho da base (1k -> 1M),
+#   serialização por tabela (jsonl / jsonl.gz / parquet) e backfill de 1 ano
+#   ponta a ponta (tempo + pico de memória, cada cenário num subprocesso)
+# - Seeds fixas; resultado em JSON (--saida) pra comparar execuções
+#
+# Uso:
+#   python bench.py                      # tudo -> bench_results.json
+#   python bench.py --rapido             # tamanhos menores (smoke)
+#   python bench.py --so geradores,serializacao --saida antes.json
+# =========================
+
+import os
+os.environ["SINK"] = "memoria"  # antes do import do main (SINK é lido no import)
+
+import io
+import re
+import sys
+import ast
+import gzip
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import main
+
+SEED = 1234
+SUITES = ("geradores", "amostragem", "serializacao", "e2e")
+
+
+def semear(seed: int = SEED) -> None:
+    main.semear_rng(seed, seed)
+
+
+def cronometrar(fn, repeticoes: int) -> dict:
+    """Roda fn() `repeticoes` vezes (re-semeando antes de cada uma). Retorna tempos em s + o último retorno."""
+    tempos, ret = [], None
+    for _ in range(repeticoes):
+        semear()
+        t = time.perf_counter()
+        ret = fn()
+        tempos.append(time.perf_counter() - t)
+    tempos.sort()
+    return {"min_s": tempos[0], "mediana_s": tempos[len(tempos) // 2], "ret": ret}
+
+
+def state_base(n_clientes: int) -> dict:
+    """State limpo com base de n clientes (C0001..Cn) e frota padrão."""
+    state = main.default_state()
+    state["clientes"].estender_faixa(1, n_clientes)
+    state["cnt_cliente"] = n_clientes
+    state["clientes_seeded"] = True
+    main.gen_fleet(state)
+    return state
+
+
+def taxa(linhas: int, segundos: float) -> float:
+    return round(linhas / segundos, 1) if segundos > 0 else None
+
+
+# -------------------------
+# GERADORES
+# -------------------------
+def bench_geradores(cfg: dict) -> dict:
+    dia = datetime(2023, 3, 15, tzinfo=main.TZ_BR)
+    ticks = [dia + timedelta(hours=h) for h in range(cfg["ticks_producao"])]
+    out = {}
+
+    def medir(nome, fn, linhas_de):
+        r = cronometrar(fn, cfg["repeticoes"])
+        linhas = linhas_de(r["ret"])
+        out[nome] = {
+            "linhas": linhas,
+            "min_s": round(r["min_s"], 6),
+            "mediana_s": round(r["mediana_s"], 6),
+            "linhas_por_s": taxa(linhas, r["min_s"]),
+        }
+        return r["ret"]
+
+    state = state_base(cfg["clientes_base"])
+    fleet = state["fleet"]
+
+    producoes = medir(
+        "gen_producao_lote",
+        lambda: main.gen_producao_lote(ticks, dict(state), fleet),
+        lambda ret: sum(len(p) + len(l) + len(q) for p, l, q in ret),
+    )
+    prod, lotes, _ = producoes[0]
+
+    medir("gen_producao_grade",
+          lambda: main.gen_producao_grade(ticks, dict(state), fleet),
+          lambda ret: sum(len(b) for b in ret))
+
+    medir("gen_clientes",
+          lambda: [main.gen_clientes(dia, state_base(1), qtd_novos=10) for _ in range(cfg["chamadas"])],
+          lambda ret: sum(len(b) for b in ret))
+
+    # detector de anomalias: leituras (ordens) da grade inteira, tick a tick
+    grade = main.gen_producao_grade(ticks, dict(state), fleet)[0]
+    medir("detectar_anomalias",
+          lambda: main.detectar_anomalias(dict(state, detector=main.DetectorAnomalias(), cnt_alerta=0), grade),
+          lambda ret: len(grade))
+
+    compras = medir("gen_compras",
+                    lambda: [main.gen_compras(dia, dict(state), qtd=4) for _ in range(cfg["chamadas"])],
+                    lambda ret: sum(len(b) for b in ret))[0]
+
+    # estoque FIFO: compras do passo + consumo dos lotes (linhas = mapa lote -> compra)
+    medir("movimentar_estoque",
+          lambda: [main.movimentar_estoque(dict(state, estoque=main.EstoqueMateriais()),
+                                           {"raw_compras": compras, "raw_producao": prod})["raw_map_lote_compras"]
+                   for _ in range(cfg["chamadas"])],
+          lambda ret: sum(len(b) for b in ret))
+
+    vendas = medir("gen_vendas",
+                   lambda: [main.gen_vendas(dia, dict(state, ultimos_clientes=[]), lotes, prod)
+                            for _ in range(cfg["chamadas"])],
+                   lambda ret: sum(len(b) for b in ret))[0]
+
+    # garantia: todas acionadas pra medir o caminho de geração (não o sorteio de 1%)
+    medir("gen_garantia",
+          lambda: [main.gen_garantia(dia, dict(state), vendas, acionadas=[True] * len(vendas))
+                   for _ in range(cfg["chamadas"])],
+          lambda ret: sum(len(b) for b in ret))
+
+    medir("gen_manutencao",
+          lambda: [main.gen_manutencao(dia, dict(state), fleet, maquinas=[0]) for _ in range(cfg["chamadas"])],
+          lambda ret: sum(len(b) for b in ret))
+
+    # telemetria a 60s das ordens do bloco de ticks (consome o gerador de chunks)
+    medir("gen_telemetria",
+          lambda: [len(b) for b in main.gen_telemetria(prod, fleet, 60, SEED)],
+          lambda ret: sum(ret))
+
+    medir("gerar_dia_horario",
+          lambda: main.gerar_dia_horario(dia, dict(state, ultimos_clientes=[]), fleet),
+          lambda ret: sum(len(b) for b in ret.values()))
+
+    return out
+
+
+# -------------------------
+# AMOSTRAGEM DE CLIENTES
+# -------------------------
+def bench_amostragem(cfg: dict) -> dict:
+    """
+    Custo do escolher_cliente_por_idade por tamanho da base:
+    - fixa: base parada (pesos acumulados em cache)
+    - crescendo: 1 cliente novo entre sorteios (recalcula os pesos, como no
+      incremental quando entra cliente entre vendas)
+    """
+    out = {}
+    for n in cfg["bases_clientes"]:
+        state = state_base(n)
+        state["ultimos_clientes"] = []
+        main.pesos_acumulados_clientes.cache_clear()
+
+        def fixa():
+            for _ in range(cfg["sorteios"]):
+                c = main.escolher_cliente_por_idade(state)
+                state["ultimos_clientes"].append(c)
+                del state["ultimos_clientes"][:-main.ULTIMOS_CLIENTES_JANELA]
+
+        r_fixa = cronometrar(fixa, cfg["repeticoes"])
+
+        sorteios_cresc = max(1, cfg["sorteios"] // 50)
+
+        def crescendo():
+            for _ in range(sorteios_cresc):
+                state["cnt_cliente"] += 1
+                state["clientes"].append(main.cliente_id(state["cnt_cliente"]))
+                main.escolher_cliente_por_idade(state)
+
+        r_cresc = cronometrar(crescendo, cfg["repeticoes"])
+
+        out[str(n)] = {
+            "us_por_sorteio_fixa": round(r_fixa["min_s"] / cfg["sorteios"] * 1e6, 3),
+            "us_por_sorteio_crescendo": round(r_cresc["min_s"] / sorteios_cresc * 1e6, 3),
+        }
+    return out
+
+
+# -------------------------
+# SERIALIZAÇÃO
+# -------------------------
+def bench_serializacao(cfg: dict) -> dict:
+    """Throughput por tabela de 1 dia horário (grade 24 x frota) em cada formato."""
+    semear()
+    state = state_base(cfg["clientes_base"])
+    dia = datetime(2023, 3, 15, tzinfo=main.TZ_BR)
+    tabelas = {}
+    for d in range(cfg["dias_serializacao"]):
+        st = dict(state, ultimos_clientes=[])
+        for t, b in main.gerar_dia_horario(dia + timedelta(days=d), st, state["fleet"]).items():
+            tabelas.setdefault(t, []).append(b)
+        state.update({k: st[k] for k in main.CONTADORES})
+    tabelas = {t: main.RowBatch.concat(t, bs) for t, bs in tabelas.items()}
+
+    run_id, ingest_ts = "bench", datetime(2023, 1, 1, tzinfo=main.TZ_BR).isoformat()
+
+    def jsonl(batch, t):
+        buf = io.BytesIO()
+        main.serialize_jsonl(batch, run_id, ingest_ts, buf, t)
+        return len(buf.getvalue())
+
+    def jsonl_gz(batch, t):
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=main.GZIP_NIVEL, mtime=0) as gz:
+            main.serialize_jsonl(batch, run_id, ingest_ts, gz, t)
+        return len(buf.getvalue())
+
+    def parquet(batch, t):
+        return len(main.parquet_bytes(main.rows_to_arrow(t, batch, run_id, ingest_ts)))
+
+    formatos = {"jsonl": jsonl, "jsonl.gz": jsonl_gz}
+    try:
+        import pyarrow  # noqa: F401
+        formatos["parquet"] = parquet
+    except ImportError:
+        pass
+
+    out = {}
+    for t, batch in tabelas.items():
+        if not batch:
+            continue
+        out[t] = {"linhas": len(batch), "bytes_jsonl": jsonl(batch, t)}
+        for fmt, fn in formatos.items():
+            # batch novo a cada repetição: valores() formatados ficam em cache no RowBatch
+            r = cronometrar(lambda: fn(batch.fatia(0, len(batch)), t), cfg["repeticoes"])
+            out[t][fmt] = {
+                "bytes": r["ret"],
+                "min_s": round(r["min_s"], 6),
+                "linhas_por_s": taxa(len(batch), r["min_s"]),
+                # MB/s sobre o tamanho lógico (JSONL), comparável entre formatos
+                "mb_por_s": round(out[t]["bytes_jsonl"] / r["min_s"] / 1e6, 2) if r["min_s"] > 0 else None,
+            }
+    return out
+
+
+# -------------------------
+# PONTA A PONTA (subprocesso por cenário: pico de memória isolado)
+# -------------------------
+CENARIOS_E2E = {
+    "ano_dia_sequencial": {"granularidade": "dia"},
+    "ano_dia_paralelo": {"granularidade": "dia", "workers": "auto"},
+    "ano_hora_paralelo": {"granularidade": "hora", "workers": "auto"},
+    "ano_hora_telemetria": {"granularidade": "hora", "workers": "auto", "telemetria": "1"},
+}
+
+
+class _Req:
+    def __init__(self, **args):
+        self.args = args
+
+
+def rodar_e2e(cenario: str, ano: int, dias: int) -> dict:
+    """Executa 1 cenário no processo atual (chamado pelo subprocesso)."""
+    semear()
+    args = dict(CENARIOS_E2E[cenario])
+    if args.get("workers") == "auto":
+        args["workers"] = str(main.BACKFILL_MAX_WORKERS)
+    inicio = datetime(ano, 1, 1)
+    fim = inicio + timedelta(days=dias - 1)
+
+    main.executar_simulacao(_Req())  # seed de clientes + static + 1 hora (fora da medição)
+    sc = main.gcs()
+    antes = {o.name for o in sc.list_blobs(main.BUCKET_NAME, "bronze/")}
+    t = time.perf_counter()
+    corpo, status = main.executar_simulacao(_Req(mode="backfill", start=inicio.strftime("%Y-%m-%d"),
+                                                 end=fim.strftime("%Y-%m-%d"), **args))
+    seg = time.perf_counter() - t
+    if status != 200 or not corpo.startswith("OK"):
+        raise RuntimeError(corpo)
+
+    nbytes = sum(len(sc.objetos[(main.BUCKET_NAME, o.name)][0])
+                 for o in sc.list_blobs(main.BUCKET_NAME, "bronze/") if o.name not in antes)
+    m = re.search(r"\| (\{[^}]*\})", corpo)
+    linhas = sum(ast.literal_eval(m.group(1)).values()) if m else None
+
+    # ru_maxrss: KB no Linux, bytes no macOS
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    pico_mb = pico / 1024 / 1024 if sys.platform == "darwin" else pico / 1024
+    return {
+        "dias": dias,
+        "args": args,
+        "segundos": round(seg, 3),
+        "linhas": linhas,
+        "linhas_por_s": taxa(linhas, seg),
+        "bytes_lake": nbytes,
+        "pico_rss_mb": round(pico_mb, 1),
+    }
+
+
+def bench_e2e(cfg: dict) -> dict:
+    out = {}
+    for cenario in CENARIOS_E2E:
+        if CENARIOS_E2E[cenario]["granularidade"] == "hora" and cfg["dias_e2e"] < 365:
+            dias = max(1, cfg["dias_e2e"] // 4)
+        else:
+            dias = cfg["dias_e2e"]
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--interno-e2e", cenario, "--dias", str(dias)],
+            capture_output=True, text=True,
+        )
+        if proc.returncode != 0:
+            out[cenario] = {"erro": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "falhou"}
+            continue
+        out[cenario] = json.loads(proc.stdout.strip().splitlines()[-1])
+    return out
+
+
+# -------------------------
+# MAIN
+# -------------------------
+def metadados() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "quando": datetime.now(main.TZ_BR).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "plataforma": platform.platform(),
+        "cpus": os.cpu_count(),
+        "seed": SEED,
+    }
+
+
+def configuracao(rapido: bool, repeticoes: int) -> dict:
+    if rapido:
+        return {
+            "repeticoes": repeticoes or 2,
+            "ticks_producao": 24,
+            "chamadas": 50,
+            "clientes_base": 1_000,
+            "bases_clientes": [1_000, 10_000, 100_000],
+            "sorteios": 2_000,
+            "dias_serializacao": 1,
+            "dias_e2e": 31,
+        }
+    return {
+        "repeticoes": repeticoes or 5,
+        "ticks_producao": 24 * 31,
+        "chamadas": 500,
+        "clientes_base": 10_000,
+        "bases_clientes": [1_000, 10_000, 100_000, 1_000_000],
+        "sorteios": 20_000,
+        "dias_serializacao": 7,
+        "dias_e2e": 365,
+    }
+
+
+def main_cli(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Benchmarks offline do simulador Autovolt")
+    ap.add_argument("--saida", default="bench_results.json", help="arquivo JSON de resultados")
+    ap.add_argument("--so", default=",".join(SUITES), help=f"suítes separadas por vírgula ({', '.join(SUITES)})")
+    ap.add_argument("--rapido", action="store_true", help="tamanhos reduzidos")
+    ap.add_argument("--repeticoes", type=int, default=0, help="repetições por medição (melhor tempo vale)")
+    ap.add_argument("--interno-e2e", help=argparse.SUPPRESS)
+    ap.add_argument("--dias", type=int, default=365, help=argparse.SUPPRESS)
+    args = ap.parse_args(argv)
+
+    if args.interno_e2e:
+        print(json.dumps(rodar_e2e(args.interno_e2e, 2023, args.dias)))
+        return 0
+
+    suites = [s.strip() for s in args.so.split(",") if s.strip()]
+    invalidas = set(suites) - set(SUITES)
+    if invalidas:
+        ap.error(f"suíte(s) desconhecida(s): {', '.join(sorted(invalidas))}")
+
+    cfg = configuracao(args.rapido, args.repeticoes)
+    funcoes = {
+        "geradores": bench_geradores,
+        "amostragem": bench_amostragem,
+        "serializacao": bench_serializacao,
+        "e2e": bench_e2e,
+    }
+
+    resultado = {"meta": metadados(), "config": cfg}
+    for s in suites:
+        t = time.perf_counter()
+        print(f"[bench] {s}...", file=sys.stderr, flush=True)
+        resultado[s] = funcoes[s](cfg)
+        print(f"[bench] {s} ok em {time.perf_counter() - t:.1f}s", file=sys.stderr, flush=True)
+
+    with open(args.saida, "w", encoding="utf-8") as f:
+        json.dump(resultado, f, ensure_ascii=False, indent=2)
+    print(f"[bench] resultados em {args.saida}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
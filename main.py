@@ -13,32 +13,44 @@
 # - Escolha balanceada de cliente em vendas (peso por idade + anti-monopólio por janela)
 # =========================
 
+from __future__ import annotations
+
+import time
+_T_IMPORT_INICIO = time.perf_counter()
+
 import functions_framework
 import warnings
 warnings.simplefilter("ignore", category=FutureWarning)
 
 import io
+import gzip
+import hashlib
+import os
 import json
 import uuid
+import heapq
 import random
 import logging
-from datetime import datetime, timedelta, timezone, date
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right
+from collections import Counter, deque, namedtuple
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import TYPE_CHECKING
 import numpy as np
-from google.cloud import bigquery
-from google.cloud import storage
-from google.cloud.bigquery import SchemaField
 from google.api_core.exceptions import NotFound
 
-class CompactJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, (datetime, date)):
-            return obj.isoformat() # Converte data para "2026-02-27"
-        if isinstance(obj, np.integer):
-            return int(obj) # Converte int64 para int comum
-        if isinstance(obj, np.floating):
-            return float(obj) # Converte float64 para float comum
-        return super().default(obj)
-        
+# google.cloud.bigquery / storage são importados sob demanda (bq()/gcs()):
+# backfill não carrega no BQ, então nem importa nem autentica o cliente BQ.
+if TYPE_CHECKING:
+    from google.cloud import bigquery, storage
+
+_T_IMPORT_MS = (time.perf_counter() - _T_IMPORT_INICIO) * 1000
+_COLD_START = {"pendente": True}
+
 # -------------------------
 # CONFIG
 # -------------------------
@@ -46,10 +58,21 @@ PROJECT_ID = "autovolt-analytics-479417"
 DATASET_ID = "autovolt_bronze"
 BUCKET_NAME = "bucket_ingestao"
 
+# Onde o lake e o state ficam: "gcs" (bucket + BQ hot layer), "local" (diretório,
+# mesma árvore bronze/<tabela>/dt=...) ou "memoria" (processo; benchmarks/testes).
+# Fora do GCS não há BigQuery: hot layer desligado.
+SINK = os.environ.get("SINK", "gcs").lower()
+SINK_DIR = os.environ.get("SINK_DIR", "./lake")  # raiz do modo local (<SINK_DIR>/<bucket>/...)
+
 TZ_BR = timezone(timedelta(hours=-3))  # America/Recife
-HORAS_POR_LOTE = 1
+HORAS_POR_LOTE = 1              # horas geradas no 1º incremental (sem watermark)
+INCREMENTAL_MAX_HORAS = int(os.environ.get("INCREMENTAL_MAX_HORAS", "72"))  # teto de catch-up por chamada
 
-STATE_FILE = "state/state.json"
+STATE_FILE = "state/state.json"            # snapshot
+STATE_JOURNAL_PREFIX = "state/journal/"    # deltas append-only (<seq>.json)
+STATE_COMPACTAR_A_CADA = 10                # deltas até reescrever o snapshot (teto de GETs no load)
+STATE_COMPACTAR_BYTES = 128 * 1024         # ... ou bytes de journal desde o snapshot
+BACKFILL_CHECKPOINT_PREFIX = "state/backfill/"  # checkpoint por job de backfill (<job>.json)
 
 # -------------------------
 # CLIENT SEEDING / BALANCE
@@ -59,175 +82,295 @@ ULTIMOS_CLIENTES_JANELA = 200    # janela anti-monopólio
 PESO_INTENSIDADE = 2.2          # >2 favorece antigos; menor = mais uniforme
 PESO_PISO = 0.25                # chance mínima pros mais novos
 
+# -------------------------
+# FROTA / PRODUÇÃO VETORIZADA
+# -------------------------
+FROTA_QTD = 20                  # máquinas criadas no 1º run (fleet fica no state)
+BLOCO_TICKS_PRODUCAO = 31       # backfill: dias gerados por chamada de gen_producao_lote
+
+CLIENTES_MAX_POR_PASSO = 10     # teto de clientes novos por passo (gen_clientes)
+TAXA_GARANTIA = 0.01            # prob. de uma venda acionar garantia
+PROB_MANUTENCAO_MAQUINA = 0.0015  # prob. de manutenção por máquina por tick (máquina sem desgaste)
+PESO_DESGASTE_MANUTENCAO = 6.0  # prob. escala com fator_desgaste ** peso (máquina velha para mais)
+MANUTENCAO_HORAS = 2            # janela de parada: máquina não produz nesse intervalo
+
+# estoque de matéria-prima (camadas FIFO por material; ver EstoqueMateriais)
+CONSUMO_MP_POR_UNIDADE = {      # por bateria de 60 Ah (escala com capacidade_ah / 60)
+    "MP001": 0.10,  # Chumbo
+    "MP002": 0.06,  # Ácido Sulfúrico
+    "MP003": 0.08,  # Polipropileno
+    "MP004": 0.05,  # Separadores
+    "MP005": 0.05,  # Eletrólito
+}
+ESTOQUE_ALVO_MP = 6000          # reposição: cada compra leva o material de menor saldo até aqui
+COMPRA_MIN_MP = 500             # limites da quantidade_comprada
+COMPRA_MAX_MP = 2000
+
+# detector de anomalias (EWMA por máquina; ver DetectorAnomalias)
+DETECTOR_METRICAS = {"temperatura": "temperatura_media_c", "vibracao": "vibracao_media_rpm"}
+DETECTOR_ALFA = 0.02            # peso da leitura nova na média/variância (~50 leituras de memória)
+DETECTOR_AQUECIMENTO = 24       # leituras por máquina antes de começar a alertar
+DETECTOR_Z_WARN = 3.0           # |z| a partir do qual alerta WARN...
+DETECTOR_Z_CRITICO = 4.5        # ...e CRITICO
+DETECTOR_LIMITES = {"temperatura": 100.0, "vibracao": 2000.0}  # acima disso é CRITICO sempre
+
+# -------------------------
+# BACKFILL PARALELO (RNG por dia)
+# -------------------------
+BACKFILL_MAX_WORKERS = os.cpu_count() or 1
+BLOCO_DIAS_PARALELO = 31        # dias por shard enviado a cada worker
+BACKFILL_CHECKPOINT_DIAS = 31   # dias simulados entre checkpoints (override: ?checkpoint=N)
+BACKFILL_MAX_SEGUNDOS = int(os.environ.get("BACKFILL_MAX_SEGUNDOS", "3000"))  # orçamento por request; depois, ?resume=<job>
+# ?async=1: URL do próprio serviço p/ encadear requests de resume (Cloud Run);
+# sem ela, o job roda numa thread do processo (functions-framework local / CPU sempre alocada)
+BACKFILL_SELF_URL = os.environ.get("BACKFILL_SELF_URL", "")
+BACKFILL_DISPARO_TIMEOUT = 5    # s: só entrega a request de resume, não espera terminar
+BACKFILL_MAX_CONFLITOS = 5      # StateConflict no commit de segmento: recarrega o state e refaz até N vezes
+
+# -------------------------
+# PERSISTÊNCIA (incremental)
+# -------------------------
+PERSIST_MAX_THREADS = 8         # uploads/loads simultâneos em persist_tables
+
+# Hot layer: URIs ficam pendentes no state e viram 1 load job multi-URI por
+# tabela quando passam de N arquivos ou da idade máxima (economiza quota de loads/dia)
+BQ_COALESCE_MAX_URIS = 6
+BQ_COALESCE_MAX_IDADE_MIN = 180
+BQ_FLUSH_IMEDIATO = {"monitoramento_alertas"}  # tabelas sensíveis a frescor: load a cada run
+
+# -------------------------
+# BACKFILL WRITER (buffer por partição)
+# -------------------------
+PARTICOES_BACKFILL = ("dia", "mes")
+BACKFILL_PARTICAO = "mes"       # histórico: 1 partição dt= por mês (override: ?particao=dia)
+GRANULARIDADES_BACKFILL = {"dia": "dia", "day": "dia", "hora": "hora", "hour": "hora"}
+BACKFILL_GRANULARIDADE = "dia"  # 1 tick/dia; ?granularidade=hora -> 24 ticks/dia (igual ao incremental)
+FLUSH_MAX_LINHAS = 250_000      # flush de uma partição ao passar desse nº de linhas...
+FLUSH_MAX_BYTES = 64 * 1024 * 1024  # ...ou desse tamanho (JSONL não comprimido)
+
+# -------------------------
+# SERIALIZAÇÃO JSONL
+# -------------------------
+GCS_GZIP = True                 # part-files .jsonl.gz (BQ carrega NDJSON gzip direto)
+GZIP_NIVEL = 6
+SERIALIZE_LOTE_LINHAS = 2000    # linhas codificadas por write no stream
+STREAM_MIN_LINHAS = 20_000      # a partir disso write_gcs_jsonl usa upload resumable em chunks
+GCS_CHUNK_BYTES = 8 * 1024 * 1024  # múltiplo de 256 KiB (exigência do upload resumable)
+
+# -------------------------
+# FORMATO DO BRONZE
+# -------------------------
+FORMATOS_BRONZE = ("jsonl", "parquet")
+FORMATO_BRONZE = os.environ.get("FORMATO_BRONZE", "jsonl")  # override: ?formato=parquet
+PARQUET_COMPRESSAO = "zstd"
+STREAM_PARQUET_MAX_LINHAS = 20_000_000  # part-file em streaming (ParquetStream) fecha ao passar disso
+
+# -------------------------
+# TELEMETRIA (raw_telemetria, opcional)
+# -------------------------
+# Leituras de sensor por máquina durante cada ordem de produção. Volume alto
+# (60s -> ~14M linhas/mês com a frota padrão): só vai pro lake, sempre parquet.
+TELEMETRIA = os.environ.get("TELEMETRIA", "0") == "1"  # override: ?telemetria=1|0
+TELEMETRIA_RESOLUCAO_S = 60     # s entre leituras (override: ?telemetria_resolucao=N, 1..3600)
+TELEMETRIA_CHUNK_LINHAS = 500_000  # linhas por RowBatch gerado (= 1 row group no parquet)
+TELEMETRIA_TAU_S = 300.0        # tempo de correlação do ruído AR(1)
+TELEMETRIA_RHO = 0.6            # correlação temperatura x vibração no ruído
+TELEMETRIA_RUIDO = {"temperatura_c": 0.8, "vibracao_rpm": 45.0, "pressao_bar": 0.05}  # desvio (fator 1.0)
+TELEMETRIA_AQUECIMENTO_C = 4.0  # subida de temperatura do início ao fim do lote (fator 1.0)
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
 
 # -------------------------
 # SCHEMAS (Bronze)
 # -------------------------
+# Definição leve (sem importar o BigQuery); bq_schema() converte pra SchemaField.
+Campo = namedtuple("Campo", ["name", "field_type", "mode"], defaults=["NULLABLE"])
+
 SCHEMAS = {
     "raw_linha": [
-        SchemaField("linha_id", "STRING"),
-        SchemaField("descricao", "STRING"),
-        SchemaField("turnos_operacionais", "STRING"),
+        Campo("linha_id", "STRING"),
+        Campo("descricao", "STRING"),
+        Campo("turnos_operacionais", "STRING"),
     ],
     "raw_metas_vendas": [
-        SchemaField("meta_id", "STRING"),
-        SchemaField("ano_mes_id", "STRING"),
-        SchemaField("meta_quantidade", "STRING"),
-        SchemaField("meta_valor", "STRING"),
+        Campo("meta_id", "STRING"),
+        Campo("ano_mes_id", "STRING"),
+        Campo("meta_quantidade", "STRING"),
+        Campo("meta_valor", "STRING"),
     ],
     "raw_tempo": [
-        SchemaField("ano_mes_id", "STRING"),
-        SchemaField("ano", "STRING"),
-        SchemaField("mes", "STRING"),
-        SchemaField("nome_mes", "STRING"),
-        SchemaField("trimestre", "STRING"),
-        SchemaField("ano_mes_label", "STRING"),
+        Campo("ano_mes_id", "STRING"),
+        Campo("ano", "STRING"),
+        Campo("mes", "STRING"),
+        Campo("nome_mes", "STRING"),
+        Campo("trimestre", "STRING"),
+        Campo("ano_mes_label", "STRING"),
     ],
     "raw_tipo_manut": [
-        SchemaField("tipo_manutencao_id", "STRING"),
-        SchemaField("descricao", "STRING"),
-        SchemaField("criticidade_padrao", "STRING"),
+        Campo("tipo_manutencao_id", "STRING"),
+        Campo("descricao", "STRING"),
+        Campo("criticidade_padrao", "STRING"),
     ],
     "raw_turno": [
-        SchemaField("turno_id", "STRING"),
-        SchemaField("janela", "STRING"),
-        SchemaField("coef_performance", "STRING"),
+        Campo("turno_id", "STRING"),
+        Campo("janela", "STRING"),
+        Campo("coef_performance", "STRING"),
     ],
     "raw_produto": [
-        SchemaField("produto_id", "STRING"),
-        SchemaField("modelo", "STRING"),
-        SchemaField("tensao_v", "STRING"),
-        SchemaField("capacidade_ah", "STRING"),
-        SchemaField("linha_segmento", "STRING"),
-        SchemaField("data_lancamento", "STRING"),
-        SchemaField("data_descontinuacao", "STRING"),
+        Campo("produto_id", "STRING"),
+        Campo("modelo", "STRING"),
+        Campo("tensao_v", "STRING"),
+        Campo("capacidade_ah", "STRING"),
+        Campo("linha_segmento", "STRING"),
+        Campo("data_lancamento", "STRING"),
+        Campo("data_descontinuacao", "STRING"),
     ],
     "raw_maquina": [
-        SchemaField("maquina_id", "STRING"),
-        SchemaField("tipo", "STRING"),
-        SchemaField("fabricante", "STRING"),
-        SchemaField("ano", "STRING"),
-        SchemaField("linha_id", "STRING"),
+        Campo("maquina_id", "STRING"),
+        Campo("tipo", "STRING"),
+        Campo("fabricante", "STRING"),
+        Campo("ano", "STRING"),
+        Campo("linha_id", "STRING"),
     ],
     "raw_fornecedor": [
-        SchemaField("fornecedor_id", "STRING"),
-        SchemaField("categoria", "STRING"),
-        SchemaField("leadtime_dias", "STRING"),
-        SchemaField("qualificacao", "STRING"),
-        SchemaField("data_cadastro", "STRING"),
-        SchemaField("data_ultima_avaliacao", "STRING"),
-        SchemaField("descricao", "STRING"),
+        Campo("fornecedor_id", "STRING"),
+        Campo("categoria", "STRING"),
+        Campo("leadtime_dias", "STRING"),
+        Campo("qualificacao", "STRING"),
+        Campo("data_cadastro", "STRING"),
+        Campo("data_ultima_avaliacao", "STRING"),
+        Campo("descricao", "STRING"),
     ],
     "raw_defeito": [
-        SchemaField("defeito_id", "STRING"),
-        SchemaField("descricao", "STRING"),
-        SchemaField("gravidade", "STRING"),
+        Campo("defeito_id", "STRING"),
+        Campo("descricao", "STRING"),
+        Campo("gravidade", "STRING"),
     ],
     "raw_materia_prima": [
-        SchemaField("materia_prima_id", "STRING"),
-        SchemaField("nome_material", "STRING"),
+        Campo("materia_prima_id", "STRING"),
+        Campo("nome_material", "STRING"),
     ],
     "raw_cliente": [
-        SchemaField("cliente_id", "STRING"),
-        SchemaField("tipo_cliente", "STRING"),
-        SchemaField("cidade", "STRING"),
-        SchemaField("tipo_plano", "STRING"),
-        SchemaField("data_cadastro", "STRING"),
+        Campo("cliente_id", "STRING"),
+        Campo("tipo_cliente", "STRING"),
+        Campo("cidade", "STRING"),
+        Campo("tipo_plano", "STRING"),
+        Campo("data_cadastro", "STRING"),
     ],
     "raw_lote": [
-        SchemaField("lote_id", "STRING"),
-        SchemaField("produto_id", "STRING"),
-        SchemaField("linha_id", "STRING"),
-        SchemaField("maquina_id", "STRING"),
-        SchemaField("inicio_producao", "STRING"),
-        SchemaField("fim_producao", "STRING"),
-        SchemaField("duracao_horas", "STRING"),
+        Campo("lote_id", "STRING"),
+        Campo("produto_id", "STRING"),
+        Campo("linha_id", "STRING"),
+        Campo("maquina_id", "STRING"),
+        Campo("inicio_producao", "STRING"),
+        Campo("fim_producao", "STRING"),
+        Campo("duracao_horas", "STRING"),
     ],
     "raw_producao": [
-        SchemaField("ordem_producao_id", "STRING"),
-        SchemaField("lote_id", "STRING"),
-        SchemaField("produto_id", "STRING"),
-        SchemaField("linha_id", "STRING"),
-        SchemaField("maquina_id", "STRING"),
-        SchemaField("turno_id", "STRING"),
-        SchemaField("inicio", "STRING"),
-        SchemaField("ciclo_minuto_nominal", "STRING"),
-        SchemaField("duracao_horas", "STRING"),
-        SchemaField("temperatura_media_c", "STRING"),
-        SchemaField("vibracao_media_rpm", "STRING"),
-        SchemaField("pressao_media_bar", "STRING"),
-        SchemaField("quantidade_planejada", "STRING"),
-        SchemaField("quantidade_produzida", "STRING"),
-        SchemaField("quantidade_refugada", "STRING"),
+        Campo("ordem_producao_id", "STRING"),
+        Campo("lote_id", "STRING"),
+        Campo("produto_id", "STRING"),
+        Campo("linha_id", "STRING"),
+        Campo("maquina_id", "STRING"),
+        Campo("turno_id", "STRING"),
+        Campo("inicio", "STRING"),
+        Campo("ciclo_minuto_nominal", "STRING"),
+        Campo("duracao_horas", "STRING"),
+        Campo("temperatura_media_c", "STRING"),
+        Campo("vibracao_media_rpm", "STRING"),
+        Campo("pressao_media_bar", "STRING"),
+        Campo("quantidade_planejada", "STRING"),
+        Campo("quantidade_produzida", "STRING"),
+        Campo("quantidade_refugada", "STRING"),
     ],
     "raw_qualidade": [
-        SchemaField("teste_id", "STRING"),
-        SchemaField("lote_id", "STRING"),
-        SchemaField("produto_id", "STRING"),
-        SchemaField("data_teste", "STRING"),
-        SchemaField("tensao_medida_v", "STRING"),
-        SchemaField("resistencia_interna_mohm", "STRING"),
-        SchemaField("capacidade_ah_teste", "STRING"),
-        SchemaField("defeito_id", "STRING"),
-        SchemaField("aprovado", "STRING"),
+        Campo("teste_id", "STRING"),
+        Campo("lote_id", "STRING"),
+        Campo("produto_id", "STRING"),
+        Campo("data_teste", "STRING"),
+        Campo("tensao_medida_v", "STRING"),
+        Campo("resistencia_interna_mohm", "STRING"),
+        Campo("capacidade_ah_teste", "STRING"),
+        Campo("defeito_id", "STRING"),
+        Campo("aprovado", "STRING"),
     ],
     "raw_compras": [
-        SchemaField("compra_id", "STRING"),
-        SchemaField("fornecedor_id", "STRING"),
-        SchemaField("materia_prima_id", "STRING"),
-        SchemaField("data_compra", "STRING"),
-        SchemaField("quantidade_comprada", "STRING"),
-        SchemaField("custo_unitario", "STRING"),
-        SchemaField("custo_total", "STRING"),
+        Campo("compra_id", "STRING"),
+        Campo("fornecedor_id", "STRING"),
+        Campo("materia_prima_id", "STRING"),
+        Campo("data_compra", "STRING"),
+        Campo("quantidade_comprada", "STRING"),
+        Campo("custo_unitario", "STRING"),
+        Campo("custo_total", "STRING"),
     ],
     "raw_map_lote_compras": [
-        SchemaField("lote_id", "STRING"),
-        SchemaField("compra_id", "STRING"),
+        Campo("lote_id", "STRING"),
+        Campo("compra_id", "STRING"),
+        Campo("materia_prima_id", "STRING"),
+        Campo("quantidade_consumida", "STRING"),
     ],
     "raw_vendas": [
-        SchemaField("venda_id", "STRING"),
-        SchemaField("ano_mes_id", "STRING"),
-        SchemaField("cliente_id", "STRING"),
-        SchemaField("produto_id", "STRING"),
-        SchemaField("ordem_producao_id", "STRING"),
-        SchemaField("lote_id", "STRING"),
-        SchemaField("data_venda", "STRING"),
-        SchemaField("quantidade_vendida", "STRING"),
-        SchemaField("valor_total_venda", "STRING"),
+        Campo("venda_id", "STRING"),
+        Campo("ano_mes_id", "STRING"),
+        Campo("cliente_id", "STRING"),
+        Campo("produto_id", "STRING"),
+        Campo("ordem_producao_id", "STRING"),
+        Campo("lote_id", "STRING"),
+        Campo("data_venda", "STRING"),
+        Campo("quantidade_vendida", "STRING"),
+        Campo("valor_total_venda", "STRING"),
     ],
     "raw_garantia": [
-        SchemaField("garantia_id", "STRING"),
-        SchemaField("cliente_id", "STRING"),
-        SchemaField("produto_id", "STRING"),
-        SchemaField("lote_id", "STRING"),
-        SchemaField("data_reclamacao", "STRING"),
-        SchemaField("dias_pos_venda", "STRING"),
-        SchemaField("defeito_id", "STRING"),
-        SchemaField("status", "STRING"),
-        SchemaField("tempo_resposta_dias", "STRING"),
-        SchemaField("custo_garantia", "STRING"),
+        Campo("garantia_id", "STRING"),
+        Campo("cliente_id", "STRING"),
+        Campo("produto_id", "STRING"),
+        Campo("lote_id", "STRING"),
+        Campo("data_reclamacao", "STRING"),
+        Campo("dias_pos_venda", "STRING"),
+        Campo("defeito_id", "STRING"),
+        Campo("status", "STRING"),
+        Campo("tempo_resposta_dias", "STRING"),
+        Campo("custo_garantia", "STRING"),
     ],
     "raw_manutencao": [
-        SchemaField("evento_manutencao_id", "STRING"),
-        SchemaField("maquina_id", "STRING"),
-        SchemaField("linha_id", "STRING"),
-        SchemaField("tipo_manutencao_id", "STRING"),
-        SchemaField("inicio", "STRING"),
-        SchemaField("fim", "STRING"),
-        SchemaField("duracao_min", "STRING"),
-        SchemaField("criticidade", "STRING"),
+        Campo("evento_manutencao_id", "STRING"),
+        Campo("maquina_id", "STRING"),
+        Campo("linha_id", "STRING"),
+        Campo("tipo_manutencao_id", "STRING"),
+        Campo("inicio", "STRING"),
+        Campo("fim", "STRING"),
+        Campo("duracao_min", "STRING"),
+        Campo("criticidade", "STRING"),
     ],
     "monitoramento_alertas": [
-        SchemaField("alerta_id", "STRING"),
-        SchemaField("data_ocorrencia", "TIMESTAMP"),
-        SchemaField("nivel", "STRING"),
-        SchemaField("maquina_id", "STRING"),
-        SchemaField("mensagem", "STRING"),
-        SchemaField("valor_medido", "FLOAT64"),
+        Campo("alerta_id", "STRING"),
+        Campo("data_ocorrencia", "TIMESTAMP"),
+        Campo("nivel", "STRING"),
+        Campo("maquina_id", "STRING"),
+        Campo("mensagem", "STRING"),
+        Campo("valor_medido", "FLOAT64"),
+        Campo("metrica", "STRING"),
+        Campo("z_score", "FLOAT64"),
+    ],
+    "raw_telemetria": [
+        Campo("maquina_id", "STRING"),
+        Campo("data_leitura", "TIMESTAMP"),
+        Campo("temperatura_c", "FLOAT64"),
+        Campo("vibracao_rpm", "FLOAT64"),
+        Campo("pressao_bar", "FLOAT64"),
     ],
 }
 
+# tabelas que só existem no lake (sem tabela/load no BQ)
+TABELAS_SO_LAKE = {"raw_telemetria"}
+
+# linhagem que os writers põem em toda linha (JSONL e parquet); vai pro BQ também
+CAMPOS_META = [Campo("_run_id", "STRING"), Campo("_ingested_at", "STRING")]
+
+def campos_bq(table: str) -> list:
+    """Colunas da tabela no BQ: SCHEMAS + CAMPOS_META."""
+    return SCHEMAS[table] + CAMPOS_META
+
 # -------------------------
 # STATIC DIMENSIONS
 # -------------------------
@@ -296,35 +439,669 @@ MESES_ABR = {1: "jan", 2: "fev", 3: "mar", 4: "abr", 5: "mai", 6: "jun", 7: "jul
 
 ESTADOS_BR = ["SP", "RJ", "MG", "RS", "PE", "BA", "PR", "SC"]
 
+# -------------------------
+# RNG (por thread)
+# -------------------------
+# Os geradores sequenciais usam a API de random/np.random, mas nunca o estado
+# global do processo: cada thread tem o seu random.Random + RandomState (mesmas
+# sequências do global pra mesma seed). Assim o backfill assíncrono em thread
+# e as requests concorrentes da instância não se atravessam.
+class _RngThread(threading.local):
+    def __init__(self):
+        self.py = random.Random()
+        self.np = np.random.RandomState()
+
+_RNG = _RngThread()
+
+def rnd() -> random.Random:
+    return _RNG.py
+
+def nprnd() -> np.random.RandomState:
+    return _RNG.np
+
+def semear_rng(seed: int, seed_np: int = None) -> None:
+    """Semeia o RNG da thread atual; o do numpy só com seed_np (< 2**32)."""
+    _RNG.py.seed(seed)
+    if seed_np is not None:
+        _RNG.np.seed(seed_np)
+
 # -------------------------
 # CLIENTS
 # -------------------------
+# Clientes por processo: criados na 1ª chamada e reaproveitados entre
+# invocações na mesma instância (mantém o pool HTTP/keep-alive aquecido).
+_CLIENTES = {"bq": None, "gcs": None}
+_BQ_SCHEMAS = {}
+
 def bq():
-    return bigquery.Client(project=PROJECT_ID)
+    if _CLIENTES["bq"] is None:
+        t0 = time.perf_counter()
+        from google.cloud import bigquery
+        _CLIENTES["bq"] = bigquery.Client(project=PROJECT_ID)
+        logging.info("cliente bq criado em %.1f ms", (time.perf_counter() - t0) * 1000)
+    return _CLIENTES["bq"]
 
 def gcs():
-    return storage.Client(project=PROJECT_ID)
+    """Object store do lake/state conforme SINK (storage.Client, diretório local ou memória)."""
+    if _CLIENTES["gcs"] is None:
+        t0 = time.perf_counter()
+        if SINK == "local":
+            _CLIENTES["gcs"] = ArmazenamentoLocal(SINK_DIR)
+        elif SINK == "memoria":
+            _CLIENTES["gcs"] = ArmazenamentoMemoria()
+        elif SINK == "gcs":
+            from google.cloud import storage
+            _CLIENTES["gcs"] = storage.Client(project=PROJECT_ID)
+        else:
+            raise ValueError(f"SINK inválido: {SINK} (use gcs | local | memoria)")
+        logging.info("cliente %s criado em %.1f ms", SINK, (time.perf_counter() - t0) * 1000)
+    return _CLIENTES["gcs"]
+
+def usa_bq() -> bool:
+    return SINK == "gcs"
+
+def bq_schema(table: str) -> list:
+    if table not in _BQ_SCHEMAS:
+        from google.cloud.bigquery import SchemaField
+        _BQ_SCHEMAS[table] = [SchemaField(f.name, f.field_type, mode=f.mode) for f in campos_bq(table)]
+    return _BQ_SCHEMAS[table]
+
+# -------------------------
+# ARMAZENAMENTO OFFLINE (local | memória)
+# -------------------------
+# Implementam só o pedaço da API do storage.Client que o código usa
+# (bucket().blob(): upload_from_string / download_as_bytes / open("wb") /
+# delete / generation, e list_blobs), com as mesmas exceções (NotFound,
+# PreconditionFailed). Assim writers, StateStore e checkpoints rodam sem GCS.
+class Armazenamento(ABC):
+    esquema = ""
+
+    def bucket(self, nome: str) -> "_Balde":
+        return _Balde(self, nome)
+
+    def list_blobs(self, bucket: str, prefix: str = "") -> list:
+        return [_Objeto(self, bucket, n) for n in self._listar(bucket, prefix)]
+
+    def uri(self, bucket: str, nome: str) -> str:
+        return f"{self.esquema}://{bucket}/{nome}"
+
+    def nome(self, uri: str) -> tuple[str, str]:
+        """uri -> (bucket, nome)"""
+        bucket, nome = uri[len(self.esquema) + 3:].split("/", 1)
+        return bucket, nome
+
+    # primitivas de cada backend (faltou uma -> erro já ao instanciar)
+    @abstractmethod
+    def _ler(self, bucket: str, nome: str) -> tuple[bytes, int]:
+        """(conteúdo, geração); NotFound se não existe."""
+
+    @abstractmethod
+    def _gravar(self, bucket: str, nome: str, data: bytes, if_generation_match: int = None) -> int:
+        """Grava e devolve a geração nova; PreconditionFailed se if_generation_match não bate."""
+
+    @abstractmethod
+    def _apagar(self, bucket: str, nome: str) -> None:
+        """NotFound se não existe."""
+
+    @abstractmethod
+    def _listar(self, bucket: str, prefix: str) -> list[str]:
+        """Nomes com o prefixo, ordenados."""
+
+    @staticmethod
+    def _checar_precondicao(atual: int, if_generation_match: int | None, nome: str) -> None:
+        if if_generation_match is not None and atual != if_generation_match:
+            from google.api_core.exceptions import PreconditionFailed
+            raise PreconditionFailed(f"{nome}: geração {atual} != {if_generation_match}")
+
+class _Balde:
+    def __init__(self, arm: Armazenamento, nome: str):
+        self.arm = arm
+        self.name = nome
+
+    def blob(self, nome: str) -> "_Objeto":
+        return _Objeto(self.arm, self.name, nome)
+
+class _Objeto:
+    def __init__(self, arm: Armazenamento, bucket: str, nome: str):
+        self.arm = arm
+        self.bucket = bucket
+        self.name = nome
+        self.generation = None
+        self.size = None
+
+    def upload_from_string(self, data, content_type: str = None, if_generation_match: int = None) -> None:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.generation = self.arm._gravar(self.bucket, self.name, data, if_generation_match)
+        self.size = len(data)
+
+    def download_as_bytes(self) -> bytes:
+        data, self.generation = self.arm._ler(self.bucket, self.name)
+        self.size = len(data)
+        return data
+
+    def delete(self) -> None:
+        self.arm._apagar(self.bucket, self.name)
+
+    def open(self, mode: str = "wb", content_type: str = None, **kwargs):
+        if mode != "wb":
+            raise ValueError("só mode='wb' é suportado")
+        return _EscritaObjeto(self)
+
+class _EscritaObjeto(io.BytesIO):
+    """Buffer do blob.open("wb"): grava o objeto inteiro no close()."""
+
+    def __init__(self, obj: _Objeto):
+        super().__init__()
+        self.obj = obj
+
+    def close(self) -> None:
+        if not self.closed:
+            self.obj.upload_from_string(self.getvalue())
+        super().close()
+
+class ArmazenamentoMemoria(Armazenamento):
+    """Lake + state no próprio processo (dict). Some quando o processo morre."""
+    esquema = "mem"
+
+    def __init__(self):
+        self.objetos = {}  # (bucket, nome) -> (bytes, geração)
+        self._geracao = 0
+        self._lock = threading.Lock()
+
+    def _ler(self, bucket, nome):
+        try:
+            return self.objetos[(bucket, nome)]
+        except KeyError:
+            raise NotFound(f"{bucket}/{nome}")
+
+    def _gravar(self, bucket, nome, data, if_generation_match=None):
+        with self._lock:
+            atual = self.objetos.get((bucket, nome), (b"", 0))[1]
+            self._checar_precondicao(atual, if_generation_match, nome)
+            self._geracao += 1
+            self.objetos[(bucket, nome)] = (bytes(data), self._geracao)
+            return self._geracao
+
+    def _apagar(self, bucket, nome):
+        with self._lock:
+            if self.objetos.pop((bucket, nome), None) is None:
+                raise NotFound(f"{bucket}/{nome}")
+
+    def _listar(self, bucket, prefix):
+        with self._lock:
+            return sorted(n for b, n in self.objetos if b == bucket and n.startswith(prefix))
+
+class ArmazenamentoLocal(Armazenamento):
+    """
+    Lake + state num diretório: <raiz>/<bucket>/bronze/<tabela>/dt=.../...
+    Geração = contador por objeto num arquivo ao lado, fora da árvore do
+    bucket (<raiz>/.geracao/<bucket>/<nome>): sobe 1 a cada gravação e
+    sobrevive ao delete, então nunca se repete (mtime pode empatar em duas
+    gravações seguidas). Gravação e checagem de precondição sob lock
+    (suficiente pra um processo); precondição 0 (não existe) ainda usa O_EXCL.
+    """
+    esquema = "file"
+
+    def __init__(self, raiz: str):
+        self.raiz = os.path.abspath(raiz)
+        self._lock = threading.Lock()
+
+    def _caminho(self, bucket: str, nome: str) -> str:
+        return os.path.join(self.raiz, bucket, *nome.split("/"))
+
+    def _caminho_geracao(self, bucket: str, nome: str) -> str:
+        return os.path.join(self.raiz, ".geracao", bucket, *nome.split("/"))
+
+    def _geracao(self, bucket: str, nome: str) -> int:
+        """Geração atual (0 = não existe; objeto sem contador, de antes dele, conta como 1)."""
+        if not os.path.exists(self._caminho(bucket, nome)):
+            return 0
+        try:
+            with open(self._caminho_geracao(bucket, nome)) as f:
+                return max(1, int(f.read() or 0))
+        except (FileNotFoundError, ValueError):
+            return 1
+
+    def _nova_geracao(self, bucket: str, nome: str) -> int:
+        caminho = self._caminho_geracao(bucket, nome)
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        try:
+            with open(caminho) as f:
+                ger = int(f.read() or 0) + 1
+        except (FileNotFoundError, ValueError):
+            ger = 1
+        tmp = f"{caminho}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "w") as f:
+            f.write(str(ger))
+        os.replace(tmp, caminho)
+        return ger
+
+    def uri(self, bucket, nome):
+        return "file://" + self._caminho(bucket, nome)
+
+    def nome(self, uri):
+        rel = os.path.relpath(uri[len("file://"):], self.raiz).replace(os.sep, "/")
+        bucket, nome = rel.split("/", 1)
+        return bucket, nome
+
+    def _ler(self, bucket, nome):
+        caminho = self._caminho(bucket, nome)
+        with self._lock:
+            try:
+                with open(caminho, "rb") as f:
+                    return f.read(), self._geracao(bucket, nome)
+            except FileNotFoundError:
+                raise NotFound(f"{bucket}/{nome}")
+
+    def _gravar(self, bucket, nome, data, if_generation_match=None):
+        caminho = self._caminho(bucket, nome)
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+
+        with self._lock:
+            if if_generation_match == 0:
+                try:
+                    fd = os.open(caminho, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                except FileExistsError:
+                    self._checar_precondicao(-1, 0, nome)
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                return self._nova_geracao(bucket, nome)
+
+            if if_generation_match is not None:
+                self._checar_precondicao(self._geracao(bucket, nome), if_generation_match, nome)
+            tmp = f"{caminho}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, caminho)
+            return self._nova_geracao(bucket, nome)
+
+    def _apagar(self, bucket, nome):
+        try:
+            os.remove(self._caminho(bucket, nome))
+        except FileNotFoundError:
+            raise NotFound(f"{bucket}/{nome}")
+
+    def _listar(self, bucket, prefix):
+        base = os.path.join(self.raiz, bucket)
+        out = []
+        for dirpath, _, arquivos in os.walk(base):
+            for a in arquivos:
+                if a.endswith(".tmp"):
+                    continue
+                nome = os.path.relpath(os.path.join(dirpath, a), base).replace(os.sep, "/")
+                if nome.startswith(prefix):
+                    out.append(nome)
+        return sorted(out)
+
+def uri_objeto(sc, nome: str) -> str:
+    """URI do objeto no lake: gs://<bucket>/... no GCS; file:///... ou mem://... offline."""
+    if isinstance(sc, Armazenamento):
+        return sc.uri(BUCKET_NAME, nome)
+    return f"gs://{BUCKET_NAME}/{nome}"
+
+def objeto_de_uri(sc, uri: str) -> tuple[str, str]:
+    """Inverso do uri_objeto: (bucket, nome)."""
+    if isinstance(sc, Armazenamento):
+        return sc.nome(uri)
+    bucket, nome = uri[len("gs://"):].split("/", 1)
+    return bucket, nome
 
 # -------------------------
 # BQ SETUP
 # -------------------------
-def setup_bq(client: bigquery.Client) -> None:
+# Fingerprint por tabela das definições em SCHEMAS. Tabela só é verificada no
+# BQ quando o fingerprint muda (ou após um load com NotFound). O cache vive no
+# state (entre instâncias) e em memória (instância quente).
+_SCHEMA_VERIFICADO = {}
+
+def schema_fingerprint(schema) -> str:
+    campos = [[f.name, f.field_type, f.mode] for f in schema]
+    return hashlib.sha1(json.dumps(campos).encode("utf-8")).hexdigest()[:16]
+
+def ensure_dataset(client: bigquery.Client) -> None:
+    from google.cloud import bigquery
     ds_ref = bigquery.Dataset(f"{PROJECT_ID}.{DATASET_ID}")
     try:
         client.get_dataset(ds_ref)
     except NotFound:
         client.create_dataset(ds_ref)
 
-    for table, schema in SCHEMAS.items():
-        table_ref = f"{PROJECT_ID}.{DATASET_ID}.{table}"
-        try:
-            client.get_table(table_ref)
-        except NotFound:
-            client.create_table(bigquery.Table(table_ref, schema=schema))
+def ensure_table(client: bigquery.Client, table: str) -> None:
+    """Cria a tabela ou acrescenta os campos novos do SCHEMAS (update incremental)."""
+    from google.cloud import bigquery
+    table_ref = f"{PROJECT_ID}.{DATASET_ID}.{table}"
+    schema = bq_schema(table)
+    try:
+        atual = client.get_table(table_ref)
+    except NotFound:
+        client.create_table(bigquery.Table(table_ref, schema=schema))
+        return
+
+    existentes = {f.name for f in atual.schema}
+    novos = [f for f in schema if f.name not in existentes]
+    if novos:
+        atual.schema = list(atual.schema) + novos
+        client.update_table(atual, ["schema"])
+        logging.info("schema %s: +%s", table, [f.name for f in novos])
+
+def setup_bq(client: bigquery.Client, state: dict = None) -> None:
+    cache = state.setdefault("schema_fp", {}) if state is not None else {}
+
+    pendentes = []
+    for table in SCHEMAS:
+        if table in TABELAS_SO_LAKE:
+            continue
+        fp = schema_fingerprint(campos_bq(table))
+        if _SCHEMA_VERIFICADO.get(table) == fp or cache.get(table) == fp:
+            _SCHEMA_VERIFICADO[table] = fp
+            continue
+        pendentes.append((table, fp))
+
+    if not pendentes:
+        return
+
+    ensure_dataset(client)
+    for table, fp in pendentes:
+        ensure_table(client, table)
+        cache[table] = fp
+        _SCHEMA_VERIFICADO[table] = fp
+
+def invalidate_schema(state: dict, table: str) -> None:
+    _SCHEMA_VERIFICADO.pop(table, None)
+    if state is not None:
+        state.get("schema_fp", {}).pop(table, None)
+
+def wait_load(client: bigquery.Client, table: str, uri, job, state: dict = None) -> None:
+    """Espera o load; se a tabela/dataset sumiu (NotFound), recria e tenta 1x de novo."""
+    try:
+        job.result()
+    except NotFound:
+        logging.warning("load %s: NotFound, reverificando schema", table)
+        invalidate_schema(state, table)
+        ensure_dataset(client)
+        ensure_table(client, table)
+        if state is not None:
+            state.setdefault("schema_fp", {})[table] = schema_fingerprint(campos_bq(table))
+        _SCHEMA_VERIFICADO[table] = schema_fingerprint(campos_bq(table))
+        submit_load_bq(client, table, uri).result()
 
 # -------------------------
 # STATE (com migração)
 # -------------------------
+class RegistroClientes:
+    """
+    Base de clientes compacta: em vez da lista de IDs "C0001", "C0002", ...
+    guarda faixas [ini, fim] (inclusive) dos números sequenciais, na ordem de
+    cadastro. O amostrador por idade só precisa da posição, então isso basta.
+    Interface de sequência (len, [i], append/extend de IDs) como a lista antiga.
+    No state.json vira {"faixas": [[1, 812], ...]} (tamanho ~constante).
+    """
+
+    __slots__ = ("faixas", "_inicio")
+
+    def __init__(self, faixas=None):
+        self.faixas = [[int(a), int(b)] for a, b in (faixas or [])]
+        self._reindexar()
+
+    def _reindexar(self):
+        # posição (0-based) do 1º cliente de cada faixa
+        self._inicio = []
+        n = 0
+        for a, b in self.faixas:
+            self._inicio.append(n)
+            n += b - a + 1
+
+    @classmethod
+    def from_state(cls, valor) -> "RegistroClientes":
+        if isinstance(valor, cls):
+            return valor
+        if isinstance(valor, dict):
+            return cls(valor.get("faixas", []))
+        # migração: lista antiga de IDs
+        reg = cls()
+        for cid in valor or []:
+            try:
+                reg.append(cid)
+            except ValueError:
+                logging.warning("cliente_id fora do padrão ignorado na migração: %r", cid)
+        return reg
+
+    def to_state(self) -> dict:
+        return {"faixas": self.faixas}
+
+    def __len__(self) -> int:
+        if not self.faixas:
+            return 0
+        a, b = self.faixas[-1]
+        return self._inicio[-1] + b - a + 1
+
+    def __getitem__(self, i: int) -> str:
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError(i)
+        k = bisect_right(self._inicio, i) - 1
+        return cliente_id(self.faixas[k][0] + i - self._inicio[k])
+
+    def append(self, cid) -> None:
+        num = int(cid[1:]) if isinstance(cid, str) else int(cid)
+        if self.faixas and self.faixas[-1][1] + 1 == num:
+            self.faixas[-1][1] = num
+        else:
+            self._inicio.append(len(self))
+            self.faixas.append([num, num])
+
+    def extend(self, cids) -> None:
+        for cid in cids:
+            self.append(cid)
+
+    def estender_faixa(self, ini: int, fim: int) -> None:
+        """Acrescenta os números ini..fim (inclusive) de uma vez."""
+        if fim < ini:
+            return
+        if self.faixas and self.faixas[-1][1] + 1 == ini:
+            self.faixas[-1][1] = fim
+        else:
+            self._inicio.append(len(self))
+            self.faixas.append([ini, fim])
+
+    def copy(self) -> "RegistroClientes":
+        return RegistroClientes(self.faixas)
+
+class CalendarioParadas:
+    """
+    Janelas de parada (manutenção) por máquina: [ini, fim) em epoch s, sem
+    sobreposição, em duas listas ordenadas (inícios e fins). Consulta por
+    bisect/searchsorted: O(log n) por máquina, só nas janelas que tocam os
+    ticks pedidos, sem varrer o histórico.
+    No state.json vira {"M001": [[ini, fim], ...]}.
+    """
+
+    __slots__ = ("inis", "fins")
+
+    def __init__(self, janelas: dict = None):
+        self.inis, self.fins = {}, {}
+        for maq, lista in (janelas or {}).items():
+            for ini, fim in lista:
+                self.adicionar(maq, ini, fim)
+
+    @classmethod
+    def from_state(cls, valor) -> "CalendarioParadas":
+        if isinstance(valor, cls):
+            return valor
+        return cls(valor if isinstance(valor, dict) else None)
+
+    def to_state(self) -> dict:
+        return {m: [[a, b] for a, b in zip(self.inis[m], self.fins[m])] for m in sorted(self.inis)}
+
+    def __len__(self) -> int:
+        return sum(len(v) for v in self.inis.values())
+
+    def adicionar(self, maquina: str, ini: int, fim: int) -> None:
+        """Insere [ini, fim), fundindo com as janelas que encostam/sobrepõem."""
+        ini, fim = int(ini), int(fim)
+        inis = self.inis.setdefault(maquina, [])
+        fins = self.fins.setdefault(maquina, [])
+        i = bisect_left(fins, ini)   # 1ª janela que termina em/depois de ini
+        j = bisect_right(inis, fim)  # janelas que começam até fim
+        if i < j:
+            ini, fim = min(ini, inis[i]), max(fim, fins[j - 1])
+        inis[i:j] = [ini]
+        fins[i:j] = [fim]
+
+    def podar(self, antes: datetime) -> None:
+        """Descarta janelas que terminam até `antes` (não afetam passos a partir dele)."""
+        limite = int(antes.timestamp())
+        for m in list(self.inis):
+            k = bisect_right(self.fins[m], limite)
+            if k:
+                del self.inis[m][:k]
+                del self.fins[m][:k]
+            if not self.inis[m]:
+                del self.inis[m], self.fins[m]
+
+    def consultar(self, maq_ids: list, ticks: list[datetime]):
+        """
+        Grade (ticks x máquinas): parada[t, j] = máquina j em manutenção no
+        início do tick t; livre_h[t, j] = horas até a próxima parada (inf se não há).
+        """
+        t_s = np.array([int(dt.timestamp()) for dt in ticks], dtype=np.int64)
+        parada = np.zeros((len(ticks), len(maq_ids)), dtype=bool)
+        livre_h = np.full((len(ticks), len(maq_ids)), np.inf)
+        if not self.inis or not ticks:
+            return parada, livre_h
+
+        t0, t1 = int(t_s.min()), int(t_s.max()) + 86400  # lote dura < 1 dia
+        for j, m in enumerate(maq_ids):
+            inis = self.inis.get(m)
+            if not inis:
+                continue
+            fins = self.fins[m]
+            lo, hi = bisect_right(fins, t0), bisect_right(inis, t1)
+            if lo >= hi:
+                continue
+            a = np.array(inis[lo:hi], dtype=np.int64)
+            b = np.array(fins[lo:hi], dtype=np.int64)
+            k = np.searchsorted(a, t_s, side="right") - 1  # última janela iniciada até o tick
+            parada[:, j] = (k >= 0) & (b[np.maximum(k, 0)] > t_s)
+            prox = k + 1
+            livre_h[:, j] = np.where(prox < len(a), (a[np.minimum(prox, len(a) - 1)] - t_s) / 3600.0, np.inf)
+        return parada, livre_h
+
+class EstoqueMateriais:
+    """
+    Estoque de matéria-prima em camadas FIFO: por materia_prima_id, uma deque
+    de [nº da compra, quantidade restante] na ordem de entrada, mais o saldo.
+    O consumo tira da camada mais antiga e camada zerada sai da deque: cada
+    compra entra e sai uma vez (O(1) amortizado por lote).
+    No state.json vira {"MP001": [[123, 850], ...]}.
+    """
+
+    __slots__ = ("camadas", "saldos")
+
+    def __init__(self, camadas: dict = None):
+        self.camadas, self.saldos = {}, {}
+        for mp, lista in (camadas or {}).items():
+            self.camadas[mp] = deque([int(n), int(q)] for n, q in lista)
+            self.saldos[mp] = sum(q for _, q in self.camadas[mp])
+
+    @classmethod
+    def from_state(cls, valor) -> "EstoqueMateriais":
+        if isinstance(valor, cls):
+            return valor
+        return cls(valor if isinstance(valor, dict) else None)
+
+    def to_state(self) -> dict:
+        return {mp: [list(c) for c in fila] for mp, fila in sorted(self.camadas.items()) if fila}
+
+    def saldo(self, mp: str) -> int:
+        return self.saldos.get(mp, 0)
+
+    def entrada(self, mp: str, compra: int, qtd: int) -> None:
+        self.camadas.setdefault(mp, deque()).append([int(compra), int(qtd)])
+        self.saldos[mp] = self.saldo(mp) + int(qtd)
+
+    def consumir(self, mp: str, qtd: int) -> list[tuple[int, int]]:
+        """Tira `qtd` (ou o que houver) das camadas mais antigas. Retorna [(nº da compra, quantidade)]."""
+        fila = self.camadas.get(mp)
+        usado = []
+        while qtd > 0 and fila:
+            camada = fila[0]
+            q = min(qtd, camada[1])
+            usado.append((camada[0], q))
+            camada[1] -= q
+            qtd -= q
+            self.saldos[mp] -= q
+            if not camada[1]:
+                fila.popleft()
+        return usado
+
+class DetectorAnomalias:
+    """
+    Estatística móvel por máquina pro detector de anomalias: média e variância
+    EWMA de cada métrica em arrays (máquinas x métricas). pontuar() dá o z da
+    leitura contra a estatística anterior e atualiza em O(1), vetorizado nas
+    máquinas. No state.json vira {"M001": [n, médias..., variâncias...]}.
+    """
+
+    __slots__ = ("ids", "idx", "n", "media", "var")
+
+    def __init__(self, dados: dict = None):
+        k = len(DETECTOR_METRICAS)
+        dados = {m: v for m, v in (dados or {}).items() if len(v) == 1 + 2 * k}
+        self.ids = sorted(dados)
+        self.idx = {m: j for j, m in enumerate(self.ids)}
+        self.n = np.array([int(dados[m][0]) for m in self.ids], dtype=np.int64)
+        self.media = np.array([dados[m][1:1 + k] for m in self.ids], dtype=float).reshape(-1, k)
+        self.var = np.array([dados[m][1 + k:] for m in self.ids], dtype=float).reshape(-1, k)
+
+    @classmethod
+    def from_state(cls, valor) -> "DetectorAnomalias":
+        if isinstance(valor, cls):
+            return valor
+        return cls(valor if isinstance(valor, dict) else None)
+
+    def to_state(self) -> dict:
+        return {m: [int(self.n[j])] + self.media[j].tolist() + self.var[j].tolist() for j, m in enumerate(self.ids)}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def indices(self, maq_ids: list[str]) -> np.ndarray:
+        """Índice de cada máquina (máquina nova entra zerada)."""
+        novos = [m for m in dict.fromkeys(maq_ids) if m not in self.idx]
+        if novos:
+            k = self.media.shape[1]
+            for m in novos:
+                self.idx[m] = len(self.ids)
+                self.ids.append(m)
+            self.n = np.concatenate([self.n, np.zeros(len(novos), dtype=np.int64)])
+            self.media = np.vstack([self.media, np.zeros((len(novos), k))])
+            self.var = np.vstack([self.var, np.zeros((len(novos), k))])
+        return np.array([self.idx[m] for m in maq_ids], dtype=np.int64)
+
+    def pontuar(self, j: np.ndarray, x: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Uma leitura (linha de x, métricas nas colunas) por máquina j, sem
+        repetir máquina. Retorna (z, n antes da leitura); z é nan sem variância.
+        Peso max(DETECTOR_ALFA, 1/(n+1)): média/variância simples no começo.
+        """
+        n = self.n[j]
+        media, var = self.media[j], self.var[j]
+        d = x - media
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = np.where(var > 0, d / np.sqrt(var), np.nan)
+        a = np.maximum(DETECTOR_ALFA, 1.0 / (n + 1))[:, None]
+        self.media[j] = media + a * d
+        self.var[j] = (1.0 - a) * (var + a * d * d)
+        self.n[j] = n + 1
+        return z, n
+
+def cliente_id(num: int) -> str:
+    return f"C{num:04d}"
+
 def default_state():
     return {
         "seed": 42,
@@ -336,24 +1113,42 @@ def default_state():
         "cnt_cliente": 0,
         "cnt_garantia": 0,
         "cnt_manut": 0,
-        "clientes": [],
+        "clientes": RegistroClientes(),
         "fleet": None,
 
         # NOVO
         "clientes_seeded": False,
         "ultimos_clientes": [],
-    }
 
-def load_state(sc: storage.Client) -> dict:
-    bucket = sc.bucket(BUCKET_NAME)
-    blob = bucket.blob(STATE_FILE)
+        # hot layer: {tabela: {"uris": [...], "desde": iso}} aguardando load coalescido
+        "bq_pendentes": {},
 
-    base = default_state()
+        # fingerprint do SCHEMAS já aplicado no BQ, por tabela (setup_bq)
+        "schema_fp": {},
+
+        # última hora gerada pelo incremental (iso, TZ_BR, hora cheia)
+        "watermark": None,
 
-    if not blob.exists():
-        return base
+        # backfills em andamento: {job: {"cursor": "YYYY-MM-DD", "seq": n}} (commit dos checkpoints)
+        "backfill_jobs": {},
 
-    state = json.loads(blob.download_as_text())
+        # eventos com data futura (garantia, teste de qualidade): heap de [quando, seq, tabela, linha]
+        "eventos_pendentes": [],
+        "seq_eventos": 0,
+
+        # janelas de manutenção por máquina (produção consulta antes de gerar lote)
+        "paradas": CalendarioParadas(),
+
+        # matéria-prima: camadas FIFO [compra, restante] por material
+        "estoque": EstoqueMateriais(),
+
+        # detector de anomalias: média/variância EWMA por máquina + contador de alertas
+        "detector": DetectorAnomalias(),
+        "cnt_alerta": 0,
+    }
+
+def migrar_state(state: dict) -> dict:
+    base = default_state()
 
     # MIGRAÇÃO: garante chaves novas
     for k, v in base.items():
@@ -361,8 +1156,10 @@ def load_state(sc: storage.Client) -> dict:
             state[k] = v
 
     # saneamento
-    if state.get("clientes") is None:
-        state["clientes"] = []
+    state["clientes"] = RegistroClientes.from_state(state.get("clientes"))
+    state["paradas"] = CalendarioParadas.from_state(state.get("paradas"))
+    state["estoque"] = EstoqueMateriais.from_state(state.get("estoque"))
+    state["detector"] = DetectorAnomalias.from_state(state.get("detector"))
     if state.get("fleet") == []:
         state["fleet"] = None
 
@@ -372,12 +1169,25 @@ def load_state(sc: storage.Client) -> dict:
     if not isinstance(state["ultimos_clientes"], list):
         state["ultimos_clientes"] = []
 
+    if not isinstance(state.get("bq_pendentes"), dict):
+        state["bq_pendentes"] = {}
+    if not isinstance(state.get("schema_fp"), dict):
+        state["schema_fp"] = {}
+    if not isinstance(state.get("backfill_jobs"), dict):
+        state["backfill_jobs"] = {}
+    if isinstance(state.get("eventos_pendentes"), dict):  # forma JSON: {seq: [quando, tabela, linha]}
+        state["eventos_pendentes"] = [[q, int(seq), t, linha] for seq, (q, t, linha) in state["eventos_pendentes"].items()]
+    if not isinstance(state.get("eventos_pendentes"), list):
+        state["eventos_pendentes"] = []
+    heapq.heapify(state["eventos_pendentes"])
+
     # garante flag
     if "clientes_seeded" not in state:
         state["clientes_seeded"] = False
 
     # garante inteiros
-    for k in ["cnt_op", "cnt_lote", "cnt_venda", "cnt_compra", "cnt_cliente", "cnt_garantia", "cnt_manut"]:
+    for k in ["cnt_op", "cnt_lote", "cnt_venda", "cnt_compra", "cnt_cliente", "cnt_garantia", "cnt_manut", "seq_eventos",
+              "cnt_alerta"]:
         try:
             state[k] = int(state.get(k, 0))
         except Exception:
@@ -385,11 +1195,219 @@ def load_state(sc: storage.Client) -> dict:
 
     return state
 
-def save_state(sc: storage.Client, state: dict) -> None:
-    sc.bucket(BUCKET_NAME).blob(STATE_FILE).upload_from_string(
-        json.dumps(state, ensure_ascii=False, indent=2),
-        content_type="application/json",
-    )
+def state_to_dict(state: dict) -> dict:
+    """
+    State em forma JSON (clientes, paradas, estoque e detector serializados).
+    O heap de eventos vira {seq: [quando, tabela, linha]}: no journal cada
+    passo só manda os eventos agendados/liberados, não o heap inteiro.
+    """
+    dados = dict(state)
+    dados["eventos_pendentes"] = {str(seq): [q, t, linha] for q, seq, t, linha in state.get("eventos_pendentes", [])}
+    dados["clientes"] = RegistroClientes.from_state(state.get("clientes")).to_state()
+    dados["paradas"] = CalendarioParadas.from_state(state.get("paradas")).to_state()
+    dados["estoque"] = EstoqueMateriais.from_state(state.get("estoque")).to_state()
+    dados["detector"] = DetectorAnomalias.from_state(state.get("detector")).to_state()
+    return dados
+
+def state_to_json(state: dict) -> str:
+    return json.dumps(state_to_dict(state), ensure_ascii=False, separators=(",", ":"))
+
+def diff_lista(antes: list, depois: list) -> dict | None:
+    """
+    Lista que só andou (janela/append): depois = antes[drop:] + add.
+    Retorna {"drop", "add"} ou None (aí o valor vai inteiro no "set").
+    """
+    if not depois:
+        return None
+    for k, v in enumerate(antes):
+        resto = len(antes) - k
+        if v == depois[0] and resto <= len(depois) and antes[k:] == depois[:resto]:
+            return {"drop": k, "add": depois[resto:]}
+    if not antes:
+        return {"drop": 0, "add": depois}
+    return None
+
+def diff_state(antes: dict, depois: dict) -> dict:
+    """
+    Delta entre dois states (forma JSON): inteiros viram incremento ("inc"),
+    dicts nos dois lados viram delta por sub-chave ("sub", recursivo), listas
+    que só andaram viram drop/add ("lista"); o resto que mudou é sobrescrito
+    ("set") e chaves removidas vão em "del".
+    """
+    inc, set_, del_, sub, lista = {}, {}, [], {}, {}
+    for k, v in depois.items():
+        old = antes.get(k)
+        if k in antes and old == v:
+            continue
+        if isinstance(v, int) and not isinstance(v, bool) and isinstance(old, int) and not isinstance(old, bool):
+            inc[k] = v - old
+        elif isinstance(v, dict) and isinstance(old, dict):
+            sub[k] = diff_state(old, v)
+        else:
+            d = diff_lista(old, v) if isinstance(v, list) and isinstance(old, list) else None
+            if d is None:
+                set_[k] = v
+            else:
+                lista[k] = d
+    for k in antes:
+        if k not in depois:
+            del_.append(k)
+
+    delta = {}
+    if inc:
+        delta["inc"] = inc
+    if set_:
+        delta["set"] = set_
+    if del_:
+        delta["del"] = del_
+    if sub:
+        delta["sub"] = sub
+    if lista:
+        delta["lista"] = lista
+    return delta
+
+def apply_delta(dados: dict, delta: dict) -> dict:
+    for k, v in delta.get("inc", {}).items():
+        dados[k] = int(dados.get(k, 0)) + v
+    for k, v in delta.get("set", {}).items():
+        dados[k] = v
+    for k in delta.get("del", []):
+        dados.pop(k, None)
+    for k, d in delta.get("sub", {}).items():
+        if not isinstance(dados.get(k), dict):
+            dados[k] = {}
+        apply_delta(dados[k], d)
+    for k, d in delta.get("lista", {}).items():
+        dados[k] = list(dados.get(k) or [])[d["drop"]:] + d["add"]
+    return dados
+
+class StateConflict(RuntimeError):
+    """Outra invocação gravou o state no meio desta (precondição de geração falhou)."""
+
+class StateStore:
+    """
+    State no GCS = snapshot (state/state.json, com "_journal_seq") + journal
+    append-only de deltas (state/journal/<seq>.json). Cada save() sobe só o
+    delta desde o último load/save (por sub-chave, ver diff_state), criado com
+    if_generation_match=0: se outra invocação já gravou aquele seq, levanta
+    StateConflict em vez de sobrescrever contadores. A cada
+    STATE_COMPACTAR_A_CADA deltas (ou STATE_COMPACTAR_BYTES de journal) o
+    snapshot é reescrito (precondição na geração do snapshot), o que limita o
+    replay do load, e o journal anterior ao snapshot ANTERIOR é apagado (quem
+    leu o snapshot velho ainda acha seus deltas).
+    """
+
+    def __init__(self, sc: storage.Client):
+        self.bucket = sc.bucket(BUCKET_NAME)
+        self.sc = sc
+        self.seq = 0            # último delta aplicado/gravado
+        self.snap_seq = 0       # seq coberto pelo snapshot
+        self.snap_gen = 0       # geração do snapshot (0 = não existe)
+        self.snap_seq_anterior = 0
+        self.journal_bytes = 0  # bytes de journal desde o snapshot
+        self.base = None        # state (forma JSON) do último load/save
+
+    def _journal_blob(self, seq: int):
+        return self.bucket.blob(f"{STATE_JOURNAL_PREFIX}{seq:012d}.json")
+
+    def _listar_journal(self) -> list:
+        out = []
+        for b in self.sc.list_blobs(BUCKET_NAME, prefix=STATE_JOURNAL_PREFIX):
+            nome = b.name[len(STATE_JOURNAL_PREFIX):]
+            try:
+                out.append((int(nome.split(".")[0]), b))
+            except ValueError:
+                continue
+        return sorted(out, key=lambda x: x[0])
+
+    def load(self) -> dict:
+        blob = self.bucket.blob(STATE_FILE)
+        try:
+            dados = json.loads(blob.download_as_bytes())
+            self.snap_gen = blob.generation or 0
+        except NotFound:
+            dados = {}
+            self.snap_gen = 0
+
+        self.snap_seq = int(dados.pop("_journal_seq", 0))
+        self.snap_seq_anterior = int(dados.pop("_journal_seq_anterior", 0))
+        self.seq = self.snap_seq
+        self.journal_bytes = 0
+
+        # deltas foram calculados sobre o state já migrado (defaults incluídos)
+        dados = state_to_dict(migrar_state(dados))
+
+        for seq, b in self._listar_journal():
+            if seq <= self.snap_seq:
+                continue
+            if seq != self.seq + 1:
+                raise StateConflict(f"journal com buraco: esperado {self.seq + 1}, achou {seq}")
+            bruto = b.download_as_bytes()
+            # normaliza a cada delta (journal antigo pode ter gravado a forma anterior)
+            dados = state_to_dict(migrar_state(apply_delta(dados, json.loads(bruto))))
+            self.journal_bytes += len(bruto)
+            self.seq = seq
+
+        state = migrar_state(dados)
+        self.base = json.loads(state_to_json(state))
+        return state
+
+    def save(self, state: dict) -> None:
+        atual = json.loads(state_to_json(state))
+        delta = diff_state(self.base or {}, atual)
+        if not delta:
+            return
+
+        from google.api_core.exceptions import PreconditionFailed
+
+        seq = self.seq + 1
+        corpo = json.dumps(delta, ensure_ascii=False, separators=(",", ":"))
+        try:
+            self._journal_blob(seq).upload_from_string(
+                corpo,
+                content_type="application/json",
+                if_generation_match=0,
+            )
+        except PreconditionFailed:
+            raise StateConflict(f"journal seq={seq} já existe (execução concorrente)")
+
+        self.seq = seq
+        self.base = atual
+        self.journal_bytes += len(corpo.encode())
+
+        if self.seq - self.snap_seq >= STATE_COMPACTAR_A_CADA or self.journal_bytes >= STATE_COMPACTAR_BYTES:
+            self.compactar(atual)
+
+    def compactar(self, dados: dict) -> None:
+        from google.api_core.exceptions import PreconditionFailed
+
+        snap = dict(dados)
+        snap["_journal_seq"] = self.seq
+        snap["_journal_seq_anterior"] = self.snap_seq
+        blob = self.bucket.blob(STATE_FILE)
+        try:
+            blob.upload_from_string(
+                json.dumps(snap, ensure_ascii=False, separators=(",", ":")),
+                content_type="application/json",
+                if_generation_match=self.snap_gen,
+            )
+        except PreconditionFailed:
+            logging.warning("compactação do state ignorada: snapshot mudou (outra invocação)")
+            return
+
+        # mantém o journal entre o snapshot anterior e este (leitores atrasados)
+        for seq, b in self._listar_journal():
+            if seq <= self.snap_seq_anterior:
+                b.delete()
+
+        self.snap_gen = blob.generation or 0
+        self.snap_seq_anterior = self.snap_seq
+        self.snap_seq = self.seq
+        self.journal_bytes = 0
+
+def load_state(sc: storage.Client) -> tuple[StateStore, dict]:
+    store = StateStore(sc)
+    return store, store.load()
 
 # -------------------------
 # HELPERS
@@ -408,57 +1426,776 @@ def turno(dt: datetime) -> str:
     return "T3"
 
 def hot_layer(dt: datetime) -> bool:
-    # só carrega pro BQ dados do ano atual
-    return dt.year == datetime.now(TZ_BR).year
+    # só carrega pro BQ dados do ano atual (e só quando o sink é o GCS)
+    return usa_bq() and dt.year == datetime.now(TZ_BR).year
 
-def write_gcs_jsonl(sc: storage.Client, table: str, rows: list[dict], run_id: str, dt: datetime) -> str:
-    if not rows:
-        return ""
+def hora_cheia(dt: datetime) -> datetime:
+    return dt.replace(minute=0, second=0, microsecond=0)
 
-    prefix = f"bronze/{table}/dt={dt.date().isoformat()}/hr={dt.hour:02d}/run={run_id}"
-    filename = f"part-{uuid.uuid4().hex}.jsonl"
-    blob_name = f"{prefix}/{filename}"
+def horas_pendentes(state: dict, agora: datetime) -> list[datetime]:
+    """
+    Horas que o incremental ainda não gerou: do watermark (exclusive) até a
+    hora atual, no máximo INCREMENTAL_MAX_HORAS (as mais antigas primeiro;
+    o resto fica pra próxima chamada). Sem watermark: as últimas HORAS_POR_LOTE.
+    Retry/overlap na mesma hora -> lista vazia.
+    """
+    fim = hora_cheia(agora.astimezone(TZ_BR))
+    wm = state.get("watermark")
+    if not wm:
+        return [fim - timedelta(hours=h) for h in reversed(range(HORAS_POR_LOTE))]
 
-    buf = io.StringIO()
-    ingest_ts = datetime.now(TZ_BR).isoformat()
+    ini = datetime.fromisoformat(wm).astimezone(TZ_BR) + timedelta(hours=1)
+    n = int((fim - ini) / timedelta(hours=1)) + 1
+    if n > INCREMENTAL_MAX_HORAS:
+        logging.warning("catch-up: %d horas pendentes desde %s; gerando %d nesta chamada",
+                        n, ini.isoformat(), INCREMENTAL_MAX_HORAS)
+    return [ini + timedelta(hours=h) for h in range(max(0, min(n, INCREMENTAL_MAX_HORAS)))]
 
-    for r in rows:
-        rr = dict(r)
-        rr["_run_id"] = run_id
-        rr["_ingested_at"] = ingest_ts
-        buf.write(json.dumps(rr, ensure_ascii=False, cls=CompactJSONEncoder))
-        buf.write("\n")
+def partition_prefix(table: str, dt: datetime, run_id: str) -> str:
+    return f"bronze/{table}/dt={dt.date().isoformat()}/hr={dt.hour:02d}/run={run_id}"
 
+# -------------------------
+# INSTRUMENTAÇÃO (spans por etapa + profile opcional)
+# -------------------------
+class Cronometro:
+    """
+    Spans de tempo da request: cada etapa (load_state, setup_bq, geração,
+    upload por tabela, espera do load no BQ...) vira um log JSON estruturado
+    e entra no resumo devolvido na resposta (?perf=...). Thread-safe: o
+    persist_tables mede os uploads de dentro do pool de threads.
+    """
+
+    def __init__(self, run_id: str, mode: str):
+        self.run_id = run_id
+        self.mode = mode
+        self.t0 = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, etapa: str, **attrs):
+        """Mede o bloco; quem usa pode preencher linhas/bytes no dict devolvido."""
+        info = dict(attrs)
+        t = time.perf_counter()
+        try:
+            yield info
+        finally:
+            info["ms"] = round((time.perf_counter() - t) * 1000, 1)
+            self.registrar(etapa, info)
+
+    def registrar(self, etapa: str, info: dict) -> None:
+        reg = {"etapa": etapa, **info}
+        with self._lock:
+            self.spans.append(reg)
+        logging.info(json.dumps({"evento": "span", "run_id": self.run_id, "mode": self.mode, **reg},
+                                ensure_ascii=False, default=str))
+
+    def resumo(self) -> dict:
+        """{"total_ms", "etapas": {etapa: {"ms", "n", "linhas"?, "bytes"?}}}"""
+        etapas = {}
+        with self._lock:
+            spans = list(self.spans)
+        for s in spans:
+            r = etapas.setdefault(s["etapa"], {"ms": 0.0, "n": 0})
+            r["ms"] = round(r["ms"] + s["ms"], 1)
+            r["n"] += 1
+            for k in ("linhas", "bytes"):
+                if k in s:
+                    r[k] = r.get(k, 0) + s[k]
+        return {"total_ms": round((time.perf_counter() - self.t0) * 1000, 1), "etapas": etapas}
+
+def medir(crono: Cronometro | None, etapa: str, **attrs):
+    """crono.span(...) ou um contexto nulo (dict descartável) quando não há cronômetro."""
+    return crono.span(etapa, **attrs) if crono is not None else nullcontext(dict(attrs))
+
+def salvar_profile(sc: storage.Client, perfil, run_id: str) -> str:
+    """
+    Sobe o cProfile da request (só a thread do handler) em
+    bronze/_profile/dt=.../hr=.../run=<run_id>/: profile.pstats (abre com
+    pstats/snakeviz) + profile.txt (top 40 por tempo acumulado).
+    """
+    import marshal
+    import pstats
+
+    perfil.create_stats()
+    prefix = partition_prefix("_profile", datetime.now(TZ_BR), run_id)
     bucket = sc.bucket(BUCKET_NAME)
-    blob = bucket.blob(blob_name)
-    blob.upload_from_string(buf.getvalue(), content_type="application/json")
+    bucket.blob(f"{prefix}/profile.pstats").upload_from_string(
+        marshal.dumps(perfil.stats), content_type="application/octet-stream"
+    )
 
-    return f"gs://{BUCKET_NAME}/{blob_name}"
+    txt = io.StringIO()
+    pstats.Stats(perfil, stream=txt).sort_stats("cumulative").print_stats(40)
+    bucket.blob(f"{prefix}/profile.txt").upload_from_string(txt.getvalue(), content_type="text/plain")
+    return uri_objeto(sc, f"{prefix}/profile.pstats")
 
-def load_bq_from_uri(client: bigquery.Client, table: str, uri: str) -> None:
+# -------------------------
+# ROW BATCH (colunar)
+# -------------------------
+# Colunas "preguiçosas": só viram string na serialização.
+FmtCol = namedtuple("FmtCol", ["fmt", "valores"])          # ints -> fmt % k (ex.: "OP%07d")
+CatCol = namedtuple("CatCol", ["categorias", "codigos"])    # categorias[codigo]
+
+def formatar_coluna(col, n: int, tipo: str) -> list:
+    """Coluna -> lista pronta pra serializar (str p/ STRING; datetime/float/int p/ os demais)."""
+    if isinstance(col, str) or col is None:
+        v = to_str(col) if tipo == "STRING" else col
+        return [v] * n
+    if isinstance(col, FmtCol):
+        fmt = col.fmt
+        return [fmt % k for k in col.valores.tolist()]
+    if isinstance(col, CatCol):
+        cats = [to_str(c) for c in col.categorias] if tipo == "STRING" else list(col.categorias)
+        return [cats[k] for k in col.codigos.tolist()]
+    if isinstance(col, np.ndarray):
+        if col.dtype.kind == "M":
+            if tipo == "STRING":
+                return np.char.replace(np.datetime_as_string(col, unit="s"), "T", " ").tolist()
+            return col.astype("datetime64[us]").tolist()
+        if tipo == "STRING":
+            return [str(v) for v in col.tolist()]
+        return col.tolist()
+    if tipo == "STRING":
+        return [v if type(v) is str else to_str(v) for v in col]
+    return list(col)
+
+def _recortar_coluna(col, idx):
+    """idx: slice ou array de índices."""
+    if isinstance(col, str) or col is None:
+        return col
+    if isinstance(col, FmtCol):
+        return FmtCol(col.fmt, col.valores[idx])
+    if isinstance(col, CatCol):
+        return CatCol(col.categorias, col.codigos[idx])
+    if isinstance(col, np.ndarray):
+        return col[idx]
+    if isinstance(idx, slice):
+        return col[idx]
+    return [col[k] for k in idx.tolist()]
+
+def _concatenar_coluna(cols: list, tamanhos: list, tipo: str):
+    c0 = cols[0]
+    if isinstance(c0, str) and all(c == c0 for c in cols):
+        return c0
+    if isinstance(c0, FmtCol) and all(isinstance(c, FmtCol) and c.fmt == c0.fmt for c in cols):
+        return FmtCol(c0.fmt, np.concatenate([c.valores for c in cols]))
+    if isinstance(c0, CatCol) and all(isinstance(c, CatCol) and c.categorias == c0.categorias for c in cols):
+        return CatCol(c0.categorias, np.concatenate([c.codigos for c in cols]))
+    if isinstance(c0, np.ndarray) and all(isinstance(c, np.ndarray) and c.dtype.kind == c0.dtype.kind for c in cols):
+        return np.concatenate(cols)
+    out = []
+    for c, n in zip(cols, tamanhos):
+        out.extend(formatar_coluna(c, n, tipo))
+    return out
+
+class RowBatch:
+    """
+    Lote colunar (struct-of-arrays) de uma tabela do bronze, com exatamente as
+    colunas do SCHEMAS. Coluna pode ser lista, constante (str), np.ndarray
+    (numérico / datetime64[s]), FmtCol ou CatCol; a formatação em string só
+    acontece em valores() (com cache), chamada pelos writers na serialização.
+    """
+
+    __slots__ = ("table", "n", "cols", "_fmt")
+
+    def __init__(self, table: str, n: int, cols: dict):
+        faltando = [f.name for f in SCHEMAS[table] if f.name not in cols]
+        if faltando:
+            raise ValueError(f"{table}: colunas faltando no RowBatch: {faltando}")
+        self.table = table
+        self.n = int(n)
+        self.cols = cols
+        self._fmt = {}
+
+    @classmethod
+    def vazio(cls, table: str) -> "RowBatch":
+        return cls(table, 0, {f.name: [] for f in SCHEMAS[table]})
+
+    @classmethod
+    def from_rows(cls, table: str, rows) -> "RowBatch":
+        if isinstance(rows, RowBatch):
+            return rows
+        rows = list(rows or [])
+        return cls(table, len(rows), {f.name: [r.get(f.name) for r in rows] for f in SCHEMAS[table]})
+
+    @classmethod
+    def concat(cls, table: str, batches: list) -> "RowBatch":
+        batches = [b for b in batches if b.n]
+        if not batches:
+            return cls.vazio(table)
+        if len(batches) == 1:
+            return batches[0]
+        tamanhos = [b.n for b in batches]
+        cols = {
+            f.name: _concatenar_coluna([b.cols[f.name] for b in batches], tamanhos, f.field_type)
+            for f in SCHEMAS[table]
+        }
+        return cls(table, sum(tamanhos), cols)
+
+    def __len__(self) -> int:
+        return self.n
+
+    def valores(self, nome: str) -> list:
+        out = self._fmt.get(nome)
+        if out is None:
+            tipo = next(f.field_type for f in SCHEMAS[self.table] if f.name == nome)
+            out = self._fmt[nome] = formatar_coluna(self.cols[nome], self.n, tipo)
+        return out
+
+    def fatia(self, ini: int, fim: int) -> "RowBatch":
+        ini, fim = max(0, ini), min(self.n, fim)
+        s = slice(ini, fim)
+        b = RowBatch(self.table, max(0, fim - ini), {k: _recortar_coluna(c, s) for k, c in self.cols.items()})
+        for k, v in self._fmt.items():
+            b._fmt[k] = v[s]
+        return b
+
+    def select(self, idx) -> "RowBatch":
+        idx = np.asarray(idx, dtype=np.int64)
+        return RowBatch(self.table, len(idx), {k: _recortar_coluna(c, idx) for k, c in self.cols.items()})
+
+    def rows(self) -> list[dict]:
+        nomes = [f.name for f in SCHEMAS[self.table]]
+        return [dict(zip(nomes, t)) for t in zip(*(self.valores(k) for k in nomes))]
+
+def as_batch(table: str, rows) -> RowBatch:
+    return RowBatch.from_rows(table, rows)
+
+# Literais JSON por tipo do SCHEMAS (mesma saída do json.dumps antigo).
+_json_str = json.encoder.encode_basestring  # ensure_ascii=False, implementação em C
+
+def _json_coluna(vals: list, tipo: str) -> list:
+    if tipo == "STRING":
+        return list(map(_json_str, vals))
+    if tipo == "TIMESTAMP":
+        return ["null" if v is None else _json_str(v.isoformat()) for v in vals]
+    if tipo == "FLOAT64":
+        return ["null" if v is None else float.__repr__(float(v)) for v in vals]
+    return ["null" if v is None else str(int(v)) for v in vals]
+
+class JsonlSerializer:
+    """
+    RowBatch -> bytes JSONL (utf-8) com _run_id/_ingested_at no fim de cada linha.
+    Cada coluna é codificada de uma vez (STRING vai direto no encoder C de
+    string, sem o CompactJSONEncoder) e a linha sai de um template fixo.
+    """
+
+    def __init__(self, table: str, run_id: str, ingest_ts: str):
+        self.table = table
+        self.campos = [(f.name, f.field_type) for f in SCHEMAS[table]]
+        extra = json.dumps({"_run_id": run_id, "_ingested_at": ingest_ts}, ensure_ascii=False)
+        partes = [f"{_json_str(nome)}: %s" for nome, _ in self.campos]
+        self.template = ("{" + ", ".join(partes)).replace("%s", "\0").replace("%", "%%").replace("\0", "%s")
+        self.template += ", " + extra[1:].replace("%", "%%") + "\n"
+
+    def encode(self, batch: RowBatch) -> bytes:
+        cols = [_json_coluna(batch.valores(nome), tipo) for nome, tipo in self.campos]
+        tmpl = self.template
+        return "".join([tmpl % t for t in zip(*cols)]).encode("utf-8")
+
+def serialize_jsonl(rows, run_id: str, ingest_ts: str, buf, table: str) -> int:
+    """Escreve as rows (bytes JSONL) em `buf` (arquivo binário/GzipFile). Retorna bytes brutos."""
+    batch = as_batch(table, rows)
+    ser = JsonlSerializer(table, run_id, ingest_ts)
+    total = 0
+    for k in range(0, batch.n, SERIALIZE_LOTE_LINHAS):
+        data = ser.encode(batch.fatia(k, k + SERIALIZE_LOTE_LINHAS))
+        buf.write(data)
+        total += len(data)
+    return total
+
+def jsonl_ext() -> str:
+    return ".jsonl.gz" if GCS_GZIP else ".jsonl"
+
+def jsonl_content_type() -> str:
+    return "application/gzip" if GCS_GZIP else "application/json"
+
+def new_blob_name(prefix: str) -> str:
+    return f"{prefix}/part-{uuid.uuid4().hex}{jsonl_ext()}"
+
+def upload_jsonl(sc: storage.Client, prefix: str, data: bytes) -> str:
+    """Sobe bytes já serializados (e já comprimidos se GCS_GZIP)."""
+    blob_name = new_blob_name(prefix)
+    sc.bucket(BUCKET_NAME).blob(blob_name).upload_from_string(data, content_type=jsonl_content_type())
+    return uri_objeto(sc, blob_name)
+
+class ContaBytes:
+    """File-like que repassa pro destino contando os bytes escritos."""
+
+    def __init__(self, destino):
+        self.destino = destino
+        self.n = 0
+
+    def write(self, b) -> int:
+        self.n += len(b)
+        return self.destino.write(b)
+
+    def flush(self) -> None:
+        self.destino.flush()
+
+    def tell(self) -> int:
+        return self.n
+
+    @property
+    def closed(self) -> bool:
+        return self.destino.closed
+
+def write_gcs_jsonl(sc: storage.Client, table: str, rows: RowBatch | list[dict], run_id: str,
+                    dt: datetime) -> tuple[str, int]:
+    """Retorna (uri, bytes gravados no GCS)."""
+    if not rows:
+        return "", 0
+
+    ingest_ts = datetime.now(TZ_BR).isoformat()
+    prefix = partition_prefix(table, dt, run_id)
+
+    # partição pequena: serializa em memória e sobe num request só
+    if len(rows) < STREAM_MIN_LINHAS:
+        buf = io.BytesIO()
+        if GCS_GZIP:
+            with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=GZIP_NIVEL, mtime=0) as gz:
+                serialize_jsonl(rows, run_id, ingest_ts, gz, table)
+        else:
+            serialize_jsonl(rows, run_id, ingest_ts, buf, table)
+        data = buf.getvalue()
+        return upload_jsonl(sc, prefix, data), len(data)
+
+    # partição grande: stream direto pro upload resumable em chunks (sem string inteira em memória)
+    blob_name = new_blob_name(prefix)
+    blob = sc.bucket(BUCKET_NAME).blob(blob_name)
+    with blob.open("wb", chunk_size=GCS_CHUNK_BYTES, ignore_flush=True,
+                   content_type=jsonl_content_type()) as raw:
+        out = ContaBytes(raw)
+        if GCS_GZIP:
+            with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=GZIP_NIVEL, mtime=0) as gz:
+                serialize_jsonl(rows, run_id, ingest_ts, gz, table)
+        else:
+            serialize_jsonl(rows, run_id, ingest_ts, out, table)
+    return uri_objeto(sc, blob_name), out.n
+
+# Parquet (pyarrow importado só quando o formato é usado)
+_ARROW_TIPOS = {"STRING": "string", "TIMESTAMP": "timestamp", "FLOAT64": "float64", "INT64": "int64"}
+_ARROW_SCHEMAS = {}
+
+def arrow_schema(table: str):
+    """Schema Arrow derivado do campos_bq (SCHEMAS + _run_id/_ingested_at)."""
+    if table not in _ARROW_SCHEMAS:
+        import pyarrow as pa
+        tipos = {
+            "string": pa.string(),
+            "timestamp": pa.timestamp("us", tz="UTC"),
+            "float64": pa.float64(),
+            "int64": pa.int64(),
+        }
+        campos = [pa.field(f.name, tipos[_ARROW_TIPOS[f.field_type]]) for f in campos_bq(table)]
+        _ARROW_SCHEMAS[table] = pa.schema(campos)
+    return _ARROW_SCHEMAS[table]
+
+def _arrow_coluna(batch: RowBatch, nome: str, tipo):
+    """
+    Coluna do RowBatch -> pyarrow.Array. numpy, CatCol e constantes vão direto
+    (sem lista Python por linha); o resto passa pelo valores(). Mesmos valores.
+    """
+    import pyarrow as pa
+    col = batch.cols[nome]
+    if nome not in batch._fmt:
+        if isinstance(col, np.ndarray):
+            if col.dtype.kind == "M" and pa.types.is_timestamp(tipo):
+                return pa.array(col.astype("datetime64[us]")).cast(tipo)
+            if col.dtype.kind in "iuf" and pa.types.is_float64(tipo):
+                return pa.array(col.astype(np.float64))
+            if col.dtype.kind in "iu" and pa.types.is_int64(tipo):
+                return pa.array(col.astype(np.int64))
+        elif pa.types.is_string(tipo):
+            if isinstance(col, str):
+                return pa.repeat(pa.scalar(col, tipo), batch.n)
+            if isinstance(col, CatCol):
+                cats = pa.array([to_str(c) for c in col.categorias], type=tipo)
+                return pa.DictionaryArray.from_arrays(pa.array(col.codigos), cats).dictionary_decode()
+    return pa.array(batch.valores(nome), type=tipo)
+
+def rows_to_arrow(table: str, rows, run_id: str, ingest_ts: str):
+    """RowBatch (ou rows) -> pyarrow.Table com as colunas do SCHEMAS."""
+    import pyarrow as pa
+    batch = as_batch(table, rows)
+    schema = arrow_schema(table)
+    n = batch.n
+    cols = []
+    for f in schema:
+        if f.name == "_run_id":
+            cols.append(pa.repeat(pa.scalar(run_id, f.type), n))
+        elif f.name == "_ingested_at":
+            cols.append(pa.repeat(pa.scalar(ingest_ts, f.type), n))
+        else:
+            cols.append(_arrow_coluna(batch, f.name, f.type))
+    return pa.Table.from_arrays(cols, schema=schema)
+
+def parquet_bytes(tbl) -> bytes:
+    import pyarrow.parquet as pq
+    buf = io.BytesIO()
+    pq.write_table(tbl, buf, compression=PARQUET_COMPRESSAO)
+    return buf.getvalue()
+
+def upload_parquet(sc: storage.Client, prefix: str, data: bytes) -> str:
+    blob_name = f"{prefix}/part-{uuid.uuid4().hex}.parquet"
+    sc.bucket(BUCKET_NAME).blob(blob_name).upload_from_string(data, content_type="application/vnd.apache.parquet")
+    return uri_objeto(sc, blob_name)
+
+def write_gcs_parquet(sc: storage.Client, table: str, rows: RowBatch | list[dict], run_id: str,
+                      dt: datetime) -> tuple[str, int]:
+    if not rows:
+        return "", 0
+    tbl = rows_to_arrow(table, rows, run_id, datetime.now(TZ_BR).isoformat())
+    data = parquet_bytes(tbl)
+    return upload_parquet(sc, partition_prefix(table, dt, run_id), data), len(data)
+
+def write_gcs_table(sc: storage.Client, table: str, rows: RowBatch | list[dict], run_id: str, dt: datetime,
+                    formato: str = None) -> tuple[str, int]:
+    """Grava uma partição no formato escolhido (jsonl | parquet). Retorna (uri, bytes)."""
+    if (formato or FORMATO_BRONZE) == "parquet":
+        return write_gcs_parquet(sc, table, rows, run_id, dt)
+    return write_gcs_jsonl(sc, table, rows, run_id, dt)
+
+def formato_uri(uri: str) -> str:
+    return "parquet" if uri.endswith(".parquet") else "jsonl"
+
+class ParquetStream:
+    """
+    Part-file parquet escrito direto no upload resumable (blob.open), um row
+    group por write(): a memória fica limitada a um RowBatch, não à partição.
+    Usado pelas tabelas volumosas geradas em chunks (raw_telemetria).
+    """
+
+    def __init__(self, sc: storage.Client, table: str, prefix: str, run_id: str, ingest_ts: str):
+        import pyarrow.parquet as pq
+        self.table = table
+        self.run_id = run_id
+        self.ingest_ts = ingest_ts
+        self.linhas = 0
+        blob_name = f"{prefix}/part-{uuid.uuid4().hex}.parquet"
+        self.uri = uri_objeto(sc, blob_name)
+        self._raw = sc.bucket(BUCKET_NAME).blob(blob_name).open(
+            "wb", chunk_size=GCS_CHUNK_BYTES, ignore_flush=True, content_type="application/vnd.apache.parquet"
+        )
+        self._out = ContaBytes(self._raw)
+        self._pq = pq.ParquetWriter(self._out, arrow_schema(table), compression=PARQUET_COMPRESSAO)
+
+    def write(self, rows: RowBatch) -> None:
+        self._pq.write_table(rows_to_arrow(self.table, rows, self.run_id, self.ingest_ts))
+        self.linhas += len(rows)
+
+    def close(self) -> int:
+        """Fecha o parquet (footer) e o upload; retorna os bytes gravados."""
+        self._pq.close()
+        self._raw.close()
+        return self._out.n
+
+def write_gcs_stream(sc: storage.Client, table: str, chunks, run_id: str, dt: datetime) -> tuple[str, int, int]:
+    """Chunks (RowBatch) de uma tabela volumosa num part-file parquet em streaming. Retorna (uri, bytes, linhas)."""
+    st = None
+    for chunk in chunks:
+        if st is None:
+            st = ParquetStream(sc, table, partition_prefix(table, dt, run_id), run_id,
+                               datetime.now(TZ_BR).isoformat())
+        st.write(chunk)
+    if st is None:
+        return "", 0, 0
+    return st.uri, st.close(), st.linhas
+
+class PartitionWriter:
+    """
+    Writer bufferizado do backfill: acumula rows por (tabela, partição) e só
+    sobe um part-file quando a partição passa de max_linhas/max_bytes ou no close().
+    particao="dia" -> dt=<dia>/hr=00 ; particao="mes" -> dt=<1º dia do mês>/hr=00.
+    O layout bronze/<tabela>/dt=.../hr=.../run=... é o mesmo do write_gcs_jsonl.
+    Com GCS_GZIP o buffer de cada partição já fica comprimido em memória;
+    em formato parquet o buffer é uma lista de tabelas Arrow (colunar).
+    """
+
+    def __init__(self, sc: storage.Client, run_id: str, particao: str = "dia",
+                 max_linhas: int = None, max_bytes: int = None, formato: str = None,
+                 crono: Cronometro = None):
+        if particao not in PARTICOES_BACKFILL:
+            raise ValueError(f"particao inválida: {particao}")
+        self.sc = sc
+        self.run_id = run_id
+        self.particao = particao
+        self.formato = formato or FORMATO_BRONZE
+        self.max_linhas = max_linhas or FLUSH_MAX_LINHAS
+        self.max_bytes = max_bytes or FLUSH_MAX_BYTES
+        self.ingest_ts = datetime.now(TZ_BR).isoformat()
+        # (tabela, dt_particao) -> [BytesIO|list[pa.Table], GzipFile|None, linhas, bytes_brutos]
+        self.buffers = {}
+        self.uris = []
+        self._entregues = 0  # uris já devolvidas por flush_all()
+        self.bytes = 0       # bytes enviados ao GCS (comprimidos)
+        self.crono = crono
+        self.streams = {}    # tabela -> (chave da partição, ParquetStream aberto)
+
+    def _chave(self, dt: datetime) -> datetime:
+        if self.particao == "mes":
+            return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def add(self, table: str, rows: RowBatch | list[dict], dt: datetime) -> None:
+        if not rows:
+            return
+        key = (table, self._chave(dt))
+
+        if self.formato == "parquet":
+            entry = self.buffers.setdefault(key, [[], None, 0, 0])
+            tbl = rows_to_arrow(table, rows, self.run_id, self.ingest_ts)
+            entry[0].append(tbl)
+            entry[2] += len(rows)
+            entry[3] += tbl.nbytes
+            if entry[2] >= self.max_linhas or entry[3] >= self.max_bytes:
+                self.flush(key)
+            return
+
+        entry = self.buffers.get(key)
+        if entry is None:
+            buf = io.BytesIO()
+            gz = gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=GZIP_NIVEL, mtime=0) if GCS_GZIP else None
+            entry = self.buffers[key] = [buf, gz, 0, 0]
+
+        entry[3] += serialize_jsonl(rows, self.run_id, self.ingest_ts, entry[1] or entry[0], table)
+        entry[2] += len(rows)
+
+        if entry[2] >= self.max_linhas or entry[3] >= self.max_bytes:
+            self.flush(key)
+
+    def flush(self, key) -> None:
+        entry = self.buffers.pop(key, None)
+        if entry is None or entry[2] == 0:
+            return
+        table, dt = key
+        prefix = partition_prefix(table, dt, self.run_id)
+
+        with medir(self.crono, "upload", tabela=table, linhas=entry[2]) as sp:
+            if self.formato == "parquet":
+                import pyarrow as pa
+                data = parquet_bytes(pa.concat_tables(entry[0]))
+                uri = upload_parquet(self.sc, prefix, data)
+            else:
+                buf, gz = entry[0], entry[1]
+                if gz is not None:
+                    gz.close()
+                data = buf.getvalue()
+                uri = upload_jsonl(self.sc, prefix, data)
+            sp["bytes"] = len(data)
+        self.bytes += len(data)
+        self.uris.append(uri)
+
+    def stream(self, table: str, chunks, dt: datetime) -> int:
+        """
+        Grava os chunks (RowBatch) de uma tabela volumosa num part-file parquet
+        em streaming, sem bufferizar a partição (sempre parquet, qualquer formato).
+        Um stream aberto por tabela: troca de partição ou passar de
+        STREAM_PARQUET_MAX_LINHAS fecha o part-file. Retorna as linhas gravadas.
+        """
+        key = (table, self._chave(dt))
+        total = 0
+        for chunk in chunks:
+            aberto = self.streams.get(table)
+            if aberto is not None and (aberto[0] != key or aberto[1].linhas >= STREAM_PARQUET_MAX_LINHAS):
+                self._fechar_stream(table)
+                aberto = None
+            if aberto is None:
+                st = ParquetStream(self.sc, table, partition_prefix(table, key[1], self.run_id),
+                                   self.run_id, self.ingest_ts)
+                aberto = self.streams[table] = (key, st)
+            with medir(self.crono, "upload", tabela=table, linhas=len(chunk)):
+                aberto[1].write(chunk)
+            total += len(chunk)
+        return total
+
+    def _fechar_stream(self, table: str) -> None:
+        _, st = self.streams.pop(table)
+        with medir(self.crono, "upload", tabela=table) as sp:
+            sp["bytes"] = st.close()
+        self.bytes += sp["bytes"]
+        self.uris.append(st.uri)
+
+    def flush_all(self) -> list[str]:
+        """Sobe todos os buffers e fecha os streams (writer continua aberto); devolve as URIs novas desde o último flush_all."""
+        for key in list(self.buffers):
+            self.flush(key)
+        for table in list(self.streams):
+            self._fechar_stream(table)
+        novas = self.uris[self._entregues:]
+        self._entregues = len(self.uris)
+        return novas
+
+    def close(self) -> list[str]:
+        for key in list(self.buffers):
+            self.flush(key)
+        for table in list(self.streams):
+            self._fechar_stream(table)
+        return self.uris
+
+def submit_load_bq(client: bigquery.Client, table: str, uri):
+    """
+    Dispara o load job (sem esperar). `uri` pode ser uma lista (mesmo formato).
+    Parquet -> SourceFormat.PARQUET. O schema inclui _run_id/_ingested_at
+    (CAMPOS_META): parquet não tem ignore_unknown_values, então as colunas
+    de linhagem precisam existir na tabela; ALLOW_FIELD_ADDITION cobre
+    tabela antiga ainda sem elas. Retorna o job ou None.
+    """
     if not uri:
-        return
+        return None
 
+    from google.cloud import bigquery
+    primeira = uri[0] if isinstance(uri, (list, tuple)) else uri
+    parquet = formato_uri(primeira) == "parquet"
     job_config = bigquery.LoadJobConfig(
-        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
-        schema=SCHEMAS[table],
+        source_format=bigquery.SourceFormat.PARQUET if parquet else bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+        schema=bq_schema(table),
         write_disposition="WRITE_APPEND",
         ignore_unknown_values=True,
+        schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION],
     )
 
-    client.load_table_from_uri(
+    return client.load_table_from_uri(
         uri,
         f"{PROJECT_ID}.{DATASET_ID}.{table}",
         job_config=job_config,
-    ).result()
+    )
+
+def load_bq_from_uri(client: bigquery.Client, table: str, uri: str) -> None:
+    job = submit_load_bq(client, table, uri)
+    if job is not None:
+        wait_load(client, table, uri, job)
 
 # -------------------------
 # RUN HELPERS (persist)
 # -------------------------
-def persist_table(sc, bq_client, dt, run_id, table, rows):
-    uri = write_gcs_jsonl(sc, table, rows, run_id, dt)
+class PersistError(RuntimeError):
+    """
+    Falha em uma ou mais tabelas de persist_tables ({tabela: erro}).
+    `uris`: o que chegou a subir ({tabela: uri}), pro chamador desfazer.
+    """
+
+    def __init__(self, falhas: dict, uris: dict = None):
+        self.falhas = falhas
+        self.uris = uris or {}
+        super().__init__("falha ao persistir: " + ", ".join(f"{t}: {e}" for t, e in falhas.items()))
+
+def persist_table(sc, bq_client, dt, run_id, table, rows, formato: str = None, crono: Cronometro = None):
+    with medir(crono, "upload", tabela=table, linhas=len(rows)) as sp:
+        uri, sp["bytes"] = write_gcs_table(sc, table, rows, run_id, dt, formato)
     if uri and hot_layer(dt):
-        load_bq_from_uri(bq_client, table, uri)
+        with medir(crono, "bq_load", tabela=table):
+            load_bq_from_uri(bq_client, table, uri)
+
+def persist_tables(sc, bq_client, dt, run_id, payloads: dict, state: dict = None,
+                   formato: str = None, crono: Cronometro = None) -> dict:
+    """
+    Persiste várias tabelas de uma vez: uploads em paralelo (thread pool
+    limitado a PERSIST_MAX_THREADS) e cada load job do BQ é disparado assim
+    que a URI da tabela fica pronta. Espera tudo junto no final.
+    Com `state`, o load não é imediato: a URI entra em state["bq_pendentes"]
+    e o flush_bq_pendentes decide quando carregar (coalescido).
+    Retorna {tabela: uri}; levanta PersistError com as falhas por tabela.
+    """
+    payloads = {t: rows for t, rows in payloads.items() if rows}
+    if not payloads:
+        return {}
+
+    hot = hot_layer(dt)
+    imediato = hot and state is None
+
+    def upload_e_load(table, rows):
+        with medir(crono, "upload", tabela=table, linhas=len(rows)) as sp:
+            uri, sp["bytes"] = write_gcs_table(sc, table, rows, run_id, dt, formato)
+        job = submit_load_bq(bq_client, table, uri) if imediato else None
+        return uri, job
+
+    uris, jobs, falhas = {}, {}, {}
+    with ThreadPoolExecutor(max_workers=min(PERSIST_MAX_THREADS, len(payloads))) as ex:
+        futs = {ex.submit(upload_e_load, t, rows): t for t, rows in payloads.items()}
+        for fut in as_completed(futs):
+            t = futs[fut]
+            try:
+                uris[t], job = fut.result()
+                if job is not None:
+                    jobs[t] = job
+            except Exception as e:
+                falhas[t] = e
+
+    for t, job in jobs.items():
+        try:
+            with medir(crono, "bq_load", tabela=t):
+                wait_load(bq_client, t, uris[t], job, state)
+        except Exception as e:
+            falhas[t] = e
+
+    for t, e in falhas.items():
+        logging.error("persist %s falhou: %s", t, e)
+    if falhas:
+        raise PersistError(falhas, {t: u for t, u in uris.items() if t not in falhas})
+
+    if hot and state is not None:
+        agora = datetime.now(TZ_BR).isoformat()
+        pend = state.setdefault("bq_pendentes", {})
+        for t, uri in uris.items():
+            p = pend.setdefault(t, {"uris": [], "desde": agora})
+            if not p["uris"]:
+                p["desde"] = agora
+            p["uris"].append(uri)
+
+    return uris
+
+def flush_bq_pendentes(bq_client, state: dict, agora: datetime, forcar: bool = False,
+                       crono: Cronometro = None) -> dict:
+    """
+    Carrega no BQ as URIs pendentes (1 load job multi-URI por tabela) das
+    tabelas que atingiram BQ_COALESCE_MAX_URIS, BQ_COALESCE_MAX_IDADE_MIN ou
+    estão em BQ_FLUSH_IMEDIATO. Jobs disparados juntos; em falha as URIs
+    continuam pendentes pro próximo run. Retorna {tabela: nº de URIs carregadas}.
+    """
+    pend = state.setdefault("bq_pendentes", {})
+    limite = agora - timedelta(minutes=BQ_COALESCE_MAX_IDADE_MIN)
+
+    devidas = {}
+    for t, p in pend.items():
+        if not p.get("uris"):
+            continue
+        if (forcar or t in BQ_FLUSH_IMEDIATO
+                or len(p["uris"]) >= BQ_COALESCE_MAX_URIS
+                or datetime.fromisoformat(p["desde"]) <= limite):
+            # 1 job = 1 formato: pega o trecho inicial com o formato da 1ª URI
+            fmt = formato_uri(p["uris"][0])
+            lote = []
+            for u in p["uris"]:
+                if formato_uri(u) != fmt:
+                    break
+                lote.append(u)
+            devidas[t] = lote
+
+    jobs = {}
+    for t, uris in devidas.items():
+        try:
+            jobs[t] = submit_load_bq(bq_client, t, uris)
+        except Exception as e:
+            logging.warning("load coalescido %s falhou (fica pendente): %s", t, e)
+
+    carregadas = {}
+    for t, job in jobs.items():
+        try:
+            with medir(crono, "bq_load", tabela=t, uris=len(devidas[t])):
+                wait_load(bq_client, t, devidas[t], job, state)
+        except Exception as e:
+            logging.warning("load coalescido %s falhou (fica pendente): %s", t, e)
+            continue
+        # remove só o que foi carregado (novas URIs podem ter entrado no meio)
+        restantes = pend[t]["uris"][len(devidas[t]):]
+        if restantes:
+            pend[t]["uris"] = restantes
+        else:
+            del pend[t]
+        carregadas[t] = len(devidas[t])
+
+    return carregadas
 
 # -------------------------
 # CLIENT SEED + BALANCE HELPERS
@@ -469,25 +2206,25 @@ def random_date_between(start_date: datetime, end_date: datetime) -> datetime:
         return start_date
     delta = end_date - start_date
     seconds = int(delta.total_seconds())
-    return start_date + timedelta(seconds=random.randint(0, max(1, seconds)))
+    return start_date + timedelta(seconds=rnd().randint(0, max(1, seconds)))
 
-def seed_clientes_iniciais(state: dict, dt_now: datetime) -> list[dict]:
+def seed_clientes_iniciais(state: dict, dt_now: datetime) -> RowBatch:
     """
     Cria um estoque inicial de clientes distribuídos de 2022-01-01 até dt_now.
-    Retorna rows para inserir em raw_cliente (cadastro).
+    Retorna o RowBatch para inserir em raw_cliente (cadastro).
     """
     if state.get("clientes_seeded", False):
-        return []
+        return RowBatch.vazio("raw_cliente")
 
     # Se já tem uma base relevante (ex.: migração anterior), não duplica
     if len(state.get("clientes", [])) >= 50:
         state["clientes_seeded"] = True
-        return []
+        return RowBatch.vazio("raw_cliente")
 
     alvo = int(SEED_CLIENTES_QTD)
     if alvo <= 0:
         state["clientes_seeded"] = True
-        return []
+        return RowBatch.vazio("raw_cliente")
 
     rows = []
     start = datetime(2022, 1, 1, tzinfo=TZ_BR)
@@ -506,14 +2243,32 @@ def seed_clientes_iniciais(state: dict, dt_now: datetime) -> list[dict]:
         dt_cad = random_date_between(start, end).date().isoformat()
         rows.append({
             "cliente_id": cid,
-            "tipo_cliente": random.choice(["Distribuidor", "Autopeças", "Montadora"]),
-            "cidade": random.choice(ESTADOS_BR),
-            "tipo_plano": random.choice(["Básico", "Standard", "Premium"]),
+            "tipo_cliente": rnd().choice(["Distribuidor", "Autopeças", "Montadora"]),
+            "cidade": rnd().choice(ESTADOS_BR),
+            "tipo_plano": rnd().choice(["Básico", "Standard", "Premium"]),
             "data_cadastro": dt_cad,
         })
 
     state["clientes_seeded"] = True
-    return rows
+    return RowBatch.from_rows("raw_cliente", rows)
+
+# Cache do amostrador (pesos acumulados por idade), indexado pelo tamanho da
+# base: só calcula quando aparece um n novo (gen_clientes/seed); cada sorteio
+# é O(log n). lru_cache por n (e array só leitura) em vez de um dict global
+# mutável: threads (backfill assíncrono + requests) nunca veem cum de outro n.
+@lru_cache(maxsize=2)
+def pesos_acumulados_clientes(n: int) -> np.ndarray:
+    """Pesos acumulados PESO_PISO + x**PESO_INTENSIDADE, x: 1 (antigo) -> 0 (novo)."""
+    x = 1.0 - np.arange(n, dtype=np.float64) / (n - 1)
+    cum = np.cumsum(PESO_PISO + x ** PESO_INTENSIDADE)
+    cum.flags.writeable = False
+    return cum
+
+def sortear_indice_cliente(n: int) -> int:
+    """Mesma regra de random.choices(weights=...): bisect em random() * total."""
+    cum = pesos_acumulados_clientes(n)
+    i = int(np.searchsorted(cum, rnd().random() * cum[-1], side="right"))
+    return min(i, n - 1)
 
 def escolher_cliente_por_idade(state: dict) -> str:
     """
@@ -524,28 +2279,21 @@ def escolher_cliente_por_idade(state: dict) -> str:
     if not clientes:
         return ""
     if len(clientes) < 5:
-        return random.choice(clientes)
+        return rnd().choice(clientes)
 
     n = len(clientes)
-    weights = []
-    for i in range(n):
-        x = 1 - (i / (n - 1))  # 1 (antigo) -> 0 (novo)
-        w = PESO_PISO + (x ** PESO_INTENSIDADE)
-        weights.append(w)
 
     ult = state.get("ultimos_clientes", [])[-ULTIMOS_CLIENTES_JANELA:]
     if ult:
-        freq = {}
-        for c in ult:
-            freq[c] = freq.get(c, 0) + 1
+        freq = Counter(ult)
         limite = max(3, int(0.12 * len(ult)))  # ~12% da janela
 
         for _ in range(6):
-            c = random.choices(clientes, weights=weights, k=1)[0]
+            c = clientes[sortear_indice_cliente(n)]
             if freq.get(c, 0) <= limite:
                 return c
 
-    return random.choices(clientes, weights=weights, k=1)[0]
+    return clientes[sortear_indice_cliente(n)]
 
 # -------------------------
 # STATIC BUILDERS
@@ -583,13 +2331,13 @@ def gen_fleet(state: dict) -> list[dict]:
         return state["fleet"]
 
     fleet = []
-    for i in range(1, 21):
+    for i in range(1, FROTA_QTD + 1):
         fleet.append({
             "maquina_id": f"M{i:03d}",
-            "tipo": random.choice(["Montadora", "Injetora", "Envasadora", "Robo", "Tester"]),
-            "fabricante": random.choice(["Siemens", "Bosch", "ABB", "Kuka", "Engel"]),
-            "ano": str(random.choice([2019, 2020, 2021, 2022, 2023, 2024])),
-            "linha_id": random.choice(["L01", "L02", "L03", "L04", "L05"]),
+            "tipo": rnd().choice(["Montadora", "Injetora", "Envasadora", "Robo", "Tester"]),
+            "fabricante": rnd().choice(["Siemens", "Bosch", "ABB", "Kuka", "Engel"]),
+            "ano": str(rnd().choice([2019, 2020, 2021, 2022, 2023, 2024])),
+            "linha_id": rnd().choice(["L01", "L02", "L03", "L04", "L05"]),
         })
 
     state["fleet"] = fleet
@@ -604,8 +2352,8 @@ def desgaste_maquina(ano_fab: str, dt: datetime):
     idade = max(0, dt.year - ano)
     fator = 1.0 + idade * 0.03
 
-    temp = float(np.random.normal(65.0 * fator, 3.0))
-    vib = float(np.random.normal(1200.0 * fator, 150.0))
+    temp = float(nprnd().normal(65.0 * fator, 3.0))
+    vib = float(nprnd().normal(1200.0 * fator, 150.0))
     perf = max(0.85, 1.0 - idade * 0.01)
 
     return round(temp, 1), round(vib, 0), perf
@@ -615,227 +2363,349 @@ def calc_oee(dur_h: float, ciclo_min: float, perf: float):
     cap_max = int(minutos / ciclo_min)
     qtd_plan = int(cap_max * 0.95)
 
-    eff = float(np.clip(np.random.normal(perf, 0.05), 0.0, 1.0))
+    eff = float(np.clip(nprnd().normal(perf, 0.05), 0.0, 1.0))
     qtd_prod = int(qtd_plan * eff)
 
     taxa_ref = 0.01 + (1.0 - perf)
-    qtd_ref = int(qtd_prod * random.uniform(0.0, taxa_ref))
+    qtd_ref = int(qtd_prod * rnd().uniform(0.0, taxa_ref))
+
+    return qtd_plan, qtd_prod, qtd_ref
+
+def frota_arrays(fleet: list[dict]):
+    """Colunas da frota usadas pela geração vetorizada: (ids, linhas, anos_fab)."""
+    anos = []
+    for m in fleet:
+        try:
+            anos.append(int(m["ano"]))
+        except Exception:
+            anos.append(2021)
+    return (
+        [m["maquina_id"] for m in fleet],
+        [m["linha_id"] for m in fleet],
+        np.array(anos, dtype=np.int64),
+    )
+
+def fator_desgaste(anos_fab: np.ndarray, anos_tick: np.ndarray):
+    """(idade, fator) do desgaste_maquina: matrizes (ticks x máquinas)."""
+    idade = np.maximum(0, anos_tick[:, None] - anos_fab[None, :])
+    return idade, 1.0 + idade * 0.03
+
+def desgaste_frota(anos_fab: np.ndarray, anos_tick: np.ndarray, rng=None):
+    """desgaste_maquina vetorizado: matrizes (ticks x máquinas)."""
+    rng = nprnd() if rng is None else rng
+    idade, fator = fator_desgaste(anos_fab, anos_tick)
+
+    temp = np.round(rng.normal(65.0 * fator, 3.0), 1)
+    vib = np.round(rng.normal(1200.0 * fator, 150.0), 0)
+    perf = np.maximum(0.85, 1.0 - idade * 0.01)
+
+    return temp, vib, perf
+
+def calc_oee_frota(dur_h: np.ndarray, ciclo_min: float, perf: np.ndarray, rng=None):
+    """calc_oee vetorizado (mesmas regras, arrays de mesmo shape)."""
+    rng = nprnd() if rng is None else rng
+    minutos = dur_h * 60.0
+    cap_max = np.floor(minutos / ciclo_min).astype(np.int64)
+    qtd_plan = np.floor(cap_max * 0.95).astype(np.int64)
+
+    eff = np.clip(rng.normal(perf, 0.05), 0.0, 1.0)
+    qtd_prod = np.floor(qtd_plan * eff).astype(np.int64)
+
+    taxa_ref = 0.01 + (1.0 - perf)
+    qtd_ref = np.floor(qtd_prod * rng.uniform(0.0, 1.0, size=perf.shape) * taxa_ref).astype(np.int64)
 
     return qtd_plan, qtd_prod, qtd_ref
 
 # -------------------------
 # GENERATORS (negócio)
 # -------------------------
-def gen_clientes(dt: datetime, state: dict, passo_horas: int = 1):
-    rows = []
+def gen_clientes(dt: datetime, state: dict, passo_horas: int = 1, qtd_novos: int = None) -> RowBatch:
+    ids, tipos, cidades, planos, cadastros = [], [], [], [], []
 
     # Cliente fundador
     if not state["clientes"]:
         state["cnt_cliente"] += 1
         cid = f"C{state['cnt_cliente']:04d}"
         state["clientes"].append(cid)
-        rows.append({
-            "cliente_id": cid,
-            "tipo_cliente": "Distribuidor",
-            "cidade": "SP",
-            "tipo_plano": "Standard",
-            "data_cadastro": "2022-01-01",
-        })
+        ids.append(cid)
+        tipos.append("Distribuidor")
+        cidades.append("SP")
+        planos.append("Standard")
+        cadastros.append("2022-01-01")
 
     # Média desejada: 1 cliente a cada 4h => 0.25/h
     lambda_por_hora = 0.25
 
     # Quantos clientes surgem neste passo (aleatório, média controlada)
-    qtd_novos = int(np.random.poisson(lam=lambda_por_hora * passo_horas))
+    # (backfill paralelo já traz qtd_novos sorteada no plano do dia)
+    if qtd_novos is None:
+        qtd_novos = int(nprnd().poisson(lam=lambda_por_hora * passo_horas))
 
-    # Limite de segurança (evita picos irreais)
-    qtd_novos = min(qtd_novos, 10)
+        # Limite de segurança (evita picos irreais)
+        qtd_novos = min(qtd_novos, CLIENTES_MAX_POR_PASSO)
 
+    data_cad = dt.date().isoformat()
     for _ in range(qtd_novos):
         state["cnt_cliente"] += 1
         cid = f"C{state['cnt_cliente']:04d}"
         state["clientes"].append(cid)
 
-        rows.append({
-            "cliente_id": cid,
-            "tipo_cliente": random.choice(["Distribuidor", "Autopeças", "Montadora"]),
-            "cidade": random.choice(ESTADOS_BR),
-            "tipo_plano": random.choice(["Básico", "Standard", "Premium"]),
-            "data_cadastro": dt.date().isoformat(),
-        })
-
-    return rows
-
-
-def gen_compras(dt: datetime, state: dict):
-    rows = []
-
-    prob = 0.55 if dt.year <= 2023 else 0.45 if dt.year == 2024 else 0.35
-    if random.random() >= prob:
-        return rows
-
-    qtd = random.randint(1, 4)
+        ids.append(cid)
+        tipos.append(rnd().choice(["Distribuidor", "Autopeças", "Montadora"]))
+        cidades.append(rnd().choice(ESTADOS_BR))
+        planos.append(rnd().choice(["Básico", "Standard", "Premium"]))
+        cadastros.append(data_cad)
+
+    return RowBatch("raw_cliente", len(ids), {
+        "cliente_id": ids,
+        "tipo_cliente": tipos,
+        "cidade": cidades,
+        "tipo_plano": planos,
+        "data_cadastro": cadastros,
+    })
+
+
+def prob_compra(dt: datetime) -> float:
+    return 0.55 if dt.year <= 2023 else 0.45 if dt.year == 2024 else 0.35
+
+def gen_compras(dt: datetime, state: dict, qtd: int = None) -> RowBatch:
+    if qtd is None:
+        if rnd().random() >= prob_compra(dt):
+            return RowBatch.vazio("raw_compras")
+        qtd = rnd().randint(1, 4)
     fornecedores = [f["fornecedor_id"] for f in DADOS_ESTATICOS["raw_fornecedor"]]
     materias = [m["materia_prima_id"] for m in DADOS_ESTATICOS["raw_materia_prima"]]
 
+    cnt0 = state["cnt_compra"]
+    qtds, custos_unit, custos_total, forns, mats = [], [], [], [], []
     for _ in range(qtd):
-        state["cnt_compra"] += 1
-        compra_id = f"CP{state['cnt_compra']:06d}"
-        qtd_comprada = random.randint(500, 2000)
-        custo_unit = round(random.uniform(20, 100), 2)
-        custo_total = round(qtd_comprada * custo_unit, 2)
-
-        rows.append({
-            "compra_id": compra_id,
-            "fornecedor_id": random.choice(fornecedores),
-            "materia_prima_id": random.choice(materias),
-            "data_compra": dt.strftime("%Y-%m-%d %H:%M:%S"),
-            "quantidade_comprada": to_str(qtd_comprada),
-            "custo_unitario": to_str(custo_unit),
-            "custo_total": to_str(custo_total),
-        })
-
-    return rows
+        qtd_comprada = rnd().randint(COMPRA_MIN_MP, COMPRA_MAX_MP)
+        custo_unit = round(rnd().uniform(20, 100), 2)
+
+        qtds.append(qtd_comprada)
+        custos_unit.append(custo_unit)
+        custos_total.append(round(qtd_comprada * custo_unit, 2))
+        forns.append(rnd().choice(fornecedores))
+        mats.append(rnd().choice(materias))
+    state["cnt_compra"] = cnt0 + qtd
+
+    return RowBatch("raw_compras", qtd, {
+        "compra_id": FmtCol("CP%06d", np.arange(cnt0 + 1, cnt0 + qtd + 1)),
+        "fornecedor_id": forns,
+        "materia_prima_id": mats,
+        "data_compra": dt.strftime("%Y-%m-%d %H:%M:%S"),
+        "quantidade_comprada": qtds,
+        "custo_unitario": custos_unit,
+        "custo_total": custos_total,
+    })
 
 def gen_producao(dt: datetime, state: dict, fleet: list[dict]):
-    prod = []
-    lotes = []
-    qual = []
-    alerts = []
+    return gen_producao_lote([dt], state, fleet)[0]
 
-    produtos = [p["produto_id"] for p in DADOS_ESTATICOS["raw_produto"]]
+TABELAS_PRODUCAO = ("raw_producao", "raw_lote", "raw_qualidade")
 
-    for m in fleet:
-        state["cnt_op"] += 1
-        state["cnt_lote"] += 1
-
-        op_id = f"OP{state['cnt_op']:07d}"
-        lote_id = f"Lote{state['cnt_lote']:07d}"
-
-        temp, vib, perf = desgaste_maquina(m["ano"], dt)
-
-        dur = round(random.uniform(0.80, 1.00), 2)
-        fim = dt + timedelta(hours=dur)
-
-        pid = random.choice(produtos)
-        ciclo_nom = 0.5  # 30s
-        q_plan, q_prod, q_ref = calc_oee(dur, ciclo_nom, perf)
-
-        lotes.append({
-            "lote_id": lote_id,
-            "produto_id": pid,
-            "linha_id": m["linha_id"],
-            "maquina_id": m["maquina_id"],
-            "inicio_producao": dt.strftime("%Y-%m-%d %H:%M:%S"),
-            "fim_producao": fim.strftime("%Y-%m-%d %H:%M:%S"),
-            "duracao_horas": to_str(dur),
-        })
-
-        prod.append({
-            "ordem_producao_id": op_id,
-            "lote_id": lote_id,
-            "produto_id": pid,
-            "linha_id": m["linha_id"],
-            "maquina_id": m["maquina_id"],
-            "turno_id": turno(dt),
-            "inicio": dt.strftime("%Y-%m-%d %H:%M:%S"),
-            "ciclo_minuto_nominal": to_str(ciclo_nom),
-            "duracao_horas": to_str(dur),
-            "temperatura_media_c": to_str(temp),
-            "vibracao_media_rpm": to_str(vib),
-            "pressao_media_bar": to_str(round(random.uniform(6, 8), 1)),
-            "quantidade_planejada": to_str(q_plan),
-            "quantidade_produzida": to_str(q_prod),
-            "quantidade_refugada": to_str(q_ref),
-        })
-
-        qual.append({
-            "teste_id": f"T{state['cnt_lote']:07d}",
-            "lote_id": lote_id,
-            "produto_id": pid,
-            "data_teste": (fim + timedelta(minutes=10)).strftime("%Y-%m-%d %H:%M:%S"),
-            "tensao_medida_v": to_str(round(random.normalvariate(12.6, 0.2), 2)),
-            "resistencia_interna_mohm": "6.0",
-            "capacidade_ah_teste": "60.0",
-            "defeito_id": "D00",
-            "aprovado": "1" if q_prod > 0 else "0",
-        })
-
-        if temp > 100.0 or vib > 2000.0:
-            alerts.append({
-                "alerta_id": f"ALT-{uuid.uuid4().hex[:10]}",
-                "data_ocorrencia": dt,  # TIMESTAMP
-                "nivel": "CRITICO",
-                "maquina_id": m["maquina_id"],
-                "mensagem": "Anomalia Detectada",
-                "valor_medido": float(temp),
-            })
+def gen_producao_lote(ticks: list[datetime], state: dict, fleet: list[dict], rng=None):
+    """
+    Produção da frota inteira para vários ticks de uma vez (vetorizado).
+    Retorna uma tupla (prod, lotes, qual) por tick, na ordem de `ticks`.
+    Alertas saem depois, do detector de anomalias (fechar_passo).
+    """
+    if not ticks or not fleet:
+        return [tuple(RowBatch.vazio(t) for t in TABELAS_PRODUCAO) for _ in ticks]
+
+    prod, lotes, qual, corte = _producao_grade(ticks, state, fleet, rng)
+    return [
+        (
+            prod.fatia(corte[t], corte[t + 1]),
+            lotes.fatia(corte[t], corte[t + 1]),
+            qual.fatia(corte[t], corte[t + 1]),
+        )
+        for t in range(len(ticks))
+    ]
 
-    return prod, lotes, qual, alerts
+def gen_producao_grade(ticks: list[datetime], state: dict, fleet: list[dict], rng=None):
+    """
+    Mesma produção do gen_producao_lote, mas devolve a grade (ticks x máquinas)
+    inteira como um RowBatch por tabela (linhas em ordem tick-major, sem as
+    máquinas paradas).
+    """
+    if not ticks or not fleet:
+        return tuple(RowBatch.vazio(t) for t in TABELAS_PRODUCAO)
+    return _producao_grade(ticks, state, fleet, rng)[:3]
 
-def gen_map_lote_compras(lotes: list[dict], compras: list[dict]):
-    rows = []
-    if not lotes or not compras:
-        return rows
+def _producao_grade(ticks: list[datetime], state: dict, fleet: list[dict], rng=None):
+    """
+    Sorteia temperatura/vibração/duração/eficiência/refugo como matrizes
+    (ticks x máquinas) e monta RowBatches colunares direto delas.
+    Máquina em manutenção no início do tick (state["paradas"]) não produz;
+    lote que esbarra no início de uma parada tem a duração cortada.
+    Retorna (prod, lotes, qual, corte): corte[t]:corte[t+1] são as linhas de
+    produção/lote/qualidade do tick t.
+    """
+    rng = nprnd() if rng is None else rng
 
-    compra_ids = [c["compra_id"] for c in compras]
-    for l in lotes:
-        k = random.randint(0, min(3, len(compra_ids)))
-        if k == 0:
-            continue
-        escolhidas = random.sample(compra_ids, k=k)
-        for cid in escolhidas:
-            rows.append({"lote_id": l["lote_id"], "compra_id": cid})
-    return rows
+    produtos = [p["produto_id"] for p in DADOS_ESTATICOS["raw_produto"]]
+    maq_ids, linhas, anos_fab = frota_arrays(fleet)
+    T, M = len(ticks), len(fleet)
+    n = T * M
+    anos_tick = np.array([dt.year for dt in ticks], dtype=np.int64)
+
+    temp, vib, perf = desgaste_frota(anos_fab, anos_tick, rng)
+
+    dur = np.round(rng.uniform(0.80, 1.00, size=(T, M)), 2)
+
+    # paradas: os sorteios continuam sendo da grade inteira (RNG não depende do calendário)
+    parada = None
+    if state.get("paradas"):
+        parada, livre_h = state["paradas"].consultar(maq_ids, ticks)
+        dur = np.where(livre_h < dur, np.floor(livre_h * 100) / 100, dur)
+        if not parada.any():
+            parada = None
+
+    pid_idx = rng.choice(len(produtos), size=(T, M))
+    ciclo_nom = 0.5  # 30s
+    q_plan, q_prod, q_ref = calc_oee_frota(dur, ciclo_nom, perf, rng)
+    pressao = np.round(rng.uniform(6, 8, size=(T, M)), 1)
+    tensao = np.round(rng.normal(12.6, 0.2, size=(T, M)), 2)
+
+    # fim/data_teste via datetime64 (segundos inteiros: dur tem 2 casas => múltiplo de 36s)
+    base = np.array([np.datetime64(dt.replace(tzinfo=None), "s") for dt in ticks])
+    fim = base[:, None] + np.rint(dur * 3600.0).astype("timedelta64[s]")
+
+    # células (tick, máquina) que produzem, em ordem tick-major
+    if parada is None:
+        n = T * M
+        tick_idx = np.repeat(np.arange(T), M)
+        maq_idx = np.tile(np.arange(M), T)
+
+        def celulas(a):
+            return a.ravel()
+    else:
+        cel = np.flatnonzero(~parada.ravel())
+        n = len(cel)
+        tick_idx, maq_idx = np.divmod(cel, M)
+
+        def celulas(a):
+            return a.ravel()[cel]
+    corte = np.searchsorted(tick_idx, np.arange(T + 1)).tolist()
+
+    fim = celulas(fim)
+    cnt_op, cnt_lote = state["cnt_op"], state["cnt_lote"]
+    seq_op = np.arange(cnt_op + 1, cnt_op + n + 1)
+    seq_lote = np.arange(cnt_lote + 1, cnt_lote + n + 1)
+    state["cnt_op"] = cnt_op + n
+    state["cnt_lote"] = cnt_lote + n
+
+    lote_id = FmtCol("Lote%07d", seq_lote)
+    produto = CatCol(produtos, celulas(pid_idx))
+    linha = CatCol(linhas, maq_idx)
+    maquina = CatCol(maq_ids, maq_idx)
+    inicio = CatCol([dt.strftime("%Y-%m-%d %H:%M:%S") for dt in ticks], tick_idx)
+    dur_f = celulas(dur)
+
+    lotes = RowBatch("raw_lote", n, {
+        "lote_id": lote_id,
+        "produto_id": produto,
+        "linha_id": linha,
+        "maquina_id": maquina,
+        "inicio_producao": inicio,
+        "fim_producao": fim,
+        "duracao_horas": dur_f,
+    })
+
+    prod = RowBatch("raw_producao", n, {
+        "ordem_producao_id": FmtCol("OP%07d", seq_op),
+        "lote_id": lote_id,
+        "produto_id": produto,
+        "linha_id": linha,
+        "maquina_id": maquina,
+        "turno_id": CatCol([turno(dt) for dt in ticks], tick_idx),
+        "inicio": inicio,
+        "ciclo_minuto_nominal": to_str(ciclo_nom),
+        "duracao_horas": dur_f,
+        "temperatura_media_c": celulas(temp),
+        "vibracao_media_rpm": celulas(vib),
+        "pressao_media_bar": celulas(pressao),
+        "quantidade_planejada": celulas(q_plan),
+        "quantidade_produzida": celulas(q_prod),
+        "quantidade_refugada": celulas(q_ref),
+    })
+
+    qual = RowBatch("raw_qualidade", n, {
+        "teste_id": FmtCol("T%07d", seq_lote),
+        "lote_id": lote_id,
+        "produto_id": produto,
+        "data_teste": fim + np.timedelta64(600, "s"),
+        "tensao_medida_v": celulas(tensao),
+        "resistencia_interna_mohm": "6.0",
+        "capacidade_ah_teste": "60.0",
+        "defeito_id": "D00",
+        "aprovado": CatCol(["0", "1"], (celulas(q_prod) > 0).astype(np.int8)),
+    })
+
+    return prod, lotes, qual, corte
+
+def vendas_por_tick(n_lotes: int) -> int:
+    return max(1, n_lotes // 5) if n_lotes else 0
 
 # ✅ agora recebe "producao" e preenche ordem_producao_id por lote
 # ✅ também cria eventos de update em raw_cliente para data_ultima_compra
-def gen_vendas(dt: datetime, state: dict, lotes: list[dict], producao: list[dict]):
-    rows = []
+# ✅ lotes_por_tick: nº de lotes de cada tick (grade horária) -> vende os primeiros de cada tick
+def gen_vendas(dt: datetime, state: dict, lotes: RowBatch, producao: RowBatch,
+               lotes_por_tick: list[int] = None) -> RowBatch:
     if not lotes or not state["clientes"]:
-        return rows
-
-    op_por_lote = {}
-    for p in producao:
-        lid = p.get("lote_id", "")
-        op = p.get("ordem_producao_id", "")
-        if lid and op and lid not in op_por_lote:
-            op_por_lote[lid] = op
-
-    n = max(1, len(lotes) // 5)
-    amostra = lotes[:n]
-
-    for l in amostra:
-        state["cnt_venda"] += 1
-
+        return RowBatch.vazio("raw_vendas")
+
+    # 1ª OP de cada lote (zip invertido: o 1º par vence)
+    p_lotes = producao.valores("lote_id")
+    p_ops = producao.valores("ordem_producao_id")
+    op_por_lote = {lid: op for lid, op in zip(reversed(p_lotes), reversed(p_ops)) if lid and op}
+
+    if lotes_por_tick is not None:
+        inicio_tick = np.cumsum([0] + list(lotes_por_tick[:-1]))
+        amostra = lotes.select(np.concatenate(
+            [ini + np.arange(vendas_por_tick(k)) for ini, k in zip(inicio_tick.tolist(), lotes_por_tick)]
+        ))
+        n = len(amostra)
+    else:
+        n = vendas_por_tick(len(lotes))
+        amostra = lotes.fatia(0, n)
+    lote_ids = amostra.valores("lote_id")
+
+    cnt0 = state["cnt_venda"]
+    clientes, qtds, valores = [], [], []
+    for _ in range(n):
         # Escolha balanceada (mantém sua lógica atual)
         cliente = escolher_cliente_por_idade(state)
         if cliente:
             state.setdefault("ultimos_clientes", []).append(cliente)
             state["ultimos_clientes"] = state["ultimos_clientes"][-ULTIMOS_CLIENTES_JANELA:]
 
-        ordem = op_por_lote.get(l.get("lote_id", ""), "")
+        clientes.append(cliente)
+        qtds.append(rnd().randint(20, 120))
+        valores.append(round(rnd().uniform(5000, 15000), 2))
+    state["cnt_venda"] = cnt0 + n
 
-        rows.append({
-            "venda_id": f"V{state['cnt_venda']:07d}",
-            "ano_mes_id": dt.strftime("%Y-%m"),
-            "cliente_id": cliente,
-            "produto_id": l["produto_id"],
-            "ordem_producao_id": ordem,
-            "lote_id": l["lote_id"],
-            "data_venda": dt.date().isoformat(),
-            "quantidade_vendida": to_str(random.randint(20, 120)),
-            "valor_total_venda": to_str(round(random.uniform(5000, 15000), 2)),
-        })
-
-    return rows
+    return RowBatch("raw_vendas", n, {
+        "venda_id": FmtCol("V%07d", np.arange(cnt0 + 1, cnt0 + n + 1)),
+        "ano_mes_id": dt.strftime("%Y-%m"),
+        "cliente_id": clientes,
+        "produto_id": amostra.cols["produto_id"],
+        "ordem_producao_id": [op_por_lote.get(lid, "") for lid in lote_ids],
+        "lote_id": lote_ids,
+        "data_venda": dt.date().isoformat(),
+        "quantidade_vendida": qtds,
+        "valor_total_venda": valores,
+    })
 
 
 # ✅ garantia sempre baseada em venda
-def gen_garantia(dt: datetime, state: dict, vendas: list[dict]):
+def gen_garantia(dt: datetime, state: dict, vendas: RowBatch, acionadas: list[bool] = None,
+                 quando_vendas: list[datetime] = None) -> RowBatch:
+    """quando_vendas: hora de cada venda (grade horária); sem ele, todas contam a partir de dt."""
     rows = []
     if not vendas:
-        return rows
+        return RowBatch.vazio("raw_garantia")
 
     # Janela de garantia (em dias) - ajuste se quiser
     GARANTIA_DIAS = 180
@@ -872,14 +2742,21 @@ def gen_garantia(dt: datetime, state: dict, vendas: list[dict]):
     defeitos_ids = [d for d, _ in defeitos_pesos]
     defeitos_w = [w for _, w in defeitos_pesos]
 
-    for v in vendas:
+    v_clientes = vendas.valores("cliente_id")
+    v_produtos = vendas.valores("produto_id")
+    v_lotes = vendas.valores("lote_id")
+
+    for i in range(len(vendas)):
         # taxa de acionamento de garantia (você já tinha 1%)
-        if random.random() >= 0.01:
+        if acionadas is not None:
+            if not acionadas[i]:
+                continue
+        elif rnd().random() >= TAXA_GARANTIA:
             continue
 
         state["cnt_garantia"] += 1
-        dias = random.randint(1, 90)  # seu range atual; se quiser mais real, pode aumentar
-        defeito_id = random.choices(defeitos_ids, weights=defeitos_w, k=1)[0]
+        dias = rnd().randint(1, 90)  # seu range atual; se quiser mais real, pode aumentar
+        defeito_id = rnd().choices(defeitos_ids, weights=defeitos_w, k=1)[0]
 
         # Regras de decisão
         dentro_garantia = dias <= GARANTIA_DIAS
@@ -895,59 +2772,1088 @@ def gen_garantia(dt: datetime, state: dict, vendas: list[dict]):
             if dias > 120:
                 p_mau = min(0.90, p_mau + 0.10)
 
-            if random.random() < p_mau:
+            if rnd().random() < p_mau:
                 status = "Negada - Mau Uso"
                 custo = 0.0
             else:
                 if dentro_garantia:
                     status = "Aprovada"
                     lo, hi = custo_base.get(defeito_id, (200, 1500))
-                    custo = round(random.uniform(lo, hi), 2)
+                    custo = round(rnd().uniform(lo, hi), 2)
                 else:
                     # Fora da garantia: normalmente nega, mas pode ter "boa vontade"
-                    if random.random() < 0.08:
+                    if rnd().random() < 0.08:
                         status = "Aprovada"
                         lo, hi = custo_base.get(defeito_id, (200, 1500))
-                        custo = round(random.uniform(lo, hi), 2)
+                        custo = round(rnd().uniform(lo, hi), 2)
                     else:
                         status = "Negada"
                         custo = 0.0
 
         rows.append({
             "garantia_id": f"W{state['cnt_garantia']:07d}",
-            "cliente_id": v["cliente_id"],
-            "produto_id": v["produto_id"],
-            "lote_id": v["lote_id"],
-            "data_reclamacao": (dt + timedelta(days=dias)).strftime("%Y-%m-%d %H:%M:%S"),
+            "cliente_id": v_clientes[i],
+            "produto_id": v_produtos[i],
+            "lote_id": v_lotes[i],
+            "data_reclamacao": ((dt if quando_vendas is None else quando_vendas[i]) + timedelta(days=dias)
+                                ).strftime("%Y-%m-%d %H:%M:%S"),
             "dias_pos_venda": to_str(dias),
             "defeito_id": defeito_id,
             "status": status,
-            "tempo_resposta_dias": to_str(random.randint(1, 15)),
+            "tempo_resposta_dias": to_str(rnd().randint(1, 15)),
             "custo_garantia": to_str(custo),
         })
 
-    return rows
+    return RowBatch.from_rows("raw_garantia", rows)
+
+
+def prob_manutencao_frota(ticks: list[datetime], fleet: list[dict]) -> np.ndarray:
+    """Prob. de manutenção por (tick, máquina): cresce com o desgaste (idade) da máquina."""
+    _, _, anos_fab = frota_arrays(fleet)
+    _, fator = fator_desgaste(anos_fab, np.array([dt.year for dt in ticks], dtype=np.int64))
+    return np.minimum(1.0, PROB_MANUTENCAO_MAQUINA * fator ** PESO_DESGASTE_MANUTENCAO)
 
+def sortear_manutencoes(ticks: list[datetime], fleet: list[dict], rng=None) -> list[list[int]]:
+    """Índices (na frota) das máquinas que entram em manutenção em cada tick."""
+    if not ticks or not fleet:
+        return [[] for _ in ticks]
+    rng = nprnd() if rng is None else rng
+    sorteio = rng.random((len(ticks), len(fleet))) < prob_manutencao_frota(ticks, fleet)
+    return [np.flatnonzero(linha).tolist() for linha in sorteio]
 
-def gen_manutencao(dt: datetime, state: dict, fleet: list[dict]):
+def registrar_manutencoes(paradas: CalendarioParadas, ticks: list[datetime], fleet: list[dict],
+                          maquinas: list[list[int]]) -> None:
+    """Põe as janelas [tick, tick + MANUTENCAO_HORAS) no calendário (antes de gerar a produção)."""
+    for tick, idx in zip(ticks, maquinas):
+        ini = int(tick.timestamp())
+        for j in idx:
+            paradas.adicionar(fleet[j]["maquina_id"], ini, ini + MANUTENCAO_HORAS * 3600)
+
+def gen_manutencao(dt: datetime, state: dict, fleet: list[dict], maquinas: list[int] = None) -> RowBatch:
+    """
+    Eventos de manutenção do tick. `maquinas` (índices na frota) vem do plano
+    ou do sortear_manutencoes do chamador, que já registrou as paradas; sem
+    ele, sorteia e registra aqui (a produção deste tick já não vê a parada).
+    """
     rows = []
-    if random.random() < 0.05:
+    if maquinas is None:
+        maquinas = sortear_manutencoes([dt], fleet)[0]
+        registrar_manutencoes(state["paradas"], [dt], fleet, [maquinas])
+    fim = dt + timedelta(hours=MANUTENCAO_HORAS)
+    for j in maquinas:
         state["cnt_manut"] += 1
-        m = random.choice(fleet)
-        fim = dt + timedelta(hours=2)
+        m = fleet[j]
 
         rows.append({
             "evento_manutencao_id": f"EVM{state['cnt_manut']:07d}",
             "maquina_id": m["maquina_id"],
             "linha_id": m["linha_id"],
-            "tipo_manutencao_id": random.choice(["TM01", "TM02", "TM03"]),
+            "tipo_manutencao_id": rnd().choice(["TM01", "TM02", "TM03"]),
             "inicio": dt.strftime("%Y-%m-%d %H:%M:%S"),
             "fim": fim.strftime("%Y-%m-%d %H:%M:%S"),
-            "duracao_min": "120",
-            "criticidade": random.choice(["Baixa", "Média", "Alta"]),
+            "duracao_min": str(MANUTENCAO_HORAS * 60),
+            "criticidade": rnd().choice(["Baixa", "Média", "Alta"]),
+        })
+
+    return RowBatch.from_rows("raw_manutencao", rows)
+
+# -------------------------
+# TELEMETRIA (sensores por leitura)
+# -------------------------
+# Cada ordem de produção vira leituras a cada `resolucao_s` do início até
+# inicio + duracao_horas, em torno das médias da própria ordem (raw_producao):
+# ruído AR(1) com tempo de correlação TELEMETRIA_TAU_S (temperatura e vibração
+# correlacionadas) + aquecimento ao longo do lote; amplitude de ruído e de
+# aquecimento escalam com o fator de desgaste da máquina. Tudo em matrizes
+# (lotes x leituras) por chunk, sem string por linha.
+# RNG próprio, semeado pela seed do job e pelo 1º lote do passo: a mesma
+# produção gera a mesma telemetria em qualquer nº de workers ou retomada.
+def codificar_coluna(batch: RowBatch, nome: str) -> tuple[list, np.ndarray]:
+    """(categorias, códigos) de uma coluna: direto do CatCol, senão via np.unique."""
+    col = batch.cols[nome]
+    if isinstance(col, CatCol):
+        return list(col.categorias), np.asarray(col.codigos, dtype=np.int64)
+    cats, cod = np.unique(np.asarray(batch.valores(nome), dtype=object), return_inverse=True)
+    return cats.tolist(), cod.astype(np.int64)
+
+def primeiro_lote(producao: RowBatch) -> int:
+    col = producao.cols["lote_id"]
+    if isinstance(col, FmtCol):
+        return int(col.valores[0])
+    return int("".join(c for c in producao.valores("lote_id")[0] if c.isdigit()) or 0)
+
+def gen_telemetria(producao: RowBatch, fleet: list[dict], resolucao_s: int, seed: int):
+    """Gera RowBatches de raw_telemetria (até TELEMETRIA_CHUNK_LINHAS linhas cada) para as ordens do passo."""
+    if not producao:
+        return
+    rng = np.random.default_rng(np.random.SeedSequence(entropy=int(seed), spawn_key=(primeiro_lote(producao), 3)))
+
+    maq_cats, maq_cod = codificar_coluna(producao, "maquina_id")
+    ini_cats, ini_cod = codificar_coluna(producao, "inicio")
+    inicios = [datetime.strptime(c, "%Y-%m-%d %H:%M:%S").replace(tzinfo=TZ_BR) for c in ini_cats]
+    ini_s = np.array([int(d.timestamp()) for d in inicios], dtype=np.int64)[ini_cod]  # epoch UTC
+
+    ids, _, anos_frota = frota_arrays(fleet)
+    anos = dict(zip(ids, anos_frota.tolist()))
+    anos_fab = np.array([anos.get(m, 2021) for m in maq_cats], dtype=np.int64)
+    _, fator = fator_desgaste(anos_fab, np.array([d.year for d in inicios], dtype=np.int64))
+    fator = fator[ini_cod, maq_cod]
+
+    medias = [coluna_numerica(producao, c).astype(float) for c in
+              ("temperatura_media_c", "vibracao_media_rpm", "pressao_media_bar")]
+    dur_s = np.rint(coluna_numerica(producao, "duracao_horas").astype(float) * 3600.0)
+    k = np.maximum(1, (dur_s // resolucao_s).astype(np.int64))  # leituras por lote
+
+    phi = float(np.exp(-resolucao_s / TELEMETRIA_TAU_S))
+    inov = float(np.sqrt(1.0 - phi * phi))
+    rho = TELEMETRIA_RHO
+    sig_t, sig_v, sig_p = (TELEMETRIA_RUIDO[c] for c in ("temperatura_c", "vibracao_rpm", "pressao_bar"))
+
+    # lotes inteiros por chunk (ao menos 1), ~TELEMETRIA_CHUNK_LINHAS leituras cada
+    acum = np.cumsum(k)
+    a = 0
+    while a < len(k):
+        base = acum[a - 1] if a else 0
+        b = max(a + 1, int(np.searchsorted(acum, base + TELEMETRIA_CHUNK_LINHAS, side="right")))
+        kk, m = k[a:b], b - a
+        L = int(kk.max())
+
+        # AR(1) estacionário, coluna a coluna (vetorizado nos lotes)
+        e = rng.standard_normal((2, m, L))
+        x = np.empty_like(e)
+        x[:, :, 0] = e[:, :, 0]
+        for t in range(1, L):
+            x[:, :, t] = phi * x[:, :, t - 1] + inov * e[:, :, t]
+
+        passo = np.arange(L)
+        valido = passo[None, :] < kk[:, None]
+        rampa = (passo[None, :] + 0.5) / kk[:, None] - 0.5  # -0.5 .. +0.5 ao longo do lote
+        f = fator[a:b, None]
+        temp = medias[0][a:b, None] + f * (TELEMETRIA_AQUECIMENTO_C * rampa + sig_t * x[0])
+        vib = medias[1][a:b, None] + f * sig_v * (rho * x[0] + np.sqrt(1.0 - rho * rho) * x[1])
+        pres = medias[2][a:b, None] + sig_p * rng.standard_normal((m, L))
+        quando = (ini_s[a:b, None] + passo[None, :] * resolucao_s)[valido]
+
+        yield RowBatch("raw_telemetria", int(kk.sum()), {
+            "maquina_id": CatCol(maq_cats, np.repeat(maq_cod[a:b], kk)),
+            "data_leitura": quando.astype("datetime64[s]"),  # TIMESTAMP (UTC, como data_ocorrencia)
+            "temperatura_c": np.round(temp[valido], 2),
+            "vibracao_rpm": np.round(vib[valido], 1),
+            "pressao_bar": np.round(pres[valido], 3),
+        })
+        a = b
+
+# -------------------------
+# EVENTOS FUTUROS (fila em heap no state)
+# -------------------------
+# Garantia (data_reclamacao = venda + N dias) e teste de qualidade
+# (data_teste = fim do lote + 10 min) acontecem depois do passo que os gerou.
+# Em vez de cair na partição do run (e o hot layer carregar o "futuro"), a
+# linha vai pro heap state["eventos_pendentes"] e só sai no passo que cobre
+# `quando`: cada passo tira apenas o que venceu, O(k log n).
+# seq desempata pela ordem de agendamento; no backfill paralelo quem agenda e
+# libera é o pai, dia a dia em ordem, então a saída não depende dos workers.
+# O heap do state é do incremental; cada job de backfill tem o seu (vai no
+# checkpoint, ver ESTADO_POR_JOB). No fim do job, o que sobrou e já aconteceu
+# (antes da fronteira do incremental) é gravado na partição do próprio
+# `quando`; o que ainda não aconteceu passa pro heap do incremental e sai no
+# passo que o cobre. Nenhuma partição dt= de dia futuro é escrita.
+TABELAS_EVENTO = {"raw_garantia": "data_reclamacao", "raw_qualidade": "data_teste"}
+
+def agendar_eventos(state: dict, batch: RowBatch, ate: datetime) -> RowBatch:
+    """Manda pro heap as linhas com `quando` >= ate; devolve as que já aconteceram."""
+    if not batch:
+        return batch
+    limite = ate.strftime("%Y-%m-%d %H:%M:%S")
+    quando = batch.valores(TABELAS_EVENTO[batch.table])
+    futuro = np.array(quando) >= limite
+    if not futuro.any():
+        return batch
+
+    idx = np.flatnonzero(futuro)
+    heap = state["eventos_pendentes"]
+    for i, linha in zip(idx.tolist(), batch.select(idx).rows()):
+        state["seq_eventos"] += 1
+        heapq.heappush(heap, [quando[i], state["seq_eventos"], batch.table, linha])
+    return batch.select(np.flatnonzero(~futuro))
+
+def eventos_vencidos(state: dict, ate: datetime) -> dict:
+    """Tira do heap tudo com `quando` < ate. Retorna {tabela: [linhas]} em ordem de ocorrência."""
+    limite = ate.strftime("%Y-%m-%d %H:%M:%S")
+    heap = state["eventos_pendentes"]
+    out = {t: [] for t in TABELAS_EVENTO}
+    while heap and heap[0][0] < limite:
+        _, _, tabela, linha = heapq.heappop(heap)
+        out[tabela].append(linha)
+    return out
+
+def liberar_eventos(state: dict, tabelas: dict, ate: datetime) -> dict:
+    """
+    Fecha um passo [.., ate): agenda o que ainda não aconteceu e anexa às
+    tabelas de evento o que venceu (pendentes antigos primeiro).
+    """
+    vencidos = eventos_vencidos(state, ate)
+    for t in TABELAS_EVENTO:
+        atuais = agendar_eventos(state, tabelas[t], ate)
+        tabelas[t] = RowBatch.concat(t, [RowBatch.from_rows(t, vencidos[t]), atuais])
+    return tabelas
+
+def fronteira_incremental(state: dict, agora: datetime) -> datetime:
+    """Início do próximo passo do incremental (watermark + 1h; sem watermark, a hora atual)."""
+    wm = state.get("watermark")
+    if not wm:
+        return hora_cheia(agora.astimezone(TZ_BR))
+    return datetime.fromisoformat(wm).astimezone(TZ_BR) + timedelta(hours=1)
+
+def descarregar_eventos(state: dict, writer: "PartitionWriter", counts: dict, ate: datetime) -> list:
+    """
+    Esvazia o heap: o que tem `quando` < ate vai pro writer, na partição do dia
+    do seu `quando`. Devolve o resto ([quando, tabela, linha], em ordem).
+    """
+    chaves = {t: k for k, t in TABELAS_FATO}
+    limite = ate.strftime("%Y-%m-%d %H:%M:%S")
+    heap = state["eventos_pendentes"]
+    por_dia, restantes = {}, []
+    while heap:
+        quando, _, tabela, linha = heapq.heappop(heap)
+        if quando < limite:
+            por_dia.setdefault((quando[:10], tabela), []).append(linha)
+        else:
+            restantes.append([quando, tabela, linha])
+    for (dia, tabela), linhas in por_dia.items():
+        writer.add(tabela, RowBatch.from_rows(tabela, linhas), data_br(dia))
+        counts[chaves[tabela]] += len(linhas)
+    return restantes
+
+def adotar_eventos(state: dict, eventos: list) -> None:
+    """Agenda no heap do state eventos [quando, tabela, linha] vindos de outra linha do tempo."""
+    for quando, tabela, linha in eventos:
+        state["seq_eventos"] += 1
+        heapq.heappush(state["eventos_pendentes"], [quando, state["seq_eventos"], tabela, linha])
+
+# -------------------------
+# ESTOQUE DE MATÉRIA-PRIMA (FIFO)
+# -------------------------
+# Compras entram como camadas no state["estoque"]; cada lote consome a receita
+# (CONSUMO_MP_POR_UNIDADE x quantidade_produzida x capacidade/60 Ah) das
+# camadas mais antigas, e raw_map_lote_compras sai desse consumo real.
+# Qual material e quanto comprar é decisão de reposição (material de menor
+# saldo até ESTOQUE_ALVO_MP), então o volume comprado acompanha a produção e
+# o estoque no state fica limitado. Sequencial: roda no pai, dia a dia.
+# O razão é de cada linha do tempo: o do state é do incremental e cada job de
+# backfill tem o seu (ESTADO_POR_JOB), senão um lote de 2023 consumiria
+# compras de 2026.
+def coluna_numerica(batch: RowBatch, nome: str) -> np.ndarray:
+    col = batch.cols[nome]
+    if isinstance(col, np.ndarray):
+        return col
+    return np.asarray(batch.valores(nome), dtype=float)
+
+def receita_lotes(producao: RowBatch, materias: list[str]) -> np.ndarray:
+    """Consumo (lotes x materiais), inteiro, de cada ordem de produção."""
+    escala = {p["produto_id"]: float(p["capacidade_ah"]) / 60.0 for p in DADOS_ESTATICOS["raw_produto"]}
+    unidades = coluna_numerica(producao, "quantidade_produzida").astype(float)
+    fator = np.array([escala.get(p, 1.0) for p in producao.valores("produto_id")])
+    por_unidade = np.array([CONSUMO_MP_POR_UNIDADE[m] for m in materias])
+    return np.ceil((unidades * fator)[:, None] * por_unidade[None, :]).astype(np.int64)
+
+def movimentar_estoque(state: dict, tabelas: dict) -> dict:
+    """
+    Passa as compras e a produção do passo pelo estoque, em ordem de tempo
+    (compra antes do lote no mesmo instante). Reescreve material/quantidade/
+    custo_total das compras e preenche raw_map_lote_compras.
+    """
+    estoque = state["estoque"]
+    compras, prod = tabelas["raw_compras"], tabelas["raw_producao"]
+    materias = list(CONSUMO_MP_POR_UNIDADE)
+
+    n_c = len(compras)
+    datas_c = compras.valores("data_compra") if n_c else []
+    nums_c = [int(c[2:]) for c in compras.valores("compra_id")] if n_c else []
+    mats_c, qtds_c = [None] * n_c, [0] * n_c
+
+    def repor(i):
+        mp = min(materias, key=estoque.saldo)
+        q = int(min(COMPRA_MAX_MP, max(COMPRA_MIN_MP, ESTOQUE_ALVO_MP - estoque.saldo(mp))))
+        estoque.entrada(mp, nums_c[i], q)
+        mats_c[i], qtds_c[i] = mp, q
+
+    m_lote, m_compra, m_mp, m_qtd = [], [], [], []
+    i = 0
+    if prod:
+        receita = receita_lotes(prod, materias).tolist()
+        inicios, lote_ids = prod.valores("inicio"), prod.valores("lote_id")
+        for k, lid in enumerate(lote_ids):
+            while i < n_c and datas_c[i] <= inicios[k]:
+                repor(i)
+                i += 1
+            for j, mp in enumerate(materias):
+                for num, q in estoque.consumir(mp, receita[k][j]):
+                    m_lote.append(lid)
+                    m_compra.append(num)
+                    m_mp.append(j)
+                    m_qtd.append(q)
+    while i < n_c:
+        repor(i)
+        i += 1
+
+    if n_c:
+        custo_unit = coluna_numerica(compras, "custo_unitario").tolist()
+        cols = dict(compras.cols)
+        cols["materia_prima_id"] = mats_c
+        cols["quantidade_comprada"] = qtds_c
+        cols["custo_total"] = [round(q * c, 2) for q, c in zip(qtds_c, custo_unit)]
+        tabelas["raw_compras"] = RowBatch("raw_compras", n_c, cols)
+
+    tabelas["raw_map_lote_compras"] = RowBatch("raw_map_lote_compras", len(m_lote), {
+        "lote_id": m_lote,
+        "compra_id": FmtCol("CP%06d", np.array(m_compra, dtype=np.int64)),
+        "materia_prima_id": CatCol(materias, np.array(m_mp, dtype=np.int64)),
+        "quantidade_consumida": np.array(m_qtd, dtype=np.int64),
+    })
+    return tabelas
+
+# -------------------------
+# DETECTOR DE ANOMALIAS (EWMA por máquina)
+# -------------------------
+# Cada ordem de produção é uma leitura da máquina (médias de temperatura e
+# vibração). A leitura é pontuada contra a média/variância EWMA da própria
+# máquina (state["detector"]) e depois entra nela: O(1) por leitura, em
+# arrays da frota, tick a tick. |z| >= DETECTOR_Z_WARN vira WARN, >=
+# DETECTOR_Z_CRITICO (ou acima de DETECTOR_LIMITES) vira CRITICO. Por
+# acompanhar a máquina, pega desvio relativo ao histórico dela (e deriva
+# brusca), não só o limite fixo. Sequencial: roda no pai, passo a passo.
+# A estatística segue uma linha do tempo contínua: a do state é do
+# incremental e cada job de backfill tem a sua (ESTADO_POR_JOB); o salto de
+# desgaste entre anos não vira WARN.
+def detectar_anomalias(state: dict, producao: RowBatch) -> RowBatch:
+    if not producao:
+        return RowBatch.vazio("monitoramento_alertas")
+    det = state["detector"]
+    metricas = list(DETECTOR_METRICAS)
+    x = np.column_stack([coluna_numerica(producao, DETECTOR_METRICAS[m]).astype(float) for m in metricas])
+    limites = np.array([DETECTOR_LIMITES.get(m, np.inf) for m in metricas])
+
+    maq_cats, maq_cod = codificar_coluna(producao, "maquina_id")
+    maq_j = det.indices(maq_cats)[maq_cod]
+    ini_cats, ini_cod = codificar_coluna(producao, "inicio")
+
+    # leituras agrupadas por tick em ordem de tempo (1 por máquina em cada grupo)
+    tick = np.argsort(np.argsort(ini_cats))[ini_cod]  # posição cronológica do tick ("%Y-%m-%d %H:%M:%S")
+    ordem = np.argsort(tick, kind="stable")
+    corte = np.flatnonzero(np.diff(tick[ordem])) + 1
+
+    z = np.full(x.shape, np.nan)
+    n_antes = np.zeros(len(x), dtype=np.int64)
+    for g in np.split(ordem, corte):
+        z[g], n_antes[g] = det.pontuar(maq_j[g], x[g])
+    z[n_antes < DETECTOR_AQUECIMENTO] = np.nan
+
+    # métrica mais fora do padrão de cada leitura
+    az = np.where(np.isnan(z), 0.0, np.abs(z))
+    fora = x > limites[None, :]
+    k = np.argmax(np.where(fora, np.inf, az), axis=1)
+    linhas = np.arange(len(x))
+    pior = az[linhas, k]
+    critico = fora.any(axis=1) | (pior >= DETECTOR_Z_CRITICO)
+    alerta = critico | (pior >= DETECTOR_Z_WARN)
+
+    idx = ordem[alerta[ordem]]  # ordem de tempo
+    n = len(idx)
+    cnt = state["cnt_alerta"]
+    state["cnt_alerta"] = cnt + n
+    if not n:
+        return RowBatch.vazio("monitoramento_alertas")
+
+    inicios = [datetime.strptime(c, "%Y-%m-%d %H:%M:%S").replace(tzinfo=TZ_BR) for c in ini_cats]
+    kk = k[idx]
+    zz = np.round(z[idx, kk], 2)
+    valor = x[idx, kk]
+    return RowBatch("monitoramento_alertas", n, {
+        "alerta_id": FmtCol("ALT%07d", np.arange(cnt + 1, cnt + n + 1)),
+        "data_ocorrencia": [inicios[c] for c in ini_cod[idx].tolist()],  # TIMESTAMP
+        "nivel": CatCol(["WARN", "CRITICO"], critico[idx].astype(np.int8)),
+        "maquina_id": CatCol(maq_cats, maq_cod[idx]),
+        "mensagem": [f"Anomalia {metricas[m]}: {v:g} (z={zv:+.2f})" if not np.isnan(zv) else
+                     f"Anomalia {metricas[m]}: {v:g} acima do limite"
+                     for m, v, zv in zip(kk.tolist(), valor.tolist(), zz.tolist())],
+        "valor_medido": valor,
+        "metrica": CatCol(metricas, kk),
+        "z_score": [None if np.isnan(v) else v for v in zz.tolist()],
+    })
+
+def fechar_passo(state: dict, tabelas: dict, ate: datetime) -> dict:
+    """
+    Estado sequencial de um passo [.., ate): estoque FIFO, detector de
+    anomalias (monitoramento_alertas) e fila de eventos futuros.
+    """
+    tabelas = movimentar_estoque(state, tabelas)
+    tabelas["monitoramento_alertas"] = detectar_anomalias(state, tabelas["raw_producao"])
+    return liberar_eventos(state, tabelas, ate)
+
+# -------------------------
+# BACKFILL PARALELO (RNG determinística por dia)
+# -------------------------
+# Cada dia tem seu próprio stream (SeedSequence keyed por seed do state + data):
+#   stream 0 -> plano do dia (quantos clientes/compras/garantias/manutenções)
+#   stream 1 -> todo o resto da geração do dia
+# Com o plano, o pai reserva os blocos de contadores de cada dia antes de
+# despachar os shards, então a saída não depende do nº de workers.
+# Obs.: a janela anti-monopólio (ultimos_clientes) é local a cada dia.
+# Granularidade "hora": o dia vira 24 ticks horários (compras/manutenção
+# sorteadas por hora, produção/lotes/qualidade numa grade 24 x máquinas).
+CONTADORES = ["cnt_op", "cnt_lote", "cnt_venda", "cnt_compra", "cnt_cliente", "cnt_garantia", "cnt_manut"]
+
+TABELAS_FATO = [
+    ("cli", "raw_cliente"),
+    ("comp", "raw_compras"),
+    ("map", "raw_map_lote_compras"),
+    ("prod", "raw_producao"),
+    ("lote", "raw_lote"),
+    ("qual", "raw_qualidade"),
+    ("vend", "raw_vendas"),
+    ("gar", "raw_garantia"),
+    ("man", "raw_manutencao"),
+    ("alt", "monitoramento_alertas"),
+]
+
+def rng_dia(seed: int, dia: datetime, stream: int) -> np.random.Generator:
+    ss = np.random.SeedSequence(entropy=int(seed), spawn_key=(dia.date().toordinal(), stream))
+    return np.random.default_rng(ss)
+
+def ticks_dia(dia: datetime, granularidade: str) -> list[datetime]:
+    if granularidade == "hora":
+        return [dia + timedelta(hours=h) for h in range(24)]
+    return [dia]
+
+def plano_dia(seed: int, dia: datetime, fleet: list[dict], sem_clientes: bool,
+              granularidade: str = "dia", paradas: CalendarioParadas = None) -> dict:
+    """
+    Sorteia as contagens do dia (stream 0) e devolve os incrementos de cada contador.
+    As manutenções do dia entram em `paradas` aqui, no pai e em ordem de dia:
+    os lotes de cada tick já descontam as máquinas paradas (inclusive por
+    janelas que vêm do dia anterior).
+    """
+    rng = rng_dia(seed, dia, 0)
+    ticks = ticks_dia(dia, granularidade)
+
+    cli = min(int(rng.poisson(0.25 * 24)), CLIENTES_MAX_POR_PASSO)
+    comp = []
+    for tick in ticks:
+        comp.append(int(rng.integers(1, 5)) if rng.random() < prob_compra(tick) else 0)
+    man = sortear_manutencoes(ticks, fleet, rng)
+
+    lotes = [len(fleet)] * len(ticks)
+    if paradas is not None:
+        registrar_manutencoes(paradas, ticks, fleet, man)
+        parada, _ = paradas.consultar(frota_arrays(fleet)[0], ticks)
+        lotes = (len(fleet) - parada.sum(axis=1)).tolist()
+    venda = sum(vendas_por_tick(k) for k in lotes)
+    gar = (rng.random(venda) < TAXA_GARANTIA).tolist()
+
+    return {
+        "granularidade": granularidade,
+        "qtd_clientes": cli,
+        "qtd_compras": comp,  # por tick
+        "garantias": gar,
+        "manutencao": man,  # por tick: índices das máquinas na frota
+        "lotes_por_tick": lotes,
+        "inc": {
+            "cnt_op": sum(lotes),
+            "cnt_lote": sum(lotes),
+            "cnt_venda": venda,
+            "cnt_compra": sum(comp),
+            "cnt_cliente": cli + (1 if sem_clientes else 0),  # + cliente fundador
+            "cnt_garantia": sum(gar),
+            "cnt_manut": sum(len(m) for m in man),
+        },
+    }
+
+def gerar_dia_horario(dia: datetime, state: dict, fleet: list[dict], plano: dict = None, rng=None) -> dict:
+    """
+    Um dia em 24 ticks horários (mesmo formato do incremental): produção,
+    lotes e qualidade saem de uma grade 24 x máquinas numa chamada só;
+    compras/manutenção por hora, vendas/garantias sobre o dia inteiro.
+    Sem `plano`, sorteia as contagens no RNG global (backfill sequencial).
+    raw_map_lote_compras e os alertas saem depois (fechar_passo).
+    """
+    ticks = ticks_dia(dia, "hora")
+
+    # manutenções antes da produção: o plano já registrou as paradas no calendário
+    if plano:
+        man = plano["manutencao"]
+    else:
+        man = sortear_manutencoes(ticks, fleet)
+        registrar_manutencoes(state["paradas"], ticks, fleet, man)
+
+    cli = gen_clientes(dia, state, passo_horas=24, qtd_novos=plano["qtd_clientes"] if plano else None)
+    if fleet:
+        prod, lotes, qual, corte = _producao_grade(ticks, state, fleet, rng=rng)
+    else:
+        prod, lotes, qual = gen_producao_grade(ticks, state, fleet, rng=rng)
+        corte = [0] * (len(ticks) + 1)
+
+    comps, mans = [], []
+    for t, tick in enumerate(ticks):
+        comps.append(gen_compras(tick, state, qtd=plano["qtd_compras"][t] if plano else None))
+        mans.append(gen_manutencao(tick, state, fleet, maquinas=man[t]))
+
+    lotes_por_tick = np.diff(corte).tolist()
+    vend = gen_vendas(dia, state, lotes, prod, lotes_por_tick=lotes_por_tick)
+    # garantia conta da hora da venda (tick do lote vendido), não da meia-noite
+    tick_venda = np.repeat(np.arange(len(ticks)), [vendas_por_tick(k) for k in lotes_por_tick])
+    gar = gen_garantia(dia, state, vend, acionadas=plano["garantias"] if plano else None,
+                       quando_vendas=[ticks[t] for t in tick_venda.tolist()] if vend else None)
+
+    return {
+        "raw_cliente": cli,
+        "raw_compras": RowBatch.concat("raw_compras", comps),
+        "raw_producao": prod,
+        "raw_lote": lotes,
+        "raw_qualidade": qual,
+        "raw_vendas": vend,
+        "raw_garantia": gar,
+        "raw_manutencao": RowBatch.concat("raw_manutencao", mans),
+    }
+
+def gerar_dia(seed: int, dia: datetime, state: dict, fleet: list[dict], plano: dict) -> dict:
+    """
+    Gera um dia inteiro com o stream 1 do dia. Retorna {tabela: RowBatch}
+    (sem raw_map_lote_compras e alertas: estoque e detector são sequenciais
+    e ficam com o pai).
+    """
+    rng = rng_dia(seed, dia, 1)
+    semear_rng(int(rng.integers(0, 2**63 - 1)))
+
+    if plano["granularidade"] == "hora":
+        state["ultimos_clientes"] = []
+        return gerar_dia_horario(dia, state, fleet, plano, rng=rng)
+
+    cli = gen_clientes(dia, state, passo_horas=24, qtd_novos=plano["qtd_clientes"])
+    comp = gen_compras(dia, state, qtd=plano["qtd_compras"][0])
+
+    prod, lotes, qual = gen_producao_lote([dia], state, fleet, rng=rng)[0]
+
+    state["ultimos_clientes"] = []
+    vend = gen_vendas(dia, state, lotes, prod)
+
+    gar = gen_garantia(dia, state, vend, acionadas=plano["garantias"])
+    man = gen_manutencao(dia, state, fleet, maquinas=plano["manutencao"][0])
+
+    return {
+        "raw_cliente": cli,
+        "raw_compras": comp,
+        "raw_producao": prod,
+        "raw_lote": lotes,
+        "raw_qualidade": qual,
+        "raw_vendas": vend,
+        "raw_garantia": gar,
+        "raw_manutencao": man,
+    }
+
+def gerar_horas(ticks: list[datetime], state: dict, fleet: list[dict]) -> list[dict]:
+    """
+    Incremental: uma hora por tick (RNG global), produção da frota vetorizada
+    nos ticks. Retorna {tabela: RowBatch} por tick, já com fechar_passo.
+    """
+    # manutenção decidida antes da produção: máquina parada não gera lote
+    if ticks:
+        state["paradas"].podar(ticks[0])
+    manutencoes = sortear_manutencoes(ticks, fleet)
+    registrar_manutencoes(state["paradas"], ticks, fleet, manutencoes)
+    producoes = gen_producao_lote(ticks, state, fleet)
+
+    passos = []
+    for cur, (prod, lotes, qual), maqs in zip(ticks, producoes, manutencoes):
+        cli = gen_clientes(cur, state, passo_horas=1)
+        comp = gen_compras(cur, state)
+
+        vend = gen_vendas(cur, state, lotes, prod)
+
+        gar = gen_garantia(cur, state, vend)
+        man = gen_manutencao(cur, state, fleet, maquinas=maqs)
+
+        # estoque (compras -> lotes), alertas do detector e garantia/teste de qualidade na hora em que acontecem
+        passos.append(fechar_passo(state, {
+            "raw_cliente": cli,
+            "raw_compras": comp,
+            "raw_producao": prod,
+            "raw_lote": lotes,
+            "raw_qualidade": qual,
+            "raw_vendas": vend,
+            "raw_garantia": gar,
+            "raw_manutencao": man,
+        }, cur + timedelta(hours=1)))
+    return passos
+
+def backfill_shard(job: dict) -> list:
+    """
+    Worker: gera um bloco contíguo de dias a partir dos contadores reservados
+    pelo pai. Roda em processo separado (ProcessPoolExecutor) ou inline.
+    """
+    seed = job["seed"]
+    fleet = job["fleet"]
+    cnt0 = job["cnt_cliente_base"]
+
+    # base de clientes no início do shard = base do state + criados antes do shard
+    clientes = job["clientes_base"].copy()
+    clientes.estender_faixa(cnt0 + 1, job["offsets"][0]["cnt_cliente"])
+
+    out = []
+    for dia, offs, plano in zip(job["dias"], job["offsets"], job["planos"]):
+        st = dict(offs)
+        st["clientes"] = clientes
+        st["paradas"] = job["paradas"]
+        tabelas = gerar_dia(seed, dia, st, fleet, plano)
+
+        for k in CONTADORES:
+            esperado = offs[k] + plano["inc"][k]
+            if st[k] != esperado:
+                raise RuntimeError(f"{k} fora do bloco reservado em {dia.date()}: {st[k]} != {esperado}")
+
+        out.append((dia, tabelas))
+    return out
+
+def contagens_backfill(telemetria: int = 0) -> dict:
+    counts = {k: 0 for k, _ in TABELAS_FATO}
+    if telemetria:
+        counts["tele"] = 0
+    return counts
+
+def gravar_passo(writer: "PartitionWriter", tabelas: dict, dia: datetime, counts: dict,
+                 fleet: list[dict], telemetria: int = 0, seed: int = 0) -> None:
+    """Bufferiza as tabelas do passo no writer; telemetria vai em streaming (parquet)."""
+    for k, t in TABELAS_FATO:
+        writer.add(t, tabelas[t], dia)
+        counts[k] += len(tabelas[t])
+    if telemetria:
+        counts["tele"] += writer.stream(
+            "raw_telemetria", gen_telemetria(tabelas["raw_producao"], fleet, telemetria, seed), dia
+        )
+
+def backfill_paralelo(state: dict, fleet: list[dict], dt1: datetime, dt2: datetime,
+                      writer: "PartitionWriter", workers: int, granularidade: str = "dia",
+                      seed: int = None, telemetria: int = 0) -> dict:
+    """
+    Backfill determinístico por dia, fatiado em shards de BLOCO_DIAS_PARALELO
+    dias entre `workers` processos. Mesma saída para qualquer nº de workers.
+    telemetria > 0: raw_telemetria nessa resolução (s), gerada e gravada no pai.
+    """
+    seed = int(state["seed"] if seed is None else seed)
+    dias = []
+    cur = dt1
+    while cur <= dt2:
+        dias.append(cur)
+        cur += timedelta(days=1)
+
+    # 1) planos + reserva de contadores + paradas de manutenção (sequencial e barato)
+    cont = {k: int(state[k]) for k in CONTADORES}
+    n_cli = len(state["clientes"])
+    state["paradas"].podar(dt1)
+    planos, offsets = [], []
+    for dia in dias:
+        plano = plano_dia(seed, dia, fleet, sem_clientes=(n_cli == 0), granularidade=granularidade,
+                          paradas=state["paradas"])
+        planos.append(plano)
+        offsets.append(dict(cont))
+        for k in CONTADORES:
+            cont[k] += plano["inc"][k]
+        n_cli += plano["inc"]["cnt_cliente"]
+
+    jobs = []
+    for i in range(0, len(dias), BLOCO_DIAS_PARALELO):
+        jobs.append({
+            "seed": seed,
+            "fleet": fleet,
+            "clientes_base": state["clientes"],
+            "cnt_cliente_base": int(state["cnt_cliente"]),
+            "paradas": state["paradas"],
+            "dias": dias[i:i + BLOCO_DIAS_PARALELO],
+            "offsets": offsets[i:i + BLOCO_DIAS_PARALELO],
+            "planos": planos[i:i + BLOCO_DIAS_PARALELO],
         })
 
-    return rows
+    # 2) geração (em ordem; map preserva a ordem dos shards)
+    counts = contagens_backfill(telemetria)
+    ultimos = list(state.get("ultimos_clientes", []))
+
+    def consumir(resultado):
+        for dia, tabelas in resultado:
+            fechar_passo(state, tabelas, dia + timedelta(days=1))
+            gravar_passo(writer, tabelas, dia, counts, fleet, telemetria, seed)
+            ultimos.extend(c for c in tabelas["raw_vendas"].valores("cliente_id") if c)
+            del ultimos[:-ULTIMOS_CLIENTES_JANELA]
+
+    workers = max(1, min(int(workers), BACKFILL_MAX_WORKERS, len(jobs) or 1))
+    if workers == 1:
+        for job in jobs:
+            consumir(backfill_shard(job))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            for resultado in ex.map(backfill_shard, jobs):
+                consumir(resultado)
+
+    # 3) aplica no state
+    state["clientes"].estender_faixa(int(state["cnt_cliente"]) + 1, cont["cnt_cliente"])
+    for k in CONTADORES:
+        state[k] = cont[k]
+    state["ultimos_clientes"] = ultimos
+
+    return counts
+
+def backfill_sequencial(state: dict, fleet: list[dict], dt1: datetime, dt2: datetime,
+                        writer: "PartitionWriter", granularidade: str = "dia",
+                        seed: int = None, telemetria: int = 0) -> dict:
+    """Backfill no RNG global (seed do state), dia a dia de dt1 até dt2 inclusive."""
+    seed = int(state["seed"] if seed is None else seed)
+    cur = dt1
+    counts = contagens_backfill(telemetria)
+    state["paradas"].podar(dt1)
+
+    # ?granularidade=hora -> 24 ticks/dia, produção do dia numa grade só
+    if granularidade == "hora":
+        while cur <= dt2:
+            tabelas = fechar_passo(state, gerar_dia_horario(cur, state, fleet), cur + timedelta(days=1))
+            gravar_passo(writer, tabelas, cur, counts, fleet, telemetria, seed)
+            cur += timedelta(days=1)
+
+    while cur <= dt2:
+        # produção da frota em blocos de dias (vetorizado)
+        bloco = []
+        while cur <= dt2 and len(bloco) < BLOCO_TICKS_PRODUCAO:
+            bloco.append(cur)
+            cur += timedelta(days=1)
+        manutencoes = sortear_manutencoes(bloco, fleet)
+        registrar_manutencoes(state["paradas"], bloco, fleet, manutencoes)
+        producoes = gen_producao_lote(bloco, state, fleet)
+
+        for dia, (prod, lotes, qual), maqs in zip(bloco, producoes, manutencoes):
+            cli = gen_clientes(dia, state, passo_horas=24)
+            comp = gen_compras(dia, state)
+
+            vend = gen_vendas(dia, state, lotes, prod)
+
+            gar = gen_garantia(dia, state, vend)
+            man = gen_manutencao(dia, state, fleet, maquinas=maqs)
+
+            tabelas = fechar_passo(state, {
+                "raw_cliente": cli,
+                "raw_compras": comp,
+                "raw_producao": prod,
+                "raw_lote": lotes,
+                "raw_qualidade": qual,
+                "raw_vendas": vend,
+                "raw_garantia": gar,
+                "raw_manutencao": man,
+            }, dia + timedelta(days=1))
+
+            # bufferiza tudo pro lake (GCS); upload por tamanho/partição
+            gravar_passo(writer, tabelas, dia, counts, fleet, telemetria, seed)
+
+    return counts
+
+# -------------------------
+# BACKFILL RESUMÍVEL (checkpoints por job)
+# -------------------------
+# A cada N dias simulados (segmento):
+#   1) writer.flush_all()  -> part-files do segmento já estão no GCS
+#   2) checkpoint state/backfill/<job>.json ganha o segmento (URIs, cursor, contadores)
+#   3) store.save(state) com state["backfill_jobs"][job] = {cursor, seq}  -> commit
+# Se a request morre entre 2 e 3, o segmento está no checkpoint mas não no
+# state: o ?resume=<job> apaga esses part-files órfãos e regera a partir do
+# cursor commitado (sem duplicar nem pular dias).
+# A seed é a do job (não a da request): cada segmento sequencial re-semeia o
+# RNG global a partir dela (stream 2 do 1º dia), então retomar gera os mesmos
+# dados que a execução sem interrupção.
+# O estado sequencial de linha do tempo (ESTADO_POR_JOB) é de cada job: começa
+# vazio no start, entra no state só enquanto o segmento gera e sai no
+# checkpoint do segmento ("estado"); o retomar parte do último commitado.
+ESTADO_POR_JOB = ("eventos_pendentes", "seq_eventos", "estoque", "detector")
+
+def data_br(s: str) -> datetime:
+    return datetime.strptime(s, "%Y-%m-%d").replace(tzinfo=TZ_BR)
+
+def estado_job(dados: dict | None) -> dict:
+    """Estado sequencial do job a partir do checkpoint (None -> vazio, como no start)."""
+    base = default_state()
+    estado = {k: (dados or {}).get(k, base[k]) for k in ESTADO_POR_JOB}
+    estado["eventos_pendentes"] = [list(e) for e in estado["eventos_pendentes"]]
+    heapq.heapify(estado["eventos_pendentes"])
+    estado["estoque"] = EstoqueMateriais.from_state(estado["estoque"])
+    estado["detector"] = DetectorAnomalias.from_state(estado["detector"])
+    return estado
+
+def estado_job_to_dict(estado: dict) -> dict:
+    dados = {k: estado[k] for k in ESTADO_POR_JOB}
+    dados["estoque"] = EstoqueMateriais.from_state(estado["estoque"]).to_state()
+    dados["detector"] = DetectorAnomalias.from_state(estado["detector"]).to_state()
+    return dados
+
+def trocar_estado_job(state: dict, estado: dict) -> dict:
+    """Põe `estado` nas chaves de ESTADO_POR_JOB do state; devolve o que estava lá."""
+    antigo = {k: state[k] for k in ESTADO_POR_JOB}
+    state.update(estado)
+    return antigo
+
+def checkpoint_blob(sc: storage.Client, job: str):
+    return sc.bucket(BUCKET_NAME).blob(f"{BACKFILL_CHECKPOINT_PREFIX}{job}.json")
+
+def carregar_checkpoint(sc: storage.Client, job: str) -> dict | None:
+    try:
+        return json.loads(checkpoint_blob(sc, job).download_as_bytes())
+    except NotFound:
+        return None
+
+def salvar_checkpoint(sc: storage.Client, ck: dict) -> None:
+    ck["atualizado_em"] = datetime.now(TZ_BR).isoformat()
+    checkpoint_blob(sc, ck["job"]).upload_from_string(
+        json.dumps(ck, ensure_ascii=False, separators=(",", ":")),
+        content_type="application/json",
+    )
+
+def novo_checkpoint(job: str, params: dict) -> dict:
+    return {"job": job, "params": params, "cursor": params["start"], "status": "rodando", "segmentos": []}
+
+def apagar_uri(sc: storage.Client, uri: str) -> None:
+    bucket, nome = objeto_de_uri(sc, uri)
+    try:
+        sc.bucket(bucket).blob(nome).delete()
+    except NotFound:
+        pass
+
+def reconciliar_checkpoint(sc: storage.Client, ck: dict, state: dict) -> dict:
+    """Alinha o checkpoint ao último commit do job no state; apaga part-files de segmentos não commitados."""
+    info = state["backfill_jobs"].get(ck["job"])
+    if info is None:
+        if ck["status"] == "concluido":
+            return ck
+        info = {"cursor": ck["params"]["start"], "seq": 0}  # nem o registro inicial foi commitado
+
+    for seg in ck["segmentos"]:
+        if seg["seq"] > info["seq"]:
+            logging.warning("backfill %s: segmento %d não commitado, apagando %d objetos",
+                            ck["job"], seg["seq"], len(seg["uris"]))
+            for uri in seg["uris"]:
+                apagar_uri(sc, uri)
+
+    ck["segmentos"] = [seg for seg in ck["segmentos"] if seg["seq"] <= info["seq"]]
+    ck["cursor"] = info["cursor"]
+    ck["status"] = "rodando"
+    ck.pop("erro", None)
+    return ck
+
+def totais_checkpoint(ck: dict) -> tuple[int, dict]:
+    """(nº de objetos, contagens por tabela) somando os segmentos commitados."""
+    counts = {k: 0 for k, _ in TABELAS_FATO}
+    objetos = 0
+    for seg in ck["segmentos"]:
+        objetos += len(seg["uris"])
+        for k, v in seg["counts"].items():
+            counts[k] = counts.get(k, 0) + v
+    return objetos, counts
+
+def rodar_backfill(sc: storage.Client, store: StateStore, state: dict, fleet: list[dict],
+                   ck: dict, writer: "PartitionWriter", t0: float, crono: Cronometro = None) -> dict:
+    """
+    Gera segmentos de params["checkpoint"] dias a partir do cursor, com
+    checkpoint + save do state ao fim de cada um. Para no fim do intervalo
+    ou quando a request passa de BACKFILL_MAX_SEGUNDOS (status fica "rodando").
+    """
+    job, p = ck["job"], ck["params"]
+    dt2 = data_br(p["end"])
+    cur = data_br(ck["cursor"])
+    seq = ck["segmentos"][-1]["seq"] if ck["segmentos"] else 0
+    estado = estado_job(ck["segmentos"][-1].get("estado") if ck["segmentos"] else None)
+
+    while cur <= dt2:
+        t_seg, bytes0 = time.perf_counter(), writer.bytes
+        seg_fim = min(cur + timedelta(days=p["checkpoint"] - 1), dt2)
+        if p["particao"] == "mes":
+            # segmento não atravessa mês: cada partição mensal sobe num flush só
+            prox_mes = (cur.replace(day=1) + timedelta(days=32)).replace(day=1)
+            seg_fim = min(seg_fim, prox_mes - timedelta(days=1))
+        incremental = trocar_estado_job(state, estado)
+        futuros = []
+        try:
+            with medir(crono, "gerar", ate=seg_fim.date().isoformat()) as sp:
+                if p["workers"]:
+                    counts = backfill_paralelo(state, fleet, cur, seg_fim, writer, p["workers"],
+                                               p["granularidade"], seed=p["seed"],
+                                               telemetria=p.get("telemetria", 0))
+                else:
+                    rng = rng_dia(p["seed"], cur, 2)
+                    semear_rng(int(rng.integers(0, 2**63 - 1)), int(rng.integers(0, 2**32 - 1)))
+                    counts = backfill_sequencial(state, fleet, cur, seg_fim, writer, p["granularidade"],
+                                                 seed=p["seed"], telemetria=p.get("telemetria", 0))
+                if seg_fim >= dt2:
+                    fronteira = fronteira_incremental(state, datetime.now(TZ_BR))
+                    futuros = descarregar_eventos(state, writer, counts, fronteira)
+                sp["linhas"] = sum(counts.values())
+        finally:
+            estado = trocar_estado_job(state, incremental)
+        adotar_eventos(state, futuros)  # commitados junto com o último segmento
+        dias = (seg_fim - cur).days + 1
+        cur = seg_fim + timedelta(days=1)
+        seq += 1
+        uris = writer.flush_all()
+
+        ck["segmentos"].append({
+            "seq": seq,
+            "ate": seg_fim.date().isoformat(),
+            "dias": dias,
+            "uris": uris,
+            "counts": counts,
+            "bytes": writer.bytes - bytes0,
+            "segundos": round(time.perf_counter() - t_seg, 3),
+            "contadores": {k: int(state[k]) for k in CONTADORES},
+            "estado": estado_job_to_dict(estado),
+        })
+        for anterior in ck["segmentos"][:-2]:
+            anterior.pop("estado", None)  # só o último commitado (e o atual) importam pro retomar
+        ck["cursor"] = cur.date().isoformat()
+        ck["status"] = "concluido" if cur > dt2 else "rodando"
+        with medir(crono, "checkpoint", seq=seq):
+            salvar_checkpoint(sc, ck)
+
+            if ck["status"] == "concluido":
+                state["backfill_jobs"].pop(job, None)
+            else:
+                state["backfill_jobs"][job] = {"cursor": ck["cursor"], "seq": seq}
+            store.save(state)
+
+        if ck["status"] != "concluido" and time.perf_counter() - t0 > BACKFILL_MAX_SEGUNDOS:
+            logging.info("backfill %s: orçamento da request esgotado, parando em %s", job, ck["cursor"])
+            break
+
+    return ck
+
+def executar_job_backfill(sc: storage.Client, store: StateStore, state: dict, fleet: list[dict],
+                          ck: dict, run_id: str, t0: float, crono: Cronometro = None) -> dict:
+    """
+    Um trecho do job (até concluir ou estourar o orçamento) com um writer desta request.
+    StateConflict no commit de um segmento (o incremental gravou o state no
+    meio): recarrega o state, reconcilia o checkpoint (apaga o segmento não
+    commitado) e refaz do cursor commitado, até BACKFILL_MAX_CONFLITOS vezes.
+    Falha definitiva fica registrada no checkpoint (status "erro").
+    """
+    job, p = ck["job"], ck["params"]
+    writer = PartitionWriter(sc, run_id, particao=p["particao"], formato=p["formato"], crono=crono)
+    conflitos = 0
+    try:
+        while True:
+            try:
+                return rodar_backfill(sc, store, state, fleet, ck, writer, t0, crono)
+            except StateConflict as e:
+                conflitos += 1
+                if conflitos > BACKFILL_MAX_CONFLITOS:
+                    raise
+                logging.warning("backfill %s: state em conflito (%s), recarregando (%d/%d)",
+                                job, e, conflitos, BACKFILL_MAX_CONFLITOS)
+                store, state = load_state(sc)
+                ck = reconciliar_checkpoint(sc, carregar_checkpoint(sc, job), state)
+    except Exception as e:
+        registrar_erro_backfill(sc, job, e)
+        raise
+    finally:
+        writer.close()
+
+def registrar_erro_backfill(sc: storage.Client, job: str, erro: Exception) -> None:
+    """Marca o checkpoint com status "erro" (o ?resume=<job> volta pra "rodando")."""
+    try:
+        ck = carregar_checkpoint(sc, job)
+        if ck:
+            ck["status"] = "erro"
+            ck["erro"] = f"{type(erro).__name__}: {erro}"
+            salvar_checkpoint(sc, ck)
+    except Exception:
+        logging.exception("backfill %s: falha ao registrar erro no checkpoint", job)
+
+# -------------------------
+# BACKFILL ASSÍNCRONO (?async=1 -> 202 + ?mode=status&job=)
+# -------------------------
+def disparar_backfill(job: str) -> None:
+    """
+    Continua o job fora da request atual. Com BACKFILL_SELF_URL, dispara uma
+    request ?mode=backfill&resume=<job> pro próprio serviço (cada uma roda até
+    BACKFILL_MAX_SEGUNDOS e encadeia a próxima); sem ela, roda numa thread.
+    """
+    if not BACKFILL_SELF_URL:
+        threading.Thread(target=continuar_backfill, args=(job,), name=f"backfill-{job}").start()
+        return
+
+    import socket
+    import urllib.request
+
+    url = f"{BACKFILL_SELF_URL.rstrip('/')}/?mode=backfill&resume={job}"
+    req = urllib.request.Request(url)
+    try:
+        # Cloud Run autenticado: ID token da service account (metadata server)
+        import google.auth.transport.requests
+        import google.oauth2.id_token
+        token = google.oauth2.id_token.fetch_id_token(google.auth.transport.requests.Request(), BACKFILL_SELF_URL)
+        req.add_header("Authorization", f"Bearer {token}")
+    except Exception as e:
+        logging.warning("backfill %s: sem ID token pro self-invoke (%s)", job, e)
+
+    try:
+        urllib.request.urlopen(req, timeout=BACKFILL_DISPARO_TIMEOUT).close()
+    except (socket.timeout, TimeoutError):
+        pass  # esperado: a request de resume segue rodando no serviço
+    except Exception as e:
+        logging.error("backfill %s: falha ao encadear resume: %s", job, e)
+
+def continuar_backfill(job: str) -> None:
+    """Thread do modo assíncrono local: retoma o job até concluir; erro fica registrado no checkpoint."""
+    sc = gcs()
+    try:
+        while True:
+            store, state = load_state(sc)
+            ck = carregar_checkpoint(sc, job)
+            ck = reconciliar_checkpoint(sc, ck, state)
+            if ck["status"] == "concluido":
+                return
+            fleet = gen_fleet(state)
+            run_id = str(uuid.uuid4())
+            ck = executar_job_backfill(sc, store, state, fleet, ck, run_id, time.perf_counter(),
+                                       Cronometro(run_id, "backfill"))
+    except Exception as e:
+        logging.exception("backfill %s falhou", job)
+        registrar_erro_backfill(sc, job, e)
+
+def status_backfill(ck: dict) -> dict:
+    """Progresso do job a partir do checkpoint no bucket: dias, linhas por tabela, vazão e ETA."""
+    p = ck["params"]
+    segs = ck["segmentos"]
+    dias_total = (data_br(p["end"]) - data_br(p["start"])).days + 1
+    dias_ok = sum(s.get("dias", 0) for s in segs)
+    segundos = sum(s.get("segundos", 0.0) for s in segs)
+    nbytes = sum(s.get("bytes", 0) for s in segs)
+    objetos, counts = totais_checkpoint(ck)
+    linhas = sum(counts.values())
+    por_tabela = {t: counts[k] for k, t in TABELAS_FATO}
+    if "tele" in counts:
+        por_tabela["raw_telemetria"] = counts["tele"]
+
+    eta = None
+    if ck["status"] != "concluido" and dias_ok and segundos:
+        eta = round((dias_total - dias_ok) * segundos / dias_ok, 1)
+
+    return {
+        "job": ck["job"],
+        "status": ck["status"],
+        "erro": ck.get("erro"),
+        "params": p,
+        "cursor": ck["cursor"],
+        "dias_concluidos": dias_ok,
+        "dias_total": dias_total,
+        "objetos": objetos,
+        "linhas": por_tabela,
+        "segundos": round(segundos, 3),
+        "linhas_por_s": round(linhas / segundos, 1) if segundos else None,
+        "bytes_por_s": round(nbytes / segundos, 1) if segundos else None,
+        "eta_s": eta,
+        "atualizado_em": ck.get("atualizado_em"),
+    }
 
 # -------------------------
 # MAIN HANDLER
@@ -955,23 +3861,103 @@ def gen_manutencao(dt: datetime, state: dict, fleet: list[dict]):
 @functions_framework.http
 def executar_simulacao(request):
     args = request.args or {}
+    run_id = str(uuid.uuid4())
+    crono = Cronometro(run_id, args.get("mode", "incremental").lower())
+
+    # ?profile=1 -> cProfile da request inteira, salvo ao lado da saída do run
+    perfil = None
+    if args.get("profile", "0") == "1":
+        import cProfile
+        perfil = cProfile.Profile()
+        perfil.enable()
+
+    try:
+        corpo, status = simular(request, run_id, crono)
+    except StateConflict as e:
+        # outra invocação gravou o state no meio desta: não sobrescreve contadores
+        logging.error("state em conflito: %s", e)
+        corpo, status = f"ERRO: state em conflito ({e}); tente novamente", 409
+    finally:
+        if perfil is not None:
+            perfil.disable()
+
+    # tempos por etapa: log estruturado + na resposta
+    resumo = crono.resumo()
+    logging.info(json.dumps({"evento": "resumo", "run_id": run_id, "mode": crono.mode, "status": status, **resumo},
+                            ensure_ascii=False))
+    if isinstance(corpo, str):
+        corpo += f" | perf={json.dumps(resumo, ensure_ascii=False, separators=(',', ':'))}"
+
+    if perfil is not None:
+        uri = salvar_profile(gcs(), perfil, run_id)
+        if isinstance(corpo, dict):
+            corpo["profile"] = uri
+        else:
+            corpo += f" | profile={uri}"
+
+    return corpo, status
+
+def simular(request, run_id: str = None, crono: Cronometro = None):
+    args = request.args or {}
+    run_id = run_id or str(uuid.uuid4())
 
     mode = args.get("mode", "incremental").lower()
     start = args.get("start")  # YYYY-MM-DD
     end = args.get("end")      # YYYY-MM-DD
+    particao = args.get("particao", BACKFILL_PARTICAO).lower()  # dia | mes (backfill)
+    formato = args.get("formato", FORMATO_BRONZE).lower()  # jsonl | parquet
+    workers = args.get("workers")  # backfill paralelo (opcional)
+    granularidade = args.get("granularidade", args.get("granularity", BACKFILL_GRANULARIDADE)).lower()
+    forcar_flush = args.get("flush", "0") == "1"  # carrega todo o hot layer pendente
+    resume = args.get("resume")  # job de backfill a continuar
+    assincrono = args.get("async", "0") == "1"  # backfill: responde 202 e segue em background
+    telemetria = args.get("telemetria", "1" if TELEMETRIA else "0") == "1"  # raw_telemetria (só lake)
+
+    if formato not in FORMATOS_BRONZE:
+        return "ERRO: formato deve ser 'jsonl' ou 'parquet'", 400
+
+    # telemetria: resolução em s (0 = desligada); sempre parquet -> exige pyarrow
+    if telemetria:
+        try:
+            telemetria = int(args.get("telemetria_resolucao", TELEMETRIA_RESOLUCAO_S))
+        except ValueError:
+            return "ERRO: telemetria_resolucao deve ser inteiro (segundos)", 400
+        if not 1 <= telemetria <= 3600:
+            return "ERRO: telemetria_resolucao deve estar entre 1 e 3600", 400
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return "ERRO: telemetria requer pyarrow instalado", 400
+    telemetria = int(telemetria)
+
+    if _COLD_START["pendente"]:
+        _COLD_START["pendente"] = False
+        logging.info("cold start: import do módulo em %.1f ms", _T_IMPORT_MS)
+
+    # status de job de backfill: só lê o checkpoint (não mexe no state)
+    if mode == "status":
+        job = args.get("job")
+        if not job:
+            return "ERRO: status requer ?mode=status&job=<id>", 400
+        ck = carregar_checkpoint(gcs(), job)
+        if ck is None:
+            return f"ERRO: backfill job={job} não encontrado", 404
+        return status_backfill(ck), 200
 
-    run_id = str(uuid.uuid4())
     sc = gcs()
-    state = load_state(sc)
+    with medir(crono, "load_state"):
+        store, state = load_state(sc)
 
     # seeds determinísticas por state
     state["seed"] = int(state.get("seed", 42)) + 1
-    
-    random.seed(state["seed"])
-    np.random.seed(state["seed"])
+    semear_rng(state["seed"], state["seed"])
 
-    bq_client = bq()
-    setup_bq(bq_client)
+    # backfill só grava no GCS: BQ só é necessário se ainda falta seed/static
+    bq_client = None
+    if usa_bq() and (mode != "backfill" or not state.get("clientes_seeded") or not state.get("static")):
+        with medir(crono, "setup_bq"):
+            bq_client = bq()
+            setup_bq(bq_client, state)
 
     # -------------------------
     # SEED inicial de clientes (1x)
@@ -979,8 +3965,9 @@ def executar_simulacao(request):
     now_seed = datetime.now(TZ_BR)
     seed_rows = seed_clientes_iniciais(state, now_seed)
     if seed_rows:
-        persist_table(sc, bq_client, now_seed, run_id, "raw_cliente", seed_rows)
-        save_state(sc, state)
+        persist_table(sc, bq_client, now_seed, run_id, "raw_cliente", seed_rows, formato, crono=crono)
+        with medir(crono, "save_state"):
+            store.save(state)
 
     # garante fleet e static 1x
     fleet = gen_fleet(state)
@@ -1004,113 +3991,142 @@ def executar_simulacao(request):
         }
 
         now = datetime.now(TZ_BR)
-        for t, rows in static_payloads.items():
-            persist_table(sc, bq_client, now, run_id, t, rows)
+        try:
+            persist_tables(sc, bq_client, now, run_id, static_payloads, formato=formato, crono=crono)
+        except PersistError as e:
+            return f"ERRO static run_id={run_id} | {e}", 500
 
         state["static"] = True
-        save_state(sc, state)
+        with medir(crono, "save_state"):
+            store.save(state)
 
     # -------------------------
     # BACKFILL (somente GCS)
     # -------------------------
     if mode == "backfill":
-        if not start or not end:
-            return "ERRO: backfill requer ?mode=backfill&start=YYYY-MM-DD&end=YYYY-MM-DD", 400
-
-        try:
-            dt1 = datetime.strptime(start, "%Y-%m-%d").replace(tzinfo=TZ_BR)
-            dt2 = datetime.strptime(end, "%Y-%m-%d").replace(tzinfo=TZ_BR)
-        except Exception:
-            return "ERRO: formato de data inválido. Use YYYY-MM-DD", 400
-
-        cur = dt1
-        counts = {k: 0 for k in ["cli", "comp", "map", "prod", "lote", "qual", "vend", "gar", "man", "alt"]}
-
-        while cur <= dt2:
-            cli = gen_clientes(cur, state, passo_horas=24)
-            comp = gen_compras(cur, state)
-
-            prod, lotes, qual, alt = gen_producao(cur, state, fleet)
-            mapa = gen_map_lote_compras(lotes, comp)
-
-            vend = gen_vendas(cur, state, lotes, prod)
-
-            gar = gen_garantia(cur, state, vend)
-            man = gen_manutencao(cur, state, fleet)
-
-            # grava tudo no lake (GCS)
-            for t, rows in [
-                ("raw_cliente", cli),
-                ("raw_compras", comp),
-                ("raw_map_lote_compras", mapa),
-                ("raw_producao", prod),
-                ("raw_lote", lotes),
-                ("raw_qualidade", qual),
-                ("raw_vendas", vend),
-                ("raw_garantia", gar),
-                ("raw_manutencao", man),
-                ("monitoramento_alertas", alt),
-            ]:
-                write_gcs_jsonl(sc, t, rows, run_id, cur)
-
-            counts["cli"] += len(cli)
-            counts["comp"] += len(comp)
-            counts["map"] += len(mapa)
-            counts["prod"] += len(prod)
-            counts["lote"] += len(lotes)
-            counts["qual"] += len(qual)
-            counts["vend"] += len(vend)
-            counts["gar"] += len(gar)
-            counts["man"] += len(man)
-            counts["alt"] += len(alt)
-
-            cur += timedelta(days=1)
-
-        save_state(sc, state)
-        return f"OK backfill run_id={run_id} | {counts}", 200
+        t0 = time.perf_counter()
+
+        # ?resume=<job> -> continua do último checkpoint commitado (parâmetros do job)
+        if resume:
+            ck = carregar_checkpoint(sc, resume)
+            if ck is None:
+                return f"ERRO: backfill job={resume} não encontrado", 404
+            ck = reconciliar_checkpoint(sc, ck, state)
+            if ck["status"] == "concluido":
+                objetos, counts = totais_checkpoint(ck)
+                return f"OK backfill job={resume} já concluído | objetos={objetos} | {counts}", 200
+        else:
+            if not start or not end:
+                return "ERRO: backfill requer ?mode=backfill&start=YYYY-MM-DD&end=YYYY-MM-DD", 400
+
+            try:
+                data_br(start)
+                data_br(end)
+            except Exception:
+                return "ERRO: formato de data inválido. Use YYYY-MM-DD", 400
+
+            if particao not in PARTICOES_BACKFILL:
+                return "ERRO: particao deve ser 'dia' ou 'mes'", 400
+
+            if granularidade not in GRANULARIDADES_BACKFILL:
+                return "ERRO: granularidade deve ser 'dia' ou 'hora'", 400
+
+            # ?workers=N -> modo paralelo determinístico (RNG por dia)
+            try:
+                n_workers = int(workers) if workers else None
+                dias_checkpoint = int(args.get("checkpoint", BACKFILL_CHECKPOINT_DIAS))
+            except ValueError:
+                return "ERRO: workers/checkpoint devem ser inteiros", 400
+            if dias_checkpoint < 1:
+                return "ERRO: checkpoint deve ser >= 1 dia", 400
+
+            # job = run_id da 1ª request; registro inicial commitado antes de gerar
+            ck = novo_checkpoint(run_id, {
+                "start": start,
+                "end": end,
+                "particao": particao,
+                "formato": formato,
+                "granularidade": GRANULARIDADES_BACKFILL[granularidade],
+                "workers": n_workers,
+                "checkpoint": dias_checkpoint,
+                "seed": int(state["seed"]),
+                "async": assincrono,
+                "telemetria": telemetria,
+            })
+            salvar_checkpoint(sc, ck)
+            state["backfill_jobs"][run_id] = {"cursor": start, "seq": 0}
+            store.save(state)
+
+            if assincrono:
+                disparar_backfill(run_id)
+                return f"ACEITO backfill job={run_id} | acompanhe em ?mode=status&job={run_id}", 202
+
+        job, p = ck["job"], ck["params"]
+        ck = executar_job_backfill(sc, store, state, fleet, ck, run_id, t0, crono)
+
+        objetos, counts = totais_checkpoint(ck)
+        info = f"run_id={run_id} | job={job}" + (f" | workers={p['workers']}" if p["workers"] else "")
+        if ck["status"] != "concluido":
+            # job assíncrono encadeado: a próxima request de resume continua daqui
+            if p.get("async") and BACKFILL_SELF_URL:
+                disparar_backfill(job)
+            return (f"PARCIAL backfill {info} | cursor={ck['cursor']} | objetos={objetos} | {counts} "
+                    f"| continue com ?mode=backfill&resume={job}"), 200
+        return f"OK backfill {info} | objetos={objetos} | {counts}", 200
 
     # -------------------------
     # INCREMENTAL (GCS + BQ ano atual)
     # -------------------------
-    cur = datetime.now(TZ_BR)
-    counts = {k: 0 for k in ["cli", "comp", "map", "prod", "lote", "qual", "vend", "gar", "man", "alt"]}
-
-    for _ in range(HORAS_POR_LOTE):
-        cli = gen_clientes(cur, state, passo_horas=1)
-        comp = gen_compras(cur, state)
-
-        prod, lotes, qual, alt = gen_producao(cur, state, fleet)
-        mapa = gen_map_lote_compras(lotes, comp)
-
-        vend = gen_vendas(cur, state, lotes, prod)
-
-        gar = gen_garantia(cur, state, vend)
-        man = gen_manutencao(cur, state, fleet)
-
-        # persiste no GCS sempre; carrega no BQ só ano atual
-        persist_table(sc, bq_client, cur, run_id, "raw_cliente", cli)
-        persist_table(sc, bq_client, cur, run_id, "raw_compras", comp)
-        persist_table(sc, bq_client, cur, run_id, "raw_map_lote_compras", mapa)
-        persist_table(sc, bq_client, cur, run_id, "raw_producao", prod)
-        persist_table(sc, bq_client, cur, run_id, "raw_lote", lotes)
-        persist_table(sc, bq_client, cur, run_id, "raw_qualidade", qual)
-        persist_table(sc, bq_client, cur, run_id, "raw_vendas", vend)
-        persist_table(sc, bq_client, cur, run_id, "raw_garantia", gar)
-        persist_table(sc, bq_client, cur, run_id, "raw_manutencao", man)
-        persist_table(sc, bq_client, cur, run_id, "monitoramento_alertas", alt)
-
-        counts["cli"] += len(cli)
-        counts["comp"] += len(comp)
-        counts["map"] += len(mapa)
-        counts["prod"] += len(prod)
-        counts["lote"] += len(lotes)
-        counts["qual"] += len(qual)
-        counts["vend"] += len(vend)
-        counts["gar"] += len(gar)
-        counts["man"] += len(man)
-        counts["alt"] += len(alt)
-
-        cur += timedelta(hours=1)
-
-    save_state(sc, state)
-    return f"OK incremental run_id={run_id} | {counts}", 200
+    # gera toda hora que falta desde o watermark (catch-up de invocações perdidas).
+    # Um dia por vez: gera, sobe cada hora na sua partição hr= e commita o state
+    # (watermark + contadores). Se um dia falha, o que ele já subiu é apagado e o
+    # state fica no último dia commitado: o retry regera só dali, sem duplicar.
+    counts = contagens_backfill(telemetria)
+    ticks = horas_pendentes(state, datetime.now(TZ_BR))
+    por_dia = {}
+    for cur in ticks:
+        por_dia.setdefault(cur.date(), []).append(cur)
+
+    for horas in por_dia.values():
+        with medir(crono, "gerar", horas=len(horas)) as sp:
+            passos = gerar_horas(horas, state, fleet)
+            sp["linhas"] = sum(len(b) for tabelas in passos for b in tabelas.values())
+
+        # persiste no GCS sempre; carrega no BQ só ano atual (hot layer coalescido via bq_pendentes)
+        # telemetria: só lake, um part-file parquet em streaming por hora (mesmo commit do dia)
+        subidas, tele = [], 0
+        try:
+            for cur, tabelas in zip(horas, passos):
+                subidas += persist_tables(sc, bq_client, cur, run_id, tabelas, state=state,
+                                          formato=formato, crono=crono).values()
+                if telemetria:
+                    chunks = gen_telemetria(tabelas["raw_producao"], fleet, telemetria, state["seed"])
+                    with medir(crono, "upload", tabela="raw_telemetria") as sp:
+                        uri, sp["bytes"], sp["linhas"] = write_gcs_stream(sc, "raw_telemetria", chunks, run_id, cur)
+                    if uri:
+                        subidas.append(uri)
+                    tele += sp["linhas"]
+        except PersistError as e:
+            for uri in subidas + list(e.uris.values()):
+                apagar_uri(sc, uri)
+            return f"ERRO incremental run_id={run_id} | {e}", 500
+        except Exception as e:
+            for uri in subidas:
+                apagar_uri(sc, uri)
+            return f"ERRO incremental run_id={run_id} | raw_telemetria: {e}", 500
+
+        if telemetria:
+            counts["tele"] += tele
+        state["watermark"] = horas[-1].isoformat()
+        for k, t in TABELAS_FATO:
+            counts[k] += sum(len(tabelas[t]) for tabelas in passos)
+        with medir(crono, "save_state"):
+            store.save(state)
+
+    # hot layer: loads coalescidos (?flush=1 força carregar tudo que está pendente)
+    carregadas = flush_bq_pendentes(bq_client, state, datetime.now(TZ_BR), forcar=forcar_flush, crono=crono)
+
+    with medir(crono, "save_state"):
+        store.save(state)
+    return (f"OK incremental run_id={run_id} | horas={len(ticks)} | watermark={state['watermark']} "
+            f"| bq_loads={carregadas} | {counts}"), 200